@@ -0,0 +1,169 @@
+import threading
+import time
+from typing import Optional
+
+
+
+class AutoSaver:
+    """
+    Saves a ChatWrapper in the background, so the chat loop never waits on a save and a crash loses at most a few turns
+    Changes are reported with mark_dirty, which is a change listener of the wrapper's chat log and GPTChat (see ChatLog.add_change_listener), so messages, the system prompt, wildcards, priorities, pins, the model and its parameters are all saved. Changes are coalesced: a save is made once max_dirty_messages messages are unsaved, or interval seconds after the first unsaved change, whichever comes first
+    mark_dirty only takes a copy on write fork of the chat log (see ChatLog.fork), which holds the length of the history and a copy of the window, so it takes about the same time however long the chat is. The worker thread stores the fork with the wrapper's storage (see StorageBackends.py), which writes JSON saves atomically and only appends the new messages to a SQLite save.
+    A fork is released once it is written or a newer one replaces it (see ChatLog.release), so the chat log goes back to changing its messages in place
+    The fork shares the chat log's history lock, which the worker holds while it reads the fork into a save dict, so the chat log's own thread can't add to or change the shared history at the same time. The save is written after the lock is let go
+    Attributes:
+        chat_wrapper (ChatWrapper): The wrapper that is saved
+        name (str): The save name, defaults to autosave_<wrapper uuid> in the wrapper's storage, so it shows up in the load menus
+        interval (float): Most seconds a change waits before it is saved
+        max_dirty_messages (int): Number of unsaved messages that triggers a save straight away
+        saves (int): Number of saves written
+        last_error (Exception): The last error raised while saving, if any. The change is kept and tried again at the next save
+    Methods:
+        start(): Starts the worker thread and listens for changes
+        watch(): Listens for changes to the wrapper's current chat log and GPTChat, called by the wrapper when either is replaced
+        mark_dirty(messages: int = 1): Records a change, called from the chat loop's thread
+        flush(): Writes any unsaved change now, in the calling thread
+        stop(flush: bool = True): Stops the worker thread, writing any unsaved change first if flush is True
+    Example Usage:
+        autosaver = chat_wrapper.enable_autosave(interval=30, max_dirty_messages=10)
+        chat_wrapper.chat_with_assistant("Hello")  # saved in the background
+        chat_wrapper.gpt_chat.temperature = 0.5  # so is this
+        chat_wrapper.disable_autosave()
+    """
+
+    def __init__(self, chat_wrapper, file_name: str = None, interval: float = 30.0, max_dirty_messages: int = 10):
+        if interval <= 0:
+            raise ValueError("interval must be more than 0")
+        if max_dirty_messages < 1:
+            raise ValueError("max_dirty_messages must be at least 1")
+        self.chat_wrapper = chat_wrapper
+        if file_name is None:
+            file_name = f"autosave_{chat_wrapper.uuid}"
+        self.name = chat_wrapper.save_and_load._remove_file_path(file_name)
+        self.interval = interval
+        self.max_dirty_messages = max_dirty_messages
+        self.saves = 0
+        self.last_error: Optional[Exception] = None
+        self._condition = threading.Condition()
+        # only one save is written at a time, and never an older state after a newer one
+        self._write_lock = threading.Lock()
+        self._snapshot = None
+        self._snapshot_number = 0
+        self._written_number = 0
+        self._dirty_messages = 0
+        self._dirty_since = None
+        self._stopping = False
+        self._thread = None
+        # the chat log and GPTChat mark_dirty is listening to
+        self._watched = []
+
+    def start(self) -> None:
+        if self._thread is not None:
+            return
+        self._stopping = False
+        self.watch()
+        self._thread = threading.Thread(target=self._run, name="AutoSaver", daemon=True)
+        self._thread.start()
+
+    def watch(self) -> None:
+        self._unwatch()
+        self._watched = [watched for watched in (self.chat_wrapper.chat_log, self.chat_wrapper.gpt_chat) if watched is not None]
+        for watched in self._watched:
+            watched.add_change_listener(self.mark_dirty)
+
+    def _unwatch(self) -> None:
+        for watched in self._watched:
+            watched.remove_change_listener(self.mark_dirty)
+        self._watched = []
+
+    def mark_dirty(self, messages: int = 1) -> None:
+        """Records a change of messages messages, and wakes the worker if a save is due"""
+        snapshot = (self.chat_wrapper.chat_log.fork(), self.chat_wrapper.gpt_chat.make_save_dict())
+        with self._condition:
+            self._snapshot_number += 1
+            replaced, self._snapshot = self._snapshot, (self._snapshot_number, snapshot)
+            self._dirty_messages += messages
+            if self._dirty_since is None:
+                self._dirty_since = time.monotonic()
+            self._condition.notify()
+        if replaced is not None:
+            self._release(replaced)
+
+    @staticmethod
+    def _release(snapshot) -> None:
+        """Stops the snapshot's fork sharing messages with the chat log, once it won't be written"""
+        snapshot[1][0].release()
+
+    def _take_snapshot(self):
+        """Returns the latest snapshot and marks it as being saved, call with the condition held"""
+        snapshot = self._snapshot
+        self._snapshot = None
+        self._dirty_messages = 0
+        self._dirty_since = None
+        return snapshot
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                while True:
+                    if self._stopping:
+                        return
+                    if self._snapshot is not None:
+                        waited = time.monotonic() - self._dirty_since
+                        if self._dirty_messages >= self.max_dirty_messages or waited >= self.interval:
+                            snapshot = self._take_snapshot()
+                            break
+                        self._condition.wait(self.interval - waited)
+                    else:
+                        self._condition.wait()
+            self._write(snapshot)
+            snapshot = None
+
+    def _write(self, snapshot) -> None:
+        number, (chat_log, gpt_chat_dict) = snapshot
+        with self._write_lock:
+            if number <= self._written_number:
+                self._release(snapshot)
+                return
+            try:
+                self.chat_wrapper.save_and_load.save_chat(self.name, chat_log, gpt_chat_dict)
+            except Exception as e:
+                self.last_error = e
+                with self._condition:
+                    # keep the change, unless a newer one has come in since
+                    kept = self._snapshot is None
+                    if kept:
+                        self._snapshot = snapshot
+                        self._dirty_since = time.monotonic()
+                if not kept:
+                    self._release(snapshot)
+                return
+            self._written_number = number
+            self.saves += 1
+        self._release(snapshot)
+
+    def flush(self) -> None:
+        """Writes the latest unsaved change now, in the calling thread"""
+        with self._condition:
+            snapshot = self._take_snapshot()
+        if snapshot is not None:
+            self._write(snapshot)
+
+    def stop(self, flush: bool = True) -> None:
+        self._unwatch()
+        if self._thread is not None:
+            with self._condition:
+                self._stopping = True
+                self._condition.notify()
+            self._thread.join()
+            self._thread = None
+        if flush:
+            self.flush()
+        else:
+            with self._condition:
+                snapshot = self._take_snapshot()
+            if snapshot is not None:
+                self._release(snapshot)
+
+    def __repr__(self):
+        return f"AutoSaver(name={self.name!r}, interval={self.interval}, max_dirty_messages={self.max_dirty_messages}, saves={self.saves})"
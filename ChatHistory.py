@@ -1,14 +1,28 @@
+import copy
 import datetime
+import functools
 import json
 import os
+import random
+import re
+import sys
+import threading
 import unittest
 import uuid
+import weakref
+from bisect import bisect_left, bisect_right
 from collections import UserDict, UserList, UserString, deque, namedtuple
-
-import tiktoken
-tiktoken.model.MODEL_TO_ENCODING["gpt-35-turbo"] = "cl100k_base"
+from itertools import accumulate, islice
+from typing import Callable, Iterator
+from collections.abc import Mapping
 
 from EncodeMessage import BadMessageError, EncodedMessage, EncodeMessage
+from ForkedHistory import ForkedHistory
+from SpilledHistory import SpilledHistory
+from StorageBackends import StoredHistory, make_storage
+from TokenCounter import tokenizer_registry
+from TrimPolicies import FifoPolicy, TrimPolicy, make_trim_policy
+from TrimmedWindow import TrimmedWindow
 
 
 class NoSystemPromptError(Exception):
@@ -23,13 +37,76 @@ class BadSaveDictError(Exception):
     pass
 
 
-class Message(UserDict):
+class BaseMessage:
+    """
+    Shared behaviour for Message and CompactMessage, both of which can be turned into the dict the API expects with dict(message)
+    Subclasses must provide role, content, model, _tokens and _encoding_tokens attributes
+    Methods:
+        tokens: Property, the number of tokens in the message, counted the first time it is accessed and then stored
+        set_model: Switches the model used to count tokens, keeping the count for the old encoding in case it is switched back
+        copy: Returns a new message of the same class with the same content and token counts
+        _count_tokens: Counts the number of tokens in a string, with the message's model
+        pretty: Returns a pretty-printed version of the message
+    """
+
+    __slots__ = ()
+
+    @property
+    def tokens(self) -> int:
+        """The number of tokens in the message, counted on first access"""
+        if self._tokens is None:
+            self._tokens = self._count_tokens(self.content)
+        return self._tokens
+
+    @tokens.setter
+    def tokens(self, value: int):
+        self._tokens = value
+
+    def set_model(self, model: str, old_encoding: str = None, new_encoding: str = None) -> None:
+        """Switches the model used to count tokens. If the encoding stays the same the count is kept, otherwise it is stored under the old encoding and the count for the new one is used if the message was counted with it before.
+        old_encoding and new_encoding can be passed in to save looking them up for every message"""
+        if old_encoding is None:
+            old_encoding = tokenizer_registry.encoding_name_for_model(self.model)
+        if new_encoding is None:
+            new_encoding = tokenizer_registry.encoding_name_for_model(model)
+        self.model = model
+        if old_encoding == new_encoding:
+            return
+        counts = self._encoding_tokens
+        if self._tokens is not None:
+            if counts is None:
+                counts = self._encoding_tokens = {}
+            counts[old_encoding] = self._tokens
+        self._tokens = counts.pop(new_encoding, None) if counts else None
+
+    def copy(self) -> "BaseMessage":
+        """Returns a new message of the same class with the same role, content, model and token counts"""
+        message = type(self)(self.role, self.content, self.model, self._tokens)
+        if self._encoding_tokens:
+            message._encoding_tokens = dict(self._encoding_tokens)
+        return message
+
+    def _count_tokens(self, string):
+        return tokenizer_registry.count_tokens(string, self.model)
+
+    def pretty(self):
+        if self.role == "user":
+            return f"> {self.content}"
+        elif self.role == "assistant":
+            return f" >> \u001b[32m{self.content}\u001b[0m"
+        elif self.role == "system":
+            return f" >>> \u001b[31m{self.content}\u001b[0m"
+        else:
+            return f" >> {self.content}"
+
+
+class Message(BaseMessage, UserDict):
     """
     A message object containing a role and content, along with methods to count tokens and style
     Attributes:
         role (str): The role of the message, either 'user', 'assistant', or 'system'
         content (str): The content of the message
-        tokens (int): The number of tokens in the message
+        tokens (int): The number of tokens in the message, counted the first time it is accessed and then stored
         model (str): The model used to encode the message, for use in counting tokens
         .data (dict): The data of the message, containing the role and content
     Methods:
@@ -38,27 +115,69 @@ class Message(UserDict):
 
     """
 
-    def __init__(self, role: str, content: str, model: str = "gpt-4"):
+    def __init__(self, role: str, content: str, model: str = "gpt-4", tokens: int = None):
         super().__init__({"role": role, "content": content})
         self.role = role
         self.content = content
         self.model = model
-        self.tokens = self._count_tokens(content)
+        # counted lazily, messages that are only printed, exported or loaded outside the trimmed window never need it
+        self._tokens = tokens
+        # encoding name -> token count, for encodings other than the current model's, only made once the model is switched
+        self._encoding_tokens = None
 
-    def _count_tokens(self, string):
-        # if self.model == "gpt-3.5" or self.model == "gpt-35-turbo":
-        encoding = tiktoken.encoding_for_model(self.model)
-        return len(encoding.encode(string))
 
-    def pretty(self):
-        if self.role == "user":
-            return f"> {self.content}"
-        elif self.role == "assistant":
-            return f" >> \u001b[32m{self.content}\u001b[0m"
-        elif self.role == "system":
-            return f" >>> \u001b[31m{self.content}\u001b[0m"
-        else:
-            return f" >> {self.content}"
+class CompactMessage(BaseMessage, Mapping):
+    """
+    A read only message that uses __slots__ instead of a UserDict, so role and content are only stored once and there is no instance __dict__
+    Works anywhere a Message does: dict(message) gives the API dict, and it has .data, .tokens, and .pretty()
+    Use it in a ChatLog with ChatLog(compact_messages=True). For a comparison with Message, run `python -m benchmarks.message_memory`
+    Attributes:
+        role (str): The role of the message, either 'user', 'assistant', or 'system'
+        content (str): The content of the message
+        tokens (int): The number of tokens in the message, counted the first time it is accessed and then stored
+        model (str): The model used to encode the message, for use in counting tokens
+        .data (dict): A new dict containing the role and content
+    """
+
+    # __weakref__ lets a SpilledHistory find a spilled message that is still in use
+    __slots__ = ("role", "content", "model", "_tokens", "_encoding_tokens", "__weakref__")
+    _keys = ("role", "content")
+
+    def __init__(self, role: str, content: str, model: str = "gpt-4", tokens: int = None):
+        self.role = role
+        self.content = content
+        self.model = model
+        self._tokens = tokens
+        self._encoding_tokens = None
+
+    def __getitem__(self, key: str) -> str:
+        if key == "role":
+            return self.role
+        if key == "content":
+            return self.content
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return 2
+
+    @property
+    def data(self) -> dict:
+        return {"role": self.role, "content": self.content}
+
+    def __repr__(self):
+        return repr(self.data)
+
+
+def holds_history_lock(method):
+    """Runs a ChatLog method with the chat log's history lock held, for methods that change full_chat_log or its messages, see ChatLog.fork"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._history_lock:
+            return method(self, *args, **kwargs)
+    return wrapper
 
 
 class ChatLog:
@@ -66,6 +185,10 @@ class ChatLog:
         "date": {"value": "__DATE__", "description": "The current date and time"},
         "model": {"value": "__MODEL__", "description": "The model used to encode the message"}
     }
+    # priority given to pinned messages, they are evicted after every other message
+    PINNED_PRIORITY = sys.maxsize
+    # the date wildcard is shown to the second, so an expanded system prompt that uses it is good for one second
+    date_format = "%B,%d, %Y %H:%M:%S"
     
     """
     A ChatLog class for managing and preparing a chat log for use with the OpenAI API.
@@ -78,9 +201,16 @@ class ChatLog:
             max_chat_tokens (int): Maximum tokens allowed for the chat log.
         Chat Log:
             max_chat_messages (int): Maximum messages allowed in the chat log.
-            model (str): Model used to encode the messages for token counting.
-            full_chat_log (list): Contains Message objects.
-            trimmed_chat_log (deque): Contains Message objects, trimmed to max_chat_messages and max_chat_tokens.
+            model (str): Property, the model used to encode the messages for token counting. Switching to a model with another encoding recounts the window, each message is only counted once per encoding.
+            message_class (type): Message, or CompactMessage if compact_messages=True was passed to the constructor. Used by make_message.
+            trim_policy (TrimPolicy): Decides which messages are evicted, made from the trim_policy and trim_policy_options constructor arguments. See TrimPolicies.py.
+            journal (ChatJournal): Optional, appends every change to a JSONL journal with periodic snapshots. See ChatJournal.py.
+            compactor (ContextCompactor): Optional, summarizes evicted messages into the finished chat log. See ContextCompactor.py.
+            retriever (HistoryRetriever): Optional, brings relevant evicted messages back into the leftover token budget. See HistoryRetriever.py.
+            full_chat_log (list): Contains Message objects. A ForkedHistory in a chat log made by fork(). A SpilledHistory if spill_history=True was passed to the constructor, which keeps only the newest spill_resident_messages in memory and the rest in a segment file in spill_folder. See SpilledHistory.py. A StoredHistory once it has been loaded from a SQLiteStorage, which reads the saved messages from the database when they are needed. See StorageBackends.py.
+            trimmed_chat_log (TrimmedWindow): Contains Message objects, trimmed to max_chat_messages and max_chat_tokens. Works like a deque of the messages, and also knows the position of each one in full_chat_log and the lane it is evicted from. See TrimmedWindow.py.
+            _token_prefix (list): Running token totals over full_chat_log[_token_index_start:], used to find the trimmed window by binary search. It is built from the end of full_chat_log and only extended back as far as a budget reaches.
+            _token_prefixes (dict): The _token_index_start and _token_prefix of each encoding the chat log has used before the current one, so switching back to a model doesn't redo them.
         Other:
             _sys_prompt (str): System prompt. Must be added via setter before use.
             is_loaded (bool): True if the chat log has been loaded from a file.
@@ -89,15 +219,23 @@ class ChatLog:
         Token Information:
             set_token_info, work_out_tokens
         Chat Log Setup and Management:
-            setup, trim_chat_log, add_message, add_message_list
+            setup, trim_chat_log, set_trim_policy, add_message, add_message_list, count_message_tokens, find_window_start, count_window_tokens, iter_default_messages, rebuild_trimmed_chat_log, evict_from_window
         System Prompt:
             _check_sys_prompt, system_prompt
         Messages:
-            make_message, add_message_obj, get_messages, get_messages_as_list
+            make_message, add_message_obj, get_messages, get_messages_as_list, get_messages_at, get_last_message
+        Priorities:
+            set_message_priority, get_message_priority, pin_message, pin_last_message, unpin_message, get_pinned_positions
+        Compaction and Retrieval:
+            set_compactor, set_retriever, count_evicted, count_settled_evictions, get_evicted_positions, get_evicted_messages
+        Journaling and Change Listeners:
+            set_journal, add_change_listener, remove_change_listener
+        Range Queries:
+            get_message_range, get_last_turns, get_window_messages, get_page, get_page_count, count_messages
         Save/Load:
             save, load
         Other:
-            add_more_wildcards, _add_wildcards, _check_wildcards
+            fork, release, add_more_wildcards, _check_wildcards
 
     Subclasses:
         SaveToDict: Saves/loads the class to a dictionary and verifies it.
@@ -117,7 +255,7 @@ class ChatLog:
         BadMessageError, NoSystemPromptError, NoTokenInfoError, BadSaveDictError
 
     Dependencies:
-        Message class, Tiktoken module
+        Message class, Tiktoken module (through the tokenizer registry in TokenCounter.py)
     """
     version = "1.0.1"
 
@@ -130,7 +268,13 @@ class ChatLog:
         save_folder="chat_log_saves",
         model="gpt-4",
         max_chat_messages: int = 200,
-       
+        compact_messages: bool = False,
+        trim_policy: str = "fifo",
+        trim_policy_options: dict = None,
+        spill_history: bool = False,
+        spill_folder: str = None,
+        spill_resident_messages: int = 100,
+        storage=None,
     ):
         self.constructor_args = {
             "max_model_tokens": max_model_tokens,
@@ -140,7 +284,13 @@ class ChatLog:
             "save_folder": save_folder,
             "model": model,
             "max_chat_messages": max_chat_messages,
-
+            "compact_messages": compact_messages,
+            "trim_policy": trim_policy,
+            "trim_policy_options": trim_policy_options,
+            "spill_history": spill_history,
+            "spill_folder": spill_folder,
+            "spill_resident_messages": spill_resident_messages,
+            "storage": storage,
         }
         self.token_info = {
             "max_model_tokens": int(max_model_tokens),
@@ -152,17 +302,47 @@ class ChatLog:
         self._max_completion_tokens = max_completion_tokens
         self._token_padding = token_padding
         self.save_to_dict = self.SaveToDict(self)
-        self.save_to_file = self.SaveToFile(self, save_folder)
-        self.model = model
+        self.save_to_file = self.SaveToFile(self, save_folder, storage)
+        self._model = model
         self.max_chat_tokens = None
-        self.max_chat_messages = max_chat_messages
-        self.full_chat_log = []
-        self.trimmed_chat_log = deque()
+        self._max_chat_messages = max_chat_messages
+        self.spill_history = spill_history
+        self.spill_folder = spill_folder
+        self.spill_resident_messages = spill_resident_messages
+        self.message_class = CompactMessage if compact_messages else Message
+        # the chat logs sharing message objects through fork(), this one included, or None. The messages are copied before they are changed while another of them is alive
+        self._sharing = None
+        # held while full_chat_log or its messages change and while a save dict is made, shared with forks so one can be saved from another thread (ie by AutoSaver)
+        self._history_lock = threading.RLock()
+        self.full_chat_log = self._new_full_chat_log()
+        # also holds the API dicts for its messages, kept in step with it so get_finished_chat_log doesn't rebuild them every turn
+        self.trimmed_chat_log = TrimmedWindow()
         self.trimmed_chat_log_tokens = 0
+        # (the window's position list, how many evicted messages come before each of them), for get_evicted_positions
+        self._evicted_index = None
+        # _token_prefix[j] - _token_prefix[i] is the total tokens of full_chat_log[_token_index_start + i:_token_index_start + j]
+        # None until it is first needed, then it starts at the end of full_chat_log and is extended back on demand, so it never reads more of the history than a window needs
+        self._token_index_start = None
+        self._token_prefix = None
+        # encoding name -> (_token_index_start, _token_prefix) for the encodings used before the current one
+        self._token_prefixes = {}
+        # role -> positions in full_chat_log, caught up with full_chat_log when looked at
+        self._role_index = {}
+        self._role_indexed = 0
+        # position in full_chat_log -> priority, only for messages that aren't the default priority of 0
+        self._priorities = {}
         self._sys_prompt = None
+        self._sys_prompt_cache = None
         self.trimmed_messages = 0
         self.is_loaded = False
-        self.max_chat_messages = max_chat_messages
+        self.trim_policy: TrimPolicy = make_trim_policy(trim_policy, trim_policy_options)
+        # optional ContextCompactor and HistoryRetriever, set with set_compactor and set_retriever
+        self.compactor = None
+        self.retriever = None
+        # optional ChatJournal, set with set_journal
+        self.journal = None
+        # called with the number of messages added after each change, see add_change_listener
+        self._change_listeners = []
         if extra_wildcards:
             self.system_prompt_wildcards.update(extra_wildcards)
         # this is for use with the ChatLogAndGPTChatFactory class, see object_factory.py for more info 
@@ -198,6 +378,54 @@ class ChatLog:
             if "description" not in value:
                 raise BadMessageError("Wildcard values must have a description key")
     @property
+    def model(self) -> str:
+        return self._model
+    @model.setter
+    @holds_history_lock
+    def model(self, model: str):
+        """Switches the model used to count tokens. Models with the same encoding (ie gpt-4 and gpt-3.5-turbo) share their counts, so only the system prompt is looked at again.
+        Otherwise every message is moved to the new encoding, keeping its old count, and only the messages in the window are counted now, in one batch. The rest are counted when they are needed"""
+        old_model = self._model
+        if model == old_model:
+            return
+        new_encoding = tokenizer_registry.encoding_name_for_model(model)
+        old_encoding = tokenizer_registry.encoding_name_for_model(old_model)
+        self._model = model
+        if isinstance(self.full_chat_log, SpilledHistory):
+            self.full_chat_log.model = model
+        if new_encoding != old_encoding:
+            self._switch_encoding(old_model, old_encoding, new_encoding)
+        if self.max_chat_tokens is not None:
+            self.work_out_tokens()
+            self.trim_chat_log()
+        self._record("param", name="model", value=model)
+
+    def _switch_encoding(self, old_model: str, old_encoding: str, new_encoding: str) -> None:
+        """Moves every message and the token index from old_encoding to new_encoding, and recounts the window"""
+        model = self._model
+        if self._shares_messages:
+            self._copy_shared_messages()
+        # messages loaded from a save may have been made with another model, so the encoding is looked up per model
+        encodings = {old_model: old_encoding}
+        # loaded windows hold their own copies of the messages, so both are gone through, messages already moved are skipped
+        # spilled messages that aren't in memory are read back with the new model's counts, so only the loaded ones are moved
+        full_chat_log = self.full_chat_log
+        if isinstance(full_chat_log, (SpilledHistory, StoredHistory)):
+            full_chat_log = full_chat_log.loaded_messages()
+        for messages in (full_chat_log, self.trimmed_chat_log):
+            for message in messages:
+                if message.model == model:
+                    continue
+                encoding = encodings.get(message.model)
+                if encoding is None:
+                    encoding = encodings[message.model] = tokenizer_registry.encoding_name_for_model(message.model)
+                message.set_model(model, encoding, new_encoding)
+        self._token_prefixes[old_encoding] = (self._token_index_start, self._token_prefix)
+        self._token_index_start, self._token_prefix = self._token_prefixes.pop(new_encoding, (None, None))
+        self.count_message_tokens(self.trimmed_chat_log)
+        self.trimmed_chat_log_tokens = sum(message.tokens for message in self.trimmed_chat_log)
+
+    @property
     def max_model_tokens(self)-> int:
         
         return self._max_model_tokens
@@ -207,6 +435,7 @@ class ChatLog:
             raise TypeError("max_model_tokens must be an integer")
         self._max_model_tokens = value
         self.work_out_tokens()
+        self._record("param", name="max_model_tokens", value=value)
     @property
     def max_completion_tokens(self)-> int:
         return self._max_completion_tokens
@@ -216,6 +445,7 @@ class ChatLog:
             raise TypeError("max_completion_tokens must be an integer")
         self._max_completion_tokens = value
         self.work_out_tokens()
+        self._record("param", name="max_completion_tokens", value=value)
     @property
     def token_padding(self)-> int:
         return self._token_padding
@@ -225,7 +455,24 @@ class ChatLog:
             raise TypeError("token_padding must be an integer")
         self._token_padding = value
         self.work_out_tokens()
-        
+        self._record("param", name="token_padding", value=value)
+    @property
+    def max_chat_messages(self) -> int:
+        return self._max_chat_messages
+    @max_chat_messages.setter
+    def max_chat_messages(self, value: int):
+        """Sets the max number of messages in the trimmed chat log, None for no limit. Evicted messages come back if the limit is raised"""
+        if value is not None and not isinstance(value, int):
+            raise TypeError("max_chat_messages must be an integer or None")
+        old_value = self._max_chat_messages
+        self._max_chat_messages = value
+        if value == old_value:
+            return
+        if value is not None and old_value is not None and value < old_value:
+            self.trim_chat_log()
+        else:
+            self.rebuild_trimmed_chat_log()
+        self._record("param", name="max_chat_messages", value=value)
     
 
     def set_token_info(
@@ -256,7 +503,7 @@ class ChatLog:
     def sys_prompt(self):
         """Returns the system prompt with wildcards added"""
         self._check_sys_prompt()
-        return self._add_wildcards(self._sys_prompt)
+        return self._expand_sys_prompt()["expanded"]
 
     @sys_prompt.setter
     def sys_prompt(self, value: str):
@@ -264,78 +511,499 @@ class ChatLog:
         self._sys_prompt = value
         self.work_out_tokens()
         self.trim_chat_log()
+        self._record("sys_prompt", value=value)
 
     def add_more_wildcards(self, wildcards: dict):
         """Adds more wildcards to the system prompt"""
         self._check_wildcards(wildcards)
         self.system_prompt_wildcards.update(wildcards)
-
-    def _add_wildcards(self, string: str) -> str:
-        """Adds wildcards to the system prompt"""
-        # need to prevent extra curley braces in stirng from causing problems
-        if len(string) > 4_000:
-            rest_of_string = string[4_000:]
-            string = string[:4_000]
-        else:
-            rest_of_string = ""
-        def replace_curley(string: str) -> str:
-            return string.replace("{", "|__").replace("}", "__|")
-        def undo_curley_replace(string: str) -> str:
-            return string.replace("|__", "{").replace("__|", "}")
-        wild_cards = {
-            key: value["value"] for key, value in self.system_prompt_wildcards.items()
-        }
-        for key, value in wild_cards.items():
-            if value == "__DATE__":
-                wild_cards[key] = datetime.datetime.now().strftime("%B,%d, %Y %H:%M:%S")
-            if value == "__MODEL__":
-                wild_cards[key] = self.model
-        ReplacedWildCards = namedtuple("ReplacedWildCards", ['name', 'value', 'wildcard'])
-        replaced_wildcards = [ReplacedWildCards(name=key, value=value, wildcard=replace_curley(key)) for key, value in wild_cards.items()]
-        replaced_str = replace_curley(string)
-        for wildcard in replaced_wildcards:
-            replaced_str = replaced_str.replace(wildcard.wildcard, wildcard.value)        
-
-        return undo_curley_replace(replaced_str) + rest_of_string
+        self._record("wildcards", value=wildcards)
+
+    def _expand_sys_prompt(self) -> dict:
+        """Returns the cached expansion of the system prompt, as a dict with the expanded prompt and its token count (None until work_out_tokens counts it).
+        The prompt is split once into static segments, with every wildcard but the date filled in, and dynamic date segments between them.
+        The static segments are only redone if the system prompt, the wildcards or the model changed, and the expansion is only redone when the shown date moved on"""
+        static_key = (
+            self._sys_prompt,
+            self.model,
+            tuple((key, value["value"]) for key, value in self.system_prompt_wildcards.items()),
+        )
+        cache = self._sys_prompt_cache
+        if cache is None or cache["static_key"] != static_key:
+            segments = self._split_sys_prompt(self._sys_prompt)
+            cache = self._sys_prompt_cache = {
+                "static_key": static_key,
+                "segments": segments,
+                "uses_date": any(is_dynamic for _, is_dynamic in segments),
+                "static_tokens": None,
+                "date": None,
+                "expanded": None,
+                "tokens": None,
+            }
+        date = datetime.datetime.now().strftime(self.date_format) if cache["uses_date"] else None
+        if cache["expanded"] is None or cache["date"] != date:
+            cache["date"] = date
+            cache["expanded"] = "".join(date if is_dynamic else text for text, is_dynamic in cache["segments"])
+            cache["tokens"] = None
+        return cache
+
+    def _split_sys_prompt(self, string: str) -> list[tuple[str, bool]]:
+        """Splits a system prompt into (text, is_dynamic) segments in a single pass, replacing each {name} with the value of the wildcard called name. Unknown names are left alone.
+        Static segments have their wildcards filled in, dynamic segments are date wildcards, with the wildcard name as the text"""
+        wild_cards = {key: value["value"] for key, value in self.system_prompt_wildcards.items()}
+        if not wild_cards:
+            return [(string, False)]
+        segments = []
+        static_parts = []
+        position = 0
+        for match in _compile_wildcard_pattern(tuple(wild_cards)).finditer(string):
+            static_parts.append(string[position:match.start()])
+            position = match.end()
+            key = match.group(1)
+            if wild_cards[key] == "__DATE__":
+                segments.append(("".join(static_parts), False))
+                segments.append((key, True))
+                static_parts = []
+            else:
+                static_parts.append(self._resolve_wildcard(wild_cards[key]))
+        static_parts.append(string[position:])
+        segments.append(("".join(static_parts), False))
+        return [segment for segment in segments if segment[1] or segment[0]]
+
+    def _count_sys_prompt_tokens(self, expansion: dict) -> int:
+        """Counts the tokens of an expanded system prompt. The static segments are counted once and kept, only the date segments are counted again.
+        Adding up the segments can come out a token or two over counting the whole prompt, since BPE can't merge across the segment edges, which errs on the safe side for the budget"""
+        if expansion["tokens"] is None:
+            if expansion["static_tokens"] is None:
+                expansion["static_tokens"] = sum(
+                    tokenizer_registry.count_tokens(text, self.model) for text, is_dynamic in expansion["segments"] if not is_dynamic
+                )
+            dynamic_segments = sum(1 for _, is_dynamic in expansion["segments"] if is_dynamic)
+            date_tokens = tokenizer_registry.count_tokens(expansion["date"], self.model) if dynamic_segments else 0
+            expansion["tokens"] = expansion["static_tokens"] + dynamic_segments * date_tokens
+        return expansion["tokens"]
+
+    def _resolve_wildcard(self, value: str) -> str:
+        """Works out the value of a static wildcard, __MODEL__ is replaced with the model. Date wildcards are dynamic segments, see _split_sys_prompt"""
+        if value == "__MODEL__":
+            return self.model
+        return value
 
     
 
    # methods for core functionality of trimming and managing the chat log
 
+    @holds_history_lock
     def work_out_tokens(self):
-        """Works out the number of tokens allowed for the chat log"""
+        """Works out the number of tokens allowed for the chat log, and refits the trimmed chat log if that number changed"""
+        old_max_chat_tokens = self.max_chat_tokens
         if  self._sys_prompt is not  None:
-            self.sys_prompt_message = self.make_message("system", self.sys_prompt)
-            self.sys_prompt_tokens = self.sys_prompt_message.tokens
+            expansion = self._expand_sys_prompt()
+            self.sys_prompt_tokens = self._count_sys_prompt_tokens(expansion)
+            self.sys_prompt_message = self.message_class("system", expansion["expanded"], self.model, tokens=self.sys_prompt_tokens)
         else:
             self.sys_prompt_tokens = 0
         
+        summary_tokens = self.compactor.max_summary_tokens if self.compactor is not None else 0
         self.max_chat_tokens = self.max_model_tokens - (
             self.sys_prompt_tokens
             + self.token_padding
             + self.max_completion_tokens
+            + summary_tokens
         )
         if self.max_chat_tokens < 0:
             self.max_chat_tokens = 500
+        if old_max_chat_tokens is None or old_max_chat_tokens == self.max_chat_tokens:
+            return
+        # a smaller budget only needs messages popped off the front, a bigger one may bring evicted messages back
+        if self.max_chat_tokens < old_max_chat_tokens:
+            self.trim_chat_log()
+        else:
+            self.rebuild_trimmed_chat_log()
       
     def trim_chat_log(self):
-        """Trims the chat log to the maximum number of messages and tokens allowed"""
-        if  self.max_chat_messages is not None:
-            while len(self.trimmed_chat_log) > self.max_chat_messages :
-                message = self.trimmed_chat_log.popleft()
-                self.trimmed_chat_log_tokens -= message.tokens
-                self.trimmed_messages += 1
-        while self.trimmed_chat_log_tokens > self.max_chat_tokens:
-            message = self.trimmed_chat_log.popleft()
-            self.trimmed_chat_log_tokens -= message.tokens
-            self.trimmed_messages += 1
+        """Trims the chat log to the maximum number of messages and tokens allowed.
+        Messages are evicted oldest first from one lane of the window at a time: lower priorities first, then the trim policy's lanes through the policy, then higher priorities, so pins are kept under every policy"""
+        if not self._over_budget():
+            return
+        window = self.trimmed_chat_log
+        for lane in self._eviction_order():
+            while lane in window.lanes and self._over_budget():
+                if isinstance(lane, str):
+                    self.trim_policy.evict(self, lane)
+                else:
+                    self.evict_from_window(lane)
+            if not self._over_budget():
+                return
+
+    def _over_budget(self) -> bool:
+        over_messages = self.max_chat_messages is not None and len(self.trimmed_chat_log) > self.max_chat_messages
+        return over_messages or self.trimmed_chat_log_tokens > self.max_chat_tokens
+
+    def _eviction_order(self) -> list:
+        """Returns the lanes of the window in the order they are evicted from. Priorities are lanes of their own, keyed by the priority"""
+        priorities = sorted(lane for lane in self.trimmed_chat_log.lanes if not isinstance(lane, str))
+        return [lane for lane in priorities if lane < 0] + list(self.trim_policy.lanes) + [lane for lane in priorities if lane > 0]
+
+    def _window_lane(self, position: int, message: BaseMessage):
+        """Returns the lane of the window a message goes in, its priority if it has one, otherwise the trim policy's lane for it"""
+        priority = self._priorities.get(position)
+        if priority is not None:
+            return priority
+        return self.trim_policy.lane(self, position, message)
+
+    def set_trim_policy(self, trim_policy: str = "fifo", trim_policy_options: dict = None) -> None:
+        """Switches to another trim policy, see TrimPolicies.py, and works the window out again under it. Raises TrimPolicyError if the name or options are not valid"""
+        self.trim_policy = make_trim_policy(trim_policy, trim_policy_options)
+        self.constructor_args["trim_policy"] = trim_policy
+        self.constructor_args["trim_policy_options"] = trim_policy_options
+        self.rebuild_trimmed_chat_log()
+        self._record("trim_policy", name=trim_policy, options=trim_policy_options)
+
+    def evict_from_window(self, lane=None) -> BaseMessage:
+        """Removes the oldest message in lane from the trimmed chat log, keeping the token count and API payload in step. For use by trim policies.
+        Without a lane it is the next message trim_chat_log would evict. Raises IndexError if the window is empty"""
+        window = self.trimmed_chat_log
+        if lane is None:
+            lane = next((lane for lane in self._eviction_order() if lane in window.lanes), None)
+            if lane is None:
+                raise IndexError("evict from an empty trimmed chat log")
+        position, message = window.evict(lane)
+        self.trimmed_chat_log_tokens -= message.tokens
+        self.trimmed_messages += 1
+        if self.retriever is not None:
+            self.retriever.note_evicted(self, (position,))
+        return message
+
+    def _extend_token_index(self, messages: list[BaseMessage]) -> None:
+        """Adds messages that were just appended to full_chat_log to the token index, if there is one and it was up to date before they were added"""
+        prefix = self._token_prefix
+        if prefix is None or self._token_index_start + len(prefix) + len(messages) != len(self.full_chat_log) + 1:
+            return
+        total = prefix[-1]
+        for message in messages:
+            total += message.tokens
+            prefix.append(total)
+
+    def _update_token_index(self) -> None:
+        """Catches the end of the token index up with full_chat_log, counting any messages without a token count in one batch.
+        If there is no index yet it starts out empty at the end of full_chat_log, and is extended back with _extend_token_index_back"""
+        length = len(self.full_chat_log)
+        if self._token_prefix is None:
+            self._token_index_start, self._token_prefix = length, [0]
+            return
+        indexed = self._token_index_start + len(self._token_prefix) - 1
+        if indexed < length:
+            missing = self.full_chat_log[indexed:]
+            self.count_message_tokens(missing)
+            self._token_prefix.extend(accumulate((message.tokens for message in missing), initial=self._token_prefix[-1]))
+            # accumulate starts with the initial total, which is already the last entry
+            del self._token_prefix[indexed - self._token_index_start]
+
+    def _extend_token_index_back(self, lower: int) -> None:
+        """Extends the token index back towards lower, but not past it. Each step reads at least as many messages as the index already covers, so the work is amortized over the messages it ends up covering"""
+        start, prefix = self._token_index_start, self._token_prefix
+        new_start = max(lower, start - max(len(prefix), 64))
+        messages = self.full_chat_log[new_start:start]
+        self.count_message_tokens(messages)
+        # totals counted down from the old first entry, so the entries already there stay the same
+        head = list(accumulate((message.tokens for message in reversed(messages)), lambda total, tokens: total - tokens, initial=prefix[0]))
+        head.reverse()
+        self._token_prefix = head[:-1] + prefix
+        self._token_index_start = new_start
+
+    def _reset_token_index(self) -> None:
+        self._token_index_start = None
+        self._token_prefix = None
+        self._token_prefixes = {}
+
+    def _update_role_index(self) -> dict:
+        """Catches the role index up with full_chat_log and returns it"""
+        for position in range(self._role_indexed, len(self.full_chat_log)):
+            self._role_index.setdefault(self.full_chat_log[position].role, []).append(position)
+        self._role_indexed = len(self.full_chat_log)
+        return self._role_index
+
+    def _reset_role_index(self) -> None:
+        self._role_index = {}
+        self._role_indexed = 0
+
+    @property
+    def _stores_roles(self) -> bool:
+        """True if full_chat_log keeps its own roles (ie SpilledHistory), which are used instead of the role index so a spilled history is never read to find a role"""
+        return getattr(self.full_chat_log, "stores_roles", False)
+
+    def _role_positions(self, role: str, start: int = 0, stop: int = None, reverse: bool = False) -> Iterator[int]:
+        """Returns an iterator of the positions in full_chat_log[start:stop] with the given role, newest first if reverse is True"""
+        if self._stores_roles:
+            return self.full_chat_log.role_positions(role, start, stop, reverse)
+        positions = self._update_role_index().get(role, [])
+        first = bisect_left(positions, start)
+        last = len(positions) if stop is None else bisect_left(positions, stop)
+        return (positions[i] for i in (range(last - 1, first - 1, -1) if reverse else range(first, last)))
+
+    def get_last_message(self, role: str) -> BaseMessage:
+        """Returns the most recent message with the given role, or None if there isn't one"""
+        position = next(self._role_positions(role, reverse=True), None)
+        if position is None:
+            return None
+        return self.full_chat_log[position]
+
+    def find_window_start(self, max_chat_tokens: int = None, max_chat_messages: int = None, lower: int = 0, end: int = None) -> int:
+        """Returns the index in full_chat_log where the trimmed chat log starts for the given budget, by binary search over the token index.
+        The index is only extended back until it holds more than the budget, so this reads about as many messages as the window has, however long the chat log is.
+        Defaults to the chat log's own max_chat_tokens and max_chat_messages. lower and end limit the search to full_chat_log[lower:end], for policies that keep some messages apart"""
+        if max_chat_tokens is None:
+            max_chat_tokens = self.max_chat_tokens
+        if max_chat_messages is None:
+            max_chat_messages = self.max_chat_messages
+        self._update_token_index()
+        if end is None:
+            end = len(self.full_chat_log)
+        if max_chat_messages is not None:
+            lower = max(lower, end - max_chat_messages)
+        while self._token_index_start > lower and (
+            self._token_index_start > end or self._token_prefix[end - self._token_index_start] - self._token_prefix[0] <= max_chat_tokens
+        ):
+            self._extend_token_index_back(lower)
+        offset, prefix = self._token_index_start, self._token_prefix
+        # the window is full_chat_log[start:end], the first start where the tokens from start to end fit the budget
+        start = bisect_left(prefix, prefix[end - offset] - max_chat_tokens, max(lower, offset) - offset, end - offset + 1) + offset
+        return min(start, end)
+
+    def count_window_tokens(self, start: int, end: int) -> int:
+        """Returns the total tokens of full_chat_log[start:end] from the token index, extending it back to start if it doesn't reach that far"""
+        self._update_token_index()
+        while self._token_index_start > start:
+            self._extend_token_index_back(start)
+        offset, prefix = self._token_index_start, self._token_prefix
+        return prefix[end - offset] - prefix[start - offset]
+
+    def iter_default_messages(self, start: int = None, stop: int = 0, keep: Callable = None):
+        """Yields the position and message of each message in full_chat_log[stop:start] with the default priority, newest first, for trim policies working out a window. keep(position, message) can pick out only some of them, such as one lane's.
+        The messages are read in blocks that double in size going back, and the ones picked out are counted together, so a caller that stops early has only read about as many messages as it used, and only counted the ones it was given"""
+        if start is None:
+            start = len(self.full_chat_log)
+        size = 16
+        while start > stop:
+            block_start = max(stop, start - size)
+            block = [
+                (position, message) for position, message in enumerate(self.full_chat_log[block_start:start], block_start)
+                if position not in self._priorities and (keep is None or keep(position, message))
+            ]
+            self.count_message_tokens([message for _, message in block])
+            yield from reversed(block)
+            start = block_start
+            size *= 2
+
+    def rebuild_trimmed_chat_log(self) -> None:
+        """Rebuilds the trimmed chat log from full_chat_log for the current budget, so messages evicted under a smaller budget come back when it grows"""
+        if self.max_chat_tokens is None or not self.full_chat_log:
+            return
+        self._set_window(self._select_window())
+
+    def _select_window(self) -> list[int]:
+        """Returns the positions in full_chat_log to keep in the trimmed chat log.
+        The lanes are filled in the opposite order to the one they are evicted in: the highest priorities first, then the trim policy's lanes, then the negative priorities, stopping at the first message that doesn't fit.
+        Prioritized messages are expected to be few and are walked one by one, the trim policy only reads back from the end of full_chat_log as far as its window goes"""
+        token_budget = self.max_chat_tokens
+        message_budget = self.trim_policy.message_budget(self)
+        if not self._priorities:
+            return self.trim_policy.select_window(self, token_budget, message_budget)[0]
+        tiers = {}
+        for position, priority in self._priorities.items():
+            tiers.setdefault(priority, []).append(position)
+        kept = []
+        for priority in sorted(set(tiers) | {0}, reverse=True):
+            if priority == 0:
+                positions, tokens, complete = self.trim_policy.select_window(self, token_budget, message_budget)
+                kept.extend(positions)
+                token_budget -= tokens
+                message_budget -= len(positions)
+                if not complete:
+                    break
+                continue
+            complete = True
+            for position in sorted(tiers[priority], reverse=True):
+                tokens = self.full_chat_log[position].tokens
+                if tokens > token_budget or message_budget <= 0:
+                    complete = False
+                    break
+                kept.append(position)
+                token_budget -= tokens
+                message_budget -= 1
+            # every lower priority is evicted before the message that didn't fit
+            if not complete:
+                break
+        return sorted(kept)
+
+    def get_messages_at(self, positions) -> list[BaseMessage]:
+        """Returns the messages at positions in full_chat_log, which are in order, reading each run of consecutive positions as one slice"""
+        if isinstance(positions, range) and positions.step == 1:
+            return self.full_chat_log[positions.start:positions.stop]
+        messages = []
+        run_start = None
+        for position in positions:
+            if run_start is None:
+                run_start = previous = position
+            elif position != previous + 1:
+                messages.extend(self.full_chat_log[run_start:previous + 1])
+                run_start = position
+            previous = position
+        if run_start is not None:
+            messages.extend(self.full_chat_log[run_start:previous + 1])
+        return messages
+
+    def _set_window(self, positions, messages: list[BaseMessage] = None) -> None:
+        """Replaces the trimmed chat log with the messages at positions in full_chat_log, oldest first. messages can be given if they have already been read, such as from a save"""
+        if messages is None:
+            messages = self.get_messages_at(positions)
+        self.count_message_tokens(messages)
+        window = TrimmedWindow()
+        for position, message in zip(positions, messages):
+            window.add(position, message, self._window_lane(position, message))
+        if self.retriever is not None:
+            self.retriever.note_evicted(self, [position for position in self.trimmed_chat_log.positions() if position not in window.positions()])
+        self.trimmed_chat_log = window
+        self.trimmed_chat_log_tokens = sum(message.tokens for message in messages)
+        self.trimmed_messages = len(self.full_chat_log) - len(window)
+
+    # evicted messages, for the compactor and retriever. The window can have gaps, so they aren't always the first trimmed_messages messages
+    def count_evicted(self, end: int = None) -> int:
+        """Returns how many messages in full_chat_log[:end] are not in the trimmed chat log"""
+        if end is None:
+            end = len(self.full_chat_log)
+        return end - bisect_left(self.trimmed_chat_log.position_list(), end)
+
+    def count_settled_evictions(self) -> int:
+        """Returns how many evicted messages come before the oldest message in the window that isn't protected.
+        Protected messages are those with a positive priority and those the trim policy keeps for longer (see TrimPolicy.protected_lanes). Messages are evicted from the front of the other lanes, so the settled evicted messages stay the same as more are evicted, and they can be chunked by their order"""
+        window = self.trimmed_chat_log
+        protected = self.trim_policy.protected_lanes
+        oldest = [
+            positions[0] for lane, positions in window.lanes.items()
+            if not (lane in protected if isinstance(lane, str) else lane > 0)
+        ]
+        return self.count_evicted(min(oldest) if oldest else None)
+
+    def get_evicted_positions(self, start: int = 0, stop: int = None) -> list[int]:
+        """Returns the positions in full_chat_log of the evicted messages from the start-th to before the stop-th, oldest first, in O(window + stop - start)"""
+        if stop is None:
+            stop = self.count_evicted()
+        window_positions = self.trimmed_chat_log.position_list()
+        if self._evicted_index is None or self._evicted_index[0] is not window_positions:
+            # gaps[j] is how many evicted messages come before the j-th window message, so the i-th evicted message has bisect_right(gaps, i) window messages before it
+            self._evicted_index = (window_positions, [position - j for j, position in enumerate(window_positions)])
+        gaps = self._evicted_index[1]
+        return [i + bisect_right(gaps, i) for i in range(start, stop)]
+
+    def get_evicted_messages(self, start: int = 0, stop: int = None) -> list[tuple[int, BaseMessage]]:
+        """Returns the position and message of the evicted messages from the start-th to before the stop-th, oldest first"""
+        positions = self.get_evicted_positions(start, stop)
+        return list(zip(positions, self.get_messages_at(positions)))
+
+    # message priorities, positions are indexes into full_chat_log and can be negative
+    def _check_position(self, position: int) -> int:
+        """Returns position as a non negative index into full_chat_log, raising IndexError if there is no message there"""
+        if not -len(self.full_chat_log) <= position < len(self.full_chat_log):
+            raise IndexError("No message at position {}".format(position))
+        return position % len(self.full_chat_log)
+
+    def set_message_priority(self, position: int, priority: int) -> None:
+        """Sets the priority of the message at position. Lower priorities are evicted first and the default is 0. The trimmed chat log is refit straight away"""
+        if not isinstance(priority, int):
+            raise TypeError("priority must be an integer")
+        position = self._check_position(position)
+        if priority == 0:
+            self._priorities.pop(position, None)
+        else:
+            self._priorities[position] = priority
+        self.rebuild_trimmed_chat_log()
+        self._record("priority", position=position, priority=priority)
+
+    def get_message_priority(self, position: int) -> int:
+        return self._priorities.get(self._check_position(position), 0)
+
+    def pin_message(self, position: int = -1) -> None:
+        """Pins the message at position, the last message by default, so it is kept for as long as the budget allows"""
+        self.set_message_priority(position, self.PINNED_PRIORITY)
+
+    def pin_last_message(self, role: str = "user") -> bool:
+        """Pins the most recent message with the given role, returns False if there isn't one"""
+        position = next(self._role_positions(role, reverse=True), None)
+        if position is None:
+            return False
+        self.pin_message(position)
+        return True
+
+    def unpin_message(self, position: int = -1) -> None:
+        self.set_message_priority(position, 0)
+
+    def get_pinned_positions(self) -> list[int]:
+        return sorted(position for position, priority in self._priorities.items() if priority == self.PINNED_PRIORITY)
+
        
     # main method to retrieve the chat log, for use with the OpenAI API
     def get_finished_chat_log(self):
-        """Returns the trimmed chat log with the system prompt at the start for use with the OpenAI API"""
-        head = [{"role": "system", "content": self.sys_prompt}]
-        tail = [dict(message) for message in self.trimmed_chat_log]
-        return head + tail
+        """Returns the trimmed chat log with the system prompt at the start for use with the OpenAI API.
+        The message dicts are kept up to date as messages are added and trimmed, so this is only a shallow copy of the list. Don't modify the dicts in it"""
+        self._check_sys_prompt()
+        expansion = self._expand_sys_prompt()
+        if expansion.get("api_message") is None or expansion["api_message"]["content"] is not expansion["expanded"]:
+            expansion["api_message"] = {"role": "system", "content": expansion["expanded"]}
+        if self.compactor is None and self.retriever is None:
+            return [expansion["api_message"], *self.trimmed_chat_log.payload()]
+        head = [expansion["api_message"]]
+        if self.compactor is not None:
+            summary_message = self.compactor.get_summary_message(self)
+            if summary_message is not None:
+                head.append(summary_message)
+        if self.retriever is not None:
+            retrieval_message = self.retriever.get_retrieval_message(self, self.max_chat_tokens - self.trimmed_chat_log_tokens)
+            if retrieval_message is not None:
+                head.append(retrieval_message)
+        return [*head, *self.trimmed_chat_log.payload()]
+
+    def set_retriever(self, retriever) -> None:
+        """Sets a HistoryRetriever (see HistoryRetriever.py) that brings relevant evicted messages back into the tokens left over after trimming, or None to turn it off"""
+        self.retriever = retriever
+
+    def set_journal(self, journal) -> None:
+        """Sets a ChatJournal (see ChatJournal.py) that saves every change to the chat log as it happens, or None to stop journaling.
+        If the journal's files already exist the chat log is loaded from them first"""
+        if self.journal is not None:
+            self.journal.close()
+        if journal is not None:
+            journal.open(self)
+    def set_compactor(self, compactor) -> None:
+        """Sets a ContextCompactor (see ContextCompactor.py) that summarizes evicted messages into the finished chat log, or None to turn it off.
+        The compactor's max_summary_tokens are taken out of the chat log's token budget"""
+        self.compactor = compactor
+        self.work_out_tokens()
+
+    def add_change_listener(self, listener: Callable[[int], None]) -> None:
+        """Calls listener(messages) after each change to the chat log, with the number of messages the change added (0 for the system prompt, wildcards, priorities, settings and resets).
+        A load is one change. AutoSaver uses this to save after every change"""
+        self._change_listeners.append(listener)
+
+    def remove_change_listener(self, listener: Callable[[int], None]) -> None:
+        if listener in self._change_listeners:
+            self._change_listeners.remove(listener)
+
+    def _record(self, op: str, **fields) -> None:
+        """Journals a change that didn't add messages, and tells the change listeners"""
+        if self.journal is not None:
+            self.journal.record(op, **fields)
+        self._notify_change(0)
+
+    def _record_messages(self, messages: list) -> None:
+        if self.journal is not None:
+            self.journal.record_messages(messages)
+        self._notify_change(len(messages))
+
+    def _notify_change(self, messages: int) -> None:
+        for listener in list(self._change_listeners):
+            listener(messages)
     @property
     def finished_chat_log(self):
         """Returns the trimmed chat log with the system prompt at the start"""
@@ -352,24 +1020,28 @@ class ChatLog:
         if role and content and message:
             raise ValueError("Only role and content or message can be provided")
         if message:
-            return Message(role = message["role"], content=message["content"], model=self.model)
-        return Message(role, content, self.model)
+            return self.message_class(role = message["role"], content=message["content"], model=self.model)
+        return self.message_class(role, content, self.model)
     
-    def add_message_obj(self, message: Message):
+    @holds_history_lock
+    def add_message_obj(self, message: BaseMessage):
         """Adds a message to the chat log"""
 
         self._check_sys_prompt()
         self.full_chat_log.append(message)
-        self.trimmed_chat_log.append(message)
+        position = len(self.full_chat_log) - 1
+        self.trimmed_chat_log.add(position, message, self._window_lane(position, message))
         self.trimmed_chat_log_tokens += message.tokens
+        self._extend_token_index([message])
         self.trim_chat_log()
+        self._record_messages([message])
     @property
     def assistant_message_obj(self):
         """Returns the assistant message object"""
         return self.make_message("assistant", self.assistant_message)
     @assistant_message_obj.setter
-    def assistant_message_obj(self, value: Message):
-        if not isinstance(value, Message):
+    def assistant_message_obj(self, value: BaseMessage):
+        if not isinstance(value, BaseMessage):
             raise TypeError("Value must be a Message object")
         self.add_message_obj(value)
     #helper functions to add messages to the chat log, takes a role and content, or a dictionary
@@ -385,12 +1057,35 @@ class ChatLog:
             message = self.make_message(role, content)
         self.add_message_obj(message)
     # add a list of messages to the chat log, takes a list of dicts
-    def add_message_list(self, message_list: list[dict]):
-        """Adds a list of messages to the chat log"""
-
-        for message in message_list:
-            message_obj = self.make_message(message=message)
-            self.add_message_obj(message_obj)
+    @holds_history_lock
+    def add_message_list(self, message_list: list[dict], bulk: bool = True):
+        """Adds a list of messages to the chat log.
+        In bulk mode (the default) the messages are counted together with tiktoken's threaded batch encoder, appended all at once, and the chat log is trimmed a single time at the end. The result is the same as adding them one at a time, which is what bulk=False does"""
+        if not bulk:
+            for message in message_list:
+                message_obj = self.make_message(message=message)
+                self.add_message_obj(message_obj)
+            return
+        self._check_sys_prompt()
+        messages = [self.make_message(message=message) for message in message_list]
+        self.count_message_tokens(messages)
+        first_position = len(self.full_chat_log)
+        self.full_chat_log.extend(messages)
+        for position, message in enumerate(messages, first_position):
+            self.trimmed_chat_log.add(position, message, self._window_lane(position, message))
+        self.trimmed_chat_log_tokens += sum(message.tokens for message in messages)
+        self._extend_token_index(messages)
+        self.trim_chat_log()
+        self._record_messages(messages)
+
+    def count_message_tokens(self, messages: list[BaseMessage]) -> None:
+        """Counts the tokens of every message that hasn't been counted yet, in one batch"""
+        uncounted = [message for message in messages if message._tokens is None]
+        if not uncounted:
+            return
+        counts = tokenizer_registry.count_tokens_batch([message.content for message in uncounted], self.model)
+        for message, tokens in zip(uncounted, counts):
+            message.tokens = tokens
             
                 
     #setters and getters for the last user and assistant messages, for convenience
@@ -399,12 +1094,7 @@ class ChatLog:
     @property
     def user_message(self)-> Message:
         """Returns the last user message"""
-        for message in self.get_messages(role = "user", limit = 1):
-            result = message
-        if result == None:
-            return None
-        else:
-            return result
+        return self.get_last_message("user")
 
     @user_message.setter
     def user_message(self, value: str ):
@@ -414,13 +1104,7 @@ class ChatLog:
     @property
     def assistant_message(self) -> Message:
         """Returns the last assistant message"""
-        result = None
-        for message in self.get_messages(role = "assistant", limit =1):
-            result = message
-        if result == None:
-            return None
-        else:
-            return result
+        return self.get_last_message("assistant")
 
     @assistant_message.setter
     def assistant_message(self, value: str) :
@@ -437,9 +1121,9 @@ class ChatLog:
     def load(self, filename: str) -> bool:
         """Wrapper for SaveToFile.load, loads a chat log from a file, check SaveToFile.load for more info"""
         return self.save_to_file.load(filename)
-    def make_save_dict(self) -> dict:
+    def make_save_dict(self, sized: bool = True) -> dict:
         """convenience function to make a save dict, calls SaveToDict.make_save_dict"""
-        return self.save_to_dict.save()
+        return self.save_to_dict.save(sized=sized)
     def load_save_dict(self, save_dict: dict) -> bool:
         """convenience function to load a save dict, calls SaveToDict.load()"""
         return self.save_to_dict.load(save_dict)
@@ -459,6 +1143,7 @@ class ChatLog:
             chat_log (ChatLog): the chat log object to save from.
             save_folder (str): the folder to save to.
             dict_saver (function): the SaveToDict object to use to save the state of the ChatLog object to a dict, and load from a dict.
+            storage (StorageBackend): where the saves are kept, a JSONStorage in save_folder by default. See StorageBackends.py.
         Methods:
         add_path(filename: str) -> str:
             Adds the save_folder to the filename if it doesn't already have it, and adds .json to the end if it doesn't already have it.
@@ -474,11 +1159,12 @@ class ChatLog:
 
         """
 
-        def __init__(self, chat_log, save_folder: str):
+        def __init__(self, chat_log, save_folder: str, storage=None):
             self.chat_log = chat_log
             if not save_folder.endswith("/"):
                 save_folder += "/"
             self.save_folder = save_folder
+            self.storage = make_storage(storage, save_folder)
             
             self.dict_saver = self.chat_log.save_to_dict
 
@@ -502,25 +1188,27 @@ class ChatLog:
   
         def save(self, filename: str, overwrite: bool = False) -> bool:
             """Save the current state of the chat log to a file. If overwrite is True, the file will be overwritten if it already exists, otherwise, False will be returned."""
-            filename = self.add_path(filename)
-            if os.path.exists(filename) and not overwrite:
+            name = self._save_name(filename)
+            if self.storage.exists(name) and not overwrite:
                 return False
-            save_dict = self.dict_saver.save()
-            with open(filename, "w") as f:
-                json.dump(save_dict, f)
+            self.storage.save_chat(name, self.chat_log)
             return True
 
         def load(self, filename: str) -> bool:
             """Using the SaveToDict class, load a save file."""
-            file_name = self.add_path(filename)
-            if not os.path.exists(file_name):
+            save_dict = self.storage.load(self._save_name(filename))
+            if save_dict is None:
                 return False
-            with open(file_name, "r") as f:
-                save_dict = json.load(f)
-          
             self.chat_log.save_to_dict.load(save_dict)
             return True
 
+        def _save_name(self, filename: str) -> str:
+            """Returns the name of the save in the storage, the file name without the save folder and .json"""
+            filename = os.path.basename(filename)
+            if filename.endswith(".json"):
+                filename = filename[:-5]
+            return filename
+
         def get_file_list(self, remove_path: bool = False) -> list:
             """Get a list of all files in the save folder. If remove_path is True, the save folder path will be removed from the filenames."""
             file_list = os.listdir(self.save_folder)
@@ -531,17 +1219,12 @@ class ChatLog:
     #related to getting and outputting messages
     # main function to get messages
     def get_messages(self, role: str = None, limit: int = None, reverse: bool = True) -> Message:
-        """Returns a generator of messages from the chat log in reverse order if limit is not None"""
-        chat_log = self.full_chat_log[::-1] if reverse else self.full_chat_log
-       
-        counter = 0
-        for message in chat_log:
-            
-            if role == None or message.role == role:
-                yield message
-                counter += 1
-            if limit != None and counter == limit:
-                break
+        """Returns a generator of messages from the chat log, newest first if reverse is True. If a role is given, only the positions of that role are visited, using the role index or the history's own roles"""
+        if role is None:
+            chat_log = reversed(self.full_chat_log) if reverse else iter(self.full_chat_log)
+        else:
+            chat_log = (self.full_chat_log[position] for position in self._role_positions(role, reverse=reverse))
+        yield from islice(chat_log, limit)
     #helper functions to get messages
     def get_message_obj(self, role: str = None, limit: int = None, reverse = None) -> Message:
         if reverse is None:
@@ -562,7 +1245,7 @@ class ChatLog:
             if format == "Message":
                 result.append(message)
             elif format == "str":
-                result.append(message.content())
+                result.append(message.content)
             elif format == "dict":
                 result.append(dict(message))
             elif format == "pretty":
@@ -570,21 +1253,158 @@ class ChatLog:
             else: 
                 result.append(message)
         return result
+    # range queries, these cost time in proportion to the number of messages returned, not the length of the chat log
+    def get_message_range(self, start: int = None, end: int = None, role: str = None) -> list[BaseMessage]:
+        """Returns the messages in full_chat_log[start:end], oldest first. Negative indexes count from the end, like a slice.
+        If a role is given, only messages with that role in the range are returned, found by binary search in the role index"""
+        start, end, _ = slice(start, end).indices(len(self.full_chat_log))
+        if role is None:
+            return self.full_chat_log[start:end]
+        return [self.full_chat_log[position] for position in self._role_positions(role, start, end)]
+
+    def get_last_turns(self, turns: int, role: str = None) -> list[BaseMessage]:
+        """Returns the messages from the last number of turns, oldest first. A turn starts at a user message and runs until the next one"""
+        if turns <= 0:
+            return []
+        user_positions = list(islice(self._role_positions("user", reverse=True), turns))
+        start = user_positions[-1] if len(user_positions) == turns else 0
+        return self.get_message_range(start, role=role)
+
+    def get_window_messages(self, start: int = None, end: int = None, role: str = None) -> list[BaseMessage]:
+        """Returns messages that are still in the trimmed chat log, with start and end counted within the trimmed chat log"""
+        start, end, _ = slice(start, end).indices(len(self.trimmed_chat_log))
+        return [message for message in islice(self.trimmed_chat_log, start, end) if role is None or message.role == role]
+
+    def get_page(self, page: int, page_size: int = 20, role: str = None, reverse: bool = False) -> list[BaseMessage]:
+        """Returns one page of messages, oldest first. Page 0 is the oldest page, or the newest if reverse is True. Pages are counted over the messages with role if one is given"""
+        if page < 0 or page_size <= 0:
+            raise ValueError("page must be 0 or more and page_size must be more than 0")
+        total = self.count_messages(role)
+        start = page * page_size
+        if reverse:
+            start, end = max(total - start - page_size, 0), total - start
+        else:
+            end = start + page_size
+        if start >= end or start >= total:
+            return []
+        if role is None:
+            return self.full_chat_log[start:end]
+        if self._stores_roles:
+            # newest pages are found from the end, so they don't go through the whole history
+            if reverse:
+                positions = list(islice(self.full_chat_log.role_positions(role, reverse=True), total - end, total - start))[::-1]
+            else:
+                positions = islice(self.full_chat_log.role_positions(role), start, end)
+        else:
+            positions = self._update_role_index().get(role, [])[start:end]
+        return [self.full_chat_log[position] for position in positions]
+
+    def count_messages(self, role: str = None) -> int:
+        """Returns the number of messages in the chat log, or with the given role"""
+        if role is None:
+            return len(self.full_chat_log)
+        if self._stores_roles:
+            return self.full_chat_log.count_role(role)
+        return len(self._update_role_index().get(role, []))
+
+    def get_page_count(self, page_size: int = 20, role: str = None) -> int:
+        """Returns the number of pages get_page has for the given page size and role"""
+        return -(-self.count_messages(role) // page_size)
+
     def get_pretty_messages(self, role: str = None, limit: int = None, reverse = False) -> str:
         """Returns a string of messages from the chat log in reverse order if limit is not None"""
         result = []
         for message in self.get_messages(role, limit, reverse):
             result.append(message.pretty())
         return "\n".join(result)
+    @holds_history_lock
+    def fork(self) -> "ChatLog":
+        """Returns a copy of the chat log to take the conversation another way, without changing this one. See docs/ChatHistory.md
+        The fork shares the full chat log with this one instead of copying it, so forking takes the same time for any length of chat log. Only the window, the priorities, the wildcards and the API payload are copied.
+        The token and role indexes are worked out again when the fork first needs them, from the stored counts. Messages are only copied if one side switches to a model with another encoding, which is the only change made to a message in place, while the other side is alive (see release).
+        The fork shares this chat log's history lock, held while either side adds messages, switches model, works out its tokens or makes a save dict, so a fork can be saved from another thread"""
+        fork = copy.copy(self)
+        fork.id = str(uuid.uuid4())
+        fork.constructor_args = dict(self.constructor_args)
+        fork.token_info = dict(self.token_info)
+        fork.save_to_dict = self.SaveToDict(fork)
+        fork.save_to_file = self.SaveToFile(fork, self.save_to_file.save_folder, self.save_to_file.storage)
+        fork.full_chat_log = ForkedHistory(self.full_chat_log)
+        fork.trimmed_chat_log = self.trimmed_chat_log.copy()
+        fork._reset_token_index()
+        fork._reset_role_index()
+        fork._priorities = dict(self._priorities)
+        fork.system_prompt_wildcards = {key: dict(value) for key, value in self.system_prompt_wildcards.items()}
+        fork._sys_prompt_cache = dict(self._sys_prompt_cache) if self._sys_prompt_cache is not None else None
+        if self.retriever is not None:
+            fork.retriever = self.retriever.fork()
+        # a journal belongs to one chat log, the fork can be given its own with set_journal
+        fork.journal = None
+        fork._change_listeners = []
+        if self._sharing is None:
+            self._sharing = weakref.WeakSet([self])
+        self._sharing.add(fork)
+        fork._sharing = self._sharing
+        return fork
+
+    @property
+    def _shares_messages(self) -> bool:
+        """True if a fork, or the chat log this one was forked from, is alive and may still use the same message objects"""
+        return self._sharing is not None and len(self._sharing) > 1
+
+    def _stop_sharing(self) -> None:
+        with self._history_lock:
+            if self._sharing is not None:
+                self._sharing.discard(self)
+                self._sharing = None
+
+    def release(self) -> None:
+        """Stops counting this chat log as sharing messages with the ones it was forked from or to, so they can change their messages in place again. For a fork that won't be used any more, ie an autosave snapshot once it is written"""
+        self._stop_sharing()
+
+    def _copy_shared_messages(self) -> None:
+        """Gives the chat log its own copies of its messages, so they can be changed without changing a fork's"""
+        # original message -> copy, keyed by id with the original kept alive so the id isn't reused
+        copies = {}
+        def own(message: BaseMessage) -> BaseMessage:
+            entry = copies.get(id(message))
+            if entry is None:
+                entry = copies[id(message)] = (message, message.copy())
+            return entry[1]
+        self.full_chat_log = self._new_full_chat_log([own(message) for message in self.full_chat_log])
+        self.trimmed_chat_log.replace_messages(own)
+
+    def _new_full_chat_log(self, messages: list = None):
+        """Returns a new full_chat_log holding messages, a SpilledHistory if spill_history is on, otherwise a list. The segment file of the old one is deleted, unless a fork still uses it"""
+        old_full_chat_log = getattr(self, "full_chat_log", None)
+        if isinstance(old_full_chat_log, SpilledHistory) and not self._shares_messages:
+            old_full_chat_log.close()
+        # the new one isn't shared with anything
+        self._stop_sharing()
+        if isinstance(messages, StoredHistory):
+            return messages
+        if not self.spill_history:
+            return list(messages) if messages is not None else []
+        return SpilledHistory(
+            self.message_class,
+            model=self.model,
+            folder=self.spill_folder,
+            resident_messages=self.spill_resident_messages,
+            messages=messages,
+        )
     def reset(self, clear_sys_prompt = False):
         """Resets the chat log to its initial state"""
-        self.full_chat_log = []
-        self.trimmed_chat_log = deque()
+        self.full_chat_log = self._new_full_chat_log()
+        self.trimmed_chat_log = TrimmedWindow()
+        self._reset_role_index()
+        self._priorities = {}
         self.trimmed_messages = 0 
         self.trimmed_chat_log_tokens = 0
+        self._reset_token_index()
         if clear_sys_prompt:
             self._sys_prompt = None
         self.is_loaded = False
+        self._record("reset", clear_sys_prompt=clear_sys_prompt)
     def __str__(self):
         return self.get_pretty_messages()
     def __repr__(self):
@@ -617,53 +1437,90 @@ class ChatLog:
                 save: Prepares a dict to be saved to a file or for use in other objects/functions, returns the dict
                 load: Loads a dict into the chat log
                 _check_save_dict: Checks that the dict to be loaded is valid, raises BadSaveDictError if not valid and/or missing required keys with datatypes
+                _message_to_dict: Turns a Message into a dict for the save, including its token count if it has been counted
+                _dict_to_message: Turns a saved message dict back into a Message, keeping the saved token count if it can be trusted
+            Token counts:
+                Since version 1.1.0 each saved message includes its token count (if it had been counted), and the save includes a 'token_fingerprint' for the encoding used.
+                The counts are only used when the fingerprint matches the encoding of the loaded model, otherwise they are counted again. Version 1.0.0 saves have no counts and load as before
+            Trim policy:
+                Since version 1.3.0 the save includes the 'trim_policy' name and options, which the chat log switches to on load. Older saves keep the chat log's own policy
+            Window positions:
+                Since version 1.4.0 the save includes 'window_positions', the position in full_chat_log of each message in trimmed_chat_log, so the loaded window goes on evicting the same messages. Older saves have their window worked out again, unless it can only be the end of full_chat_log
 
             """
-            version = "1.0.0"
+            version = "1.4.0"
 
             def __init__(self, chat_log ):
                 self.chat_log = chat_log
 
-            def save(self) -> dict:
-                """Prepares a dict to be saved to a file or for use in other objects/functions"""
-                
-
-                self.chat_log.work_out_tokens()
-                save_dict = {
-                    "metadata": {
-                        "date": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-                        "length": len(self.chat_log.full_chat_log),
-                        "uuid": self.chat_log.id,
-                        "ChatLog version": self.chat_log.version,
-                        "SaveToDict version": self.version,
-
-
-                    },
-                    'max_chat_tokens': self.chat_log.max_chat_tokens,
-                    'max_chat_messages': self.chat_log.max_chat_messages,
-                    'max_model_tokens': self.chat_log.max_model_tokens,
-                    'token_padding': self.chat_log.token_padding,
-                    'max_completion_tokens': self.chat_log.max_completion_tokens,
-                    'max_chat_tokens': self.chat_log.max_chat_tokens,
-                    'full_chat_log': [message.data for message in self.chat_log.full_chat_log],
-                    'trimmed_chat_log': [message.data for message in self.chat_log.trimmed_chat_log],
-                    'trimmed_chat_log_tokens': self.chat_log.trimmed_chat_log_tokens,
-                    'trimmed_messages': self.chat_log.trimmed_messages,
-                    'sys_prompt': self.chat_log._sys_prompt,
-                    'model': self.chat_log.model,
-                    'wildcards': self.chat_log.system_prompt_wildcards,
-
-                    
-
-
-                }
-                size = len(json.dumps(save_dict))
-                save_dict['metadata']['size'] = size
-                del size
-                return save_dict
+            def save(self, sized: bool = True, start: int = 0) -> dict:
+                """Prepares a dict to be saved to a file or for use in other objects/functions
+                If sized is False metadata size is left as None, for SaveWriter to fill in as it writes the save, instead of serializing the whole save here just to measure it
+                If start is given, full_chat_log only has the messages from that position on, for a storage backend that appends them to a stored save. Everything else is the same"""
+                # a fork shares this lock with the chat log it was forked from, so that one can't change the shared messages while they are read
+                with self.chat_log._history_lock:
+                    self.chat_log.work_out_tokens()
+                    encoding_name = tokenizer_registry.encoding_name_for_model(self.chat_log.model)
+                    save_dict = {
+                        "metadata": {
+                            "date": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                            "length": len(self.chat_log.full_chat_log),
+                            "uuid": self.chat_log.id,
+                            "ChatLog version": self.chat_log.version,
+                            "SaveToDict version": self.version,
+
+
+                        },
+                        'max_chat_tokens': self.chat_log.max_chat_tokens,
+                        'max_chat_messages': self.chat_log.max_chat_messages,
+                        'max_model_tokens': self.chat_log.max_model_tokens,
+                        'token_padding': self.chat_log.token_padding,
+                        'max_completion_tokens': self.chat_log.max_completion_tokens,
+                        'max_chat_tokens': self.chat_log.max_chat_tokens,
+                        'full_chat_log': [self._message_to_dict(message, encoding_name) for message in self.chat_log.full_chat_log[start:]],
+                        'trimmed_chat_log': [self._message_to_dict(message, encoding_name) for message in self.chat_log.trimmed_chat_log],
+                        'trimmed_chat_log_tokens': self.chat_log.trimmed_chat_log_tokens,
+                        'window_positions': list(self.chat_log.trimmed_chat_log.positions()),
+                        'trimmed_messages': self.chat_log.trimmed_messages,
+                        'sys_prompt': self.chat_log._sys_prompt,
+                        'model': self.chat_log.model,
+                        'wildcards': self.chat_log.system_prompt_wildcards,
+                        'token_fingerprint': tokenizer_registry.fingerprint(self.chat_log.model),
+                        'message_priorities': [[position, priority] for position, priority in sorted(self.chat_log._priorities.items())],
+                        'trim_policy': {"name": self.chat_log.trim_policy.name, "options": self.chat_log.trim_policy.options},
+
+
+
+
+                    }
+                    save_dict['metadata']['size'] = len(json.dumps(save_dict)) if sized else None
+                    return save_dict
 
             
 
+            def _message_to_dict(self, message: Message, encoding_name: str) -> dict:
+                """Turns a message into a dict for the save. The token count is only included if it has already been counted, with the chat log's encoding"""
+                message_dict = dict(message.data)
+                if message._tokens is not None and tokenizer_registry.encoding_name_for_model(message.model) == encoding_name:
+                    message_dict["tokens"] = message._tokens
+                return message_dict
+
+            def _dict_to_message(self, message_dict: dict, trust_tokens: bool) -> Message:
+                """Turns a saved message dict back into a Message, keeping the saved token count if trust_tokens is True"""
+                message = self.chat_log.make_message(role=message_dict["role"], content=message_dict["content"])
+                if trust_tokens and isinstance(message_dict.get("tokens"), int):
+                    message.tokens = message_dict["tokens"]
+                return message
+
+            def stored_message_maker(self, fingerprint: str = None) -> Callable[[dict], Message]:
+                """Returns a function that makes a message from a stored message dict, for a StoredHistory. Saved token counts are kept while the chat log's model uses the encoding with fingerprint, the chat log's own encoding by default"""
+                if fingerprint is None:
+                    fingerprint = tokenizer_registry.fingerprint(self.chat_log.model)
+
+                def make_message(message_dict: dict) -> Message:
+                    return self._dict_to_message(message_dict, fingerprint == tokenizer_registry.fingerprint(self.chat_log.model))
+                return make_message
+
             def _check_save_dict(self, save_dict: dict):
                 """Checks that the save dict is valid, raises BadSaveDictError if not"""
                 required_keys = {
@@ -675,11 +1532,15 @@ class ChatLog:
                     "model": str,
                     "sys_prompt": str,
                     "wildcards": dict,
-                    "full_chat_log": list,
+                    "full_chat_log": (list, StoredHistory),
                     "trimmed_chat_log": list,
                     "trimmed_chat_log_tokens": int,
                     "trimmed_messages": int,
                 }
+                # optional keys added by later versions
+                optional_keys = {
+                    "window_positions": list,
+                }
                 if not isinstance(save_dict, dict):
                     raise BadSaveDictError(
                         "Save dict must be a dict, got {}".format(type(save_dict))
@@ -696,12 +1557,35 @@ class ChatLog:
                                 key, datatype, type(save_dict[key])
                             )
                         )
+                for key, datatype in optional_keys.items():
+                    if key in save_dict and not isinstance(save_dict[key], datatype):
+                        raise BadSaveDictError(
+                            "Save dict key {} must be of type {}, got {}".format(
+                                key, datatype, type(save_dict[key])
+                            )
+                        )
+                if "window_positions" in save_dict and len(save_dict["window_positions"]) != len(save_dict["trimmed_chat_log"]):
+                    raise BadSaveDictError("Save dict window_positions must have a position for each message in trimmed_chat_log")
                 
 
             def load(self, save_dict: dict) -> None:
-                """Loads a save_dict into the chat log, by setting the chat log attributes from the save dict"""
+                """Loads a save_dict into the chat log, by setting the chat log attributes from the save dict. A journal is given a new snapshot instead of a record per attribute, and the change listeners are told once"""
+                journal, self.chat_log.journal = self.chat_log.journal, None
+                listeners, self.chat_log._change_listeners = self.chat_log._change_listeners, []
+                try:
+                    self._load(save_dict)
+                finally:
+                    self.chat_log.journal = journal
+                    self.chat_log._change_listeners = listeners
+                if journal is not None:
+                    journal.snapshot()
+                self.chat_log._notify_change(0)
+
+            def _load(self, save_dict: dict) -> None:
                 self._check_save_dict(save_dict)
                 model = save_dict["model"]
+                # the old messages are dropped first, so a change of model doesn't recount them
+                self.chat_log.reset()
                 self.chat_log.id = save_dict["metadata"]["uuid"]
                 self.chat_log.model = model
                 self.chat_log.max_chat_tokens = save_dict["max_chat_tokens"]
@@ -712,16 +1596,52 @@ class ChatLog:
                 self.chat_log.model = save_dict["model"]
                 self.chat_log.sys_prompt = save_dict["sys_prompt"]
                 self.chat_log.system_prompt_wildcards = save_dict["wildcards"]
-                self.chat_log.full_chat_log = [ self.chat_log.make_message(message = msg ) for msg in save_dict["full_chat_log"] ]
-                self.chat_log.trimmed_chat_log = deque([ self.chat_log.make_message(message = msg ) for msg in save_dict["trimmed_chat_log"]])
-                self.chat_log.trimmed_chat_log_tokens = save_dict["trimmed_chat_log_tokens"]
+                # saves from before 1.3.0 have no trim policy, so the chat log's own is kept
+                trim_policy = save_dict.get("trim_policy")
+                if trim_policy is not None:
+                    self.chat_log.set_trim_policy(trim_policy["name"], trim_policy.get("options") or None)
+                # saves from before 1.1.0 have no fingerprint, so there are no counts to trust, and the saved trimmed_chat_log_tokens is used as before
+                fingerprint = save_dict.get("token_fingerprint")
+                trust_tokens = fingerprint is not None and fingerprint == tokenizer_registry.fingerprint(model)
+                if isinstance(save_dict["full_chat_log"], StoredHistory):
+                    # only the window is read now, the rest of the history when it is needed
+                    make_message = self.stored_message_maker(fingerprint) if fingerprint is not None else (lambda message_dict: self._dict_to_message(message_dict, False))
+                    full_chat_log = save_dict["full_chat_log"].bind(make_message)
+                else:
+                    full_chat_log = [self._dict_to_message(msg, trust_tokens) for msg in save_dict["full_chat_log"]]
+                self.chat_log.full_chat_log = self.chat_log._new_full_chat_log(full_chat_log)
+                self.chat_log._reset_token_index()
+                self.chat_log._reset_role_index()
+                # saves from before 1.2.0 have no priorities
+                self.chat_log._priorities = {position: priority for position, priority in save_dict.get("message_priorities", [])}
+                window = [self._dict_to_message(msg, trust_tokens) for msg in save_dict["trimmed_chat_log"]]
+                positions = save_dict.get("window_positions")
+                # saves from before 1.4.0 have no positions, the window can only be the end of full_chat_log if nothing was kept out of order
+                legacy_window = positions is None
+                if legacy_window:
+                    positions = range(len(full_chat_log) - len(window), len(full_chat_log))
+                self.chat_log._set_window(positions, window)
+                if fingerprint is None or trust_tokens:
+                    # saves from before 1.1.0 have no counts, so the saved total is used as before
+                    self.chat_log.trimmed_chat_log_tokens = save_dict["trimmed_chat_log_tokens"]
                 self.chat_log.trimmed_messages = save_dict["trimmed_messages"]
                 self.chat_log.is_loaded = True
                 self.chat_log.work_out_tokens()
+                if legacy_window and (self.chat_log._priorities or not isinstance(self.chat_log.trim_policy, FifoPolicy)):
+                    self.chat_log.rebuild_trimmed_chat_log()
+                elif fingerprint is not None and not trust_tokens:
+                    # the encoding changed since the save was made, so the window may not fit any more
+                    self.chat_log.trim_chat_log()
+
+@functools.lru_cache(maxsize=32)
+def _compile_wildcard_pattern(keys: tuple) -> re.Pattern:
+    """Compiles a regex matching {key} for any of the given wildcard names, cached since the wildcards rarely change"""
+    # longest first, so a name that starts with another name still matches in full
+    alternatives = "|".join(re.escape(key) for key in sorted(keys, key=len, reverse=True))
+    return re.compile(r"\{(" + alternatives + r")\}")
 
 def count_tokens(str, model):
-    encoding = tiktoken.encoding_for_model(model)
-    return len(encoding.encode(str))
+    return tokenizer_registry.count_tokens(str, model)
 
 def get_test_chat_log(name = "random_10000"):
     if not name.endswith(".json"):
@@ -752,6 +1672,141 @@ class TestChatLog(unittest.TestCase):
         self.assertEqual(self.chat_log.sys_prompt, "You are a helpful AI assistant")
 
     
+    def test_sys_prompt_cache(self):
+        """Tests that the expanded system prompt is reused until the prompt, wildcards or model change"""
+        self.chat_log.sys_prompt = "You are running on {model} and the date is {date}"
+        first = self.chat_log._expand_sys_prompt()
+        self.assertIs(self.chat_log._expand_sys_prompt(), first)
+        self.assertIsNotNone(first["tokens"])
+        self.assertIn("gpt-4", self.chat_log.sys_prompt)
+        self.chat_log.add_more_wildcards({"persona": {"value": "Bob", "description": "The name of the assistant"}})
+        self.assertIsNot(self.chat_log._expand_sys_prompt(), first)
+        self.chat_log.model = "gpt-3.5-turbo"
+        self.assertIn("gpt-3.5-turbo", self.chat_log.sys_prompt)
+        del self.chat_log.system_prompt_wildcards["persona"]
+    def test_sys_prompt_cache_date(self):
+        """Tests that a prompt using the date is expanded again once the shown date moves on"""
+        self.chat_log.sys_prompt = "The date is {date}"
+        cache = self.chat_log._expand_sys_prompt()
+        cache["date"] = "a second ago"
+        self.assertEqual(self.chat_log.sys_prompt, "The date is " + cache["date"])
+        self.assertIsNone(cache["tokens"])
+        self.chat_log.sys_prompt = "No wildcards here"
+        self.assertIsNone(self.chat_log._expand_sys_prompt()["date"])
+    def test_sys_prompt_segments(self):
+        """Tests that only the date segments are counted again when the date moves on"""
+        persona = "You are a helpful assistant running on {model}. " * 200
+        self.chat_log.sys_prompt = persona + "The date is {date}. " + persona
+        expansion = self.chat_log._expand_sys_prompt()
+        self.assertEqual([is_dynamic for _, is_dynamic in expansion["segments"]], [False, True, False])
+        static_tokens = expansion["static_tokens"]
+        whole_tokens = count_tokens(expansion["expanded"], "gpt-4")
+        self.assertGreaterEqual(self.chat_log.sys_prompt_tokens, whole_tokens)
+        self.assertLessEqual(self.chat_log.sys_prompt_tokens, whole_tokens + 2)
+        expansion["date"] = "a second ago"
+        self.chat_log.work_out_tokens()
+        self.assertIs(self.chat_log._expand_sys_prompt(), expansion)
+        self.assertEqual(expansion["static_tokens"], static_tokens)
+        self.assertEqual(self.chat_log.sys_prompt_tokens, static_tokens + count_tokens(expansion["date"], "gpt-4"))
+    def test_sys_prompt_wildcards(self):
+        """Tests that only known {name} wildcards are replaced, in one pass and past the first 4K characters"""
+        self.chat_log.add_more_wildcards({"persona": {"value": "Bob {model}", "description": "The name of the assistant"}})
+        self.chat_log.sys_prompt = "model {model} {persona} {unknown} {" + "x" * 5000 + " {model}"
+        self.assertEqual(self.chat_log.sys_prompt, "model gpt-4 Bob {model} {unknown} {" + "x" * 5000 + " gpt-4")
+        self.chat_log.sys_prompt = "{date}"
+        self.assertEqual(self.chat_log.sys_prompt, self.chat_log._expand_sys_prompt()["date"])
+        del self.chat_log.system_prompt_wildcards["persona"]
+    def test_lazy_tokens(self):
+        """Tests that tokens are only counted when accessed, and that loading does not count the full chat log"""
+        message = Message(role="user", content="Hello, how are you?")
+        self.assertIsNone(message._tokens)
+        self.assertEqual(message.tokens, count_tokens("Hello, how are you?", message.model))
+        self.assertEqual(message._tokens, message.tokens)
+        test_log = get_test_chat_log(name="short_2000_messages.json")
+        self.chat_log.add_message_list(test_log)
+        save_dict = self.chat_log.make_save_dict()
+        # a save without token counts, as made before version 1.1.0
+        del save_dict["token_fingerprint"]
+        for msg in save_dict["full_chat_log"] + save_dict["trimmed_chat_log"]:
+            msg.pop("tokens", None)
+        loaded_chat_log = ChatLog()
+        loaded_chat_log.load_save_dict(save_dict)
+        self.assertTrue(all(message._tokens is None for message in loaded_chat_log.full_chat_log))
+        self.assertEqual(loaded_chat_log.trimmed_chat_log_tokens, self.chat_log.trimmed_chat_log_tokens)
+
+    def test_saved_token_counts(self):
+        """Tests that saved token counts are used when the fingerprint matches, and counted again when it doesn't"""
+        test_log = get_test_chat_log(name="random_10000.json")
+        self.chat_log.add_message_list(test_log)
+        save_dict = self.chat_log.make_save_dict()
+        self.assertEqual(save_dict["token_fingerprint"], tokenizer_registry.fingerprint(self.chat_log.model))
+        self.assertEqual(
+            [msg["tokens"] for msg in save_dict["full_chat_log"]],
+            [message.tokens for message in self.chat_log.full_chat_log],
+        )
+        loaded_chat_log = ChatLog()
+        for msg in save_dict["full_chat_log"]:
+            msg["tokens"] = 1
+        loaded_chat_log.load_save_dict(save_dict)
+        self.assertTrue(all(message.tokens == 1 for message in loaded_chat_log.full_chat_log))
+        save_dict["token_fingerprint"] = "some_other_encoding:1"
+        loaded_chat_log.load_save_dict(save_dict)
+        self.assertEqual(
+            [message.tokens for message in loaded_chat_log.full_chat_log],
+            [message.tokens for message in self.chat_log.full_chat_log],
+        )
+        self.assertEqual(loaded_chat_log.trimmed_chat_log_tokens, self.chat_log.trimmed_chat_log_tokens)
+
+    def test_bulk_add_message_list(self):
+        """Tests that adding a list in bulk gives the same chat log as adding the messages one at a time"""
+        serial_chat_log = ChatLog(8000, 1000, 500)
+        serial_chat_log.sys_prompt = self.test_sysprompt
+        for name, max_chat_messages in (("random_10000.json", 200), ("short_2000_messages.json", 100), ("short_10000.json", None)):
+            with self.subTest(name=name):
+                test_log = get_test_chat_log(name=name)
+                for chat_log in (self.chat_log, serial_chat_log):
+                    chat_log.reset()
+                    chat_log.max_chat_messages = max_chat_messages
+                self.chat_log.add_message_list(test_log[:10])
+                serial_chat_log.add_message_list(test_log[:10], bulk=False)
+                self.chat_log.add_message_list(test_log[10:])
+                serial_chat_log.add_message_list(test_log[10:], bulk=False)
+                self.assertEqual(self.chat_log.trimmed_chat_log, serial_chat_log.trimmed_chat_log)
+                self.assertEqual(self.chat_log.trimmed_chat_log_tokens, serial_chat_log.trimmed_chat_log_tokens)
+                self.assertEqual(self.chat_log.trimmed_messages, serial_chat_log.trimmed_messages)
+                self.assertEqual(
+                    [message.tokens for message in self.chat_log.full_chat_log],
+                    [message.tokens for message in serial_chat_log.full_chat_log],
+                )
+
+    def test_compact_message(self):
+        """Tests that CompactMessage behaves like Message"""
+        message = Message(role="assistant", content="Hello, how are you?")
+        compact = CompactMessage(role="assistant", content="Hello, how are you?")
+        self.assertEqual(dict(compact), {"role": "assistant", "content": "Hello, how are you?"})
+        self.assertEqual(dict(compact), dict(message))
+        self.assertEqual(compact, message)
+        self.assertEqual(compact.data, message.data)
+        self.assertEqual(compact.pretty(), message.pretty())
+        self.assertEqual(compact.tokens, message.tokens)
+        self.assertFalse(hasattr(compact, "__dict__"))
+
+    def test_compact_chat_log(self):
+        """Tests that a chat log using CompactMessage trims the same way, and works with get_messages_as_list"""
+        compact_chat_log = ChatLog(8000, 1000, 500, compact_messages=True)
+        compact_chat_log.sys_prompt = self.test_sysprompt
+        test_log = get_test_chat_log(name="random_10000.json")
+        compact_chat_log.add_message_list(test_log)
+        self.chat_log.add_message_list(test_log)
+        self.assertIsInstance(compact_chat_log.full_chat_log[0], CompactMessage)
+        self.assertEqual(compact_chat_log.get_finished_chat_log()[1:], self.chat_log.get_finished_chat_log()[1:])
+        for format in ("Message", "dict", "str", "pretty"):
+            with self.subTest(format=format):
+                self.assertEqual(
+                    compact_chat_log.get_messages_as_list(limit=5, format=format),
+                    self.chat_log.get_messages_as_list(limit=5, format=format),
+                )
+
     def test_add_message(self):
         message = Message(
             content="Hello, how are you?",
@@ -774,9 +1829,105 @@ class TestChatLog(unittest.TestCase):
         self.assertTrue(
             finished_token_count <= self.chat_log.token_info["max_model_tokens"]
         )
+    def test_finished_chat_log_in_step(self):
+        """Tests that the kept up to date payload matches the trimmed chat log after adds, trims, budget changes and a reset"""
+        def expected():
+            return [{"role": "system", "content": self.chat_log.sys_prompt}] + [dict(message) for message in self.chat_log.trimmed_chat_log]
+        test_log = get_test_chat_log(name="short_2000_messages.json")
+        self.chat_log.add_message_list(test_log[:500])
+        self.assertEqual(self.chat_log.get_finished_chat_log(), expected())
+        for message in test_log[500:520]:
+            self.chat_log.add_message(message=message)
+        self.assertEqual(self.chat_log.get_finished_chat_log(), expected())
+        self.chat_log.max_model_tokens = 4000
+        self.assertEqual(self.chat_log.get_finished_chat_log(), expected())
+        self.chat_log.max_model_tokens = 12000
+        self.assertEqual(self.chat_log.get_finished_chat_log(), expected())
+        self.chat_log.reset()
+        self.assertEqual(self.chat_log.get_finished_chat_log(), expected())
     def test_user_message(self):
         self.chat_log.user_message = "Hello, how are you?"
         self.assertEqual(self.chat_log.user_message.content, "Hello, how are you?")
+    def test_last_message_index(self):
+        """Tests that the role index finds the same messages as scanning the whole chat log, and is rebuilt on reset and load"""
+        self.assertIsNone(self.chat_log.user_message)
+        test_log = get_test_chat_log(name="random_10000.json")
+        self.chat_log.add_message_list(test_log)
+        self.chat_log.add_message("user", "last one")
+        self.assertEqual(self.chat_log.user_message.content, "last one")
+        last_assistant = [message for message in test_log if message["role"] == "assistant"][-1]
+        self.assertEqual(dict(self.chat_log.assistant_message), last_assistant)
+        for reverse in [True, False]:
+            with self.subTest(reverse=reverse):
+                scanned = [message for message in self.chat_log.full_chat_log if message.role == "assistant"]
+                if reverse:
+                    scanned.reverse()
+                self.assertEqual(list(self.chat_log.get_messages(role="assistant", limit=5, reverse=reverse)), scanned[:5])
+        save_dict = self.chat_log.make_save_dict()
+        self.chat_log.reset()
+        self.assertIsNone(self.chat_log.assistant_message)
+        self.chat_log.load_save_dict(save_dict)
+        self.assertEqual(self.chat_log.user_message.content, "last one")
+    def test_range_queries(self):
+        """Tests the range queries against slicing and filtering the full chat log"""
+        self.chat_log.max_chat_messages = 50
+        self.chat_log.add_message_list(get_test_chat_log(name="random_10000.json"))
+        full = self.chat_log.full_chat_log
+        self.assertEqual(self.chat_log.get_message_range(5, 20), full[5:20])
+        self.assertEqual(self.chat_log.get_message_range(-10), full[-10:])
+        self.assertEqual(
+            self.chat_log.get_message_range(3, 40, role="user"),
+            [message for message in full[3:40] if message.role == "user"],
+        )
+        self.assertEqual(self.chat_log.get_window_messages(), list(self.chat_log.trimmed_chat_log))
+        self.assertEqual(self.chat_log.get_window_messages(-3, role="assistant"), [message for message in list(self.chat_log.trimmed_chat_log)[-3:] if message.role == "assistant"])
+        self.chat_log.add_message("user", "first")
+        self.chat_log.add_message("assistant", "reply")
+        self.chat_log.add_message("user", "second")
+        self.assertEqual([message.content for message in self.chat_log.get_last_turns(2)], ["first", "reply", "second"])
+        self.assertEqual([message.content for message in self.chat_log.get_last_turns(2, role="assistant")], ["reply"])
+        pages = [self.chat_log.get_page(page, 7) for page in range(self.chat_log.get_page_count(7))]
+        self.assertEqual([message for page in pages for message in page], full)
+        self.assertEqual(self.chat_log.get_page(0, 7, reverse=True), full[-7:])
+        user_messages = [message for message in full if message.role == "user"]
+        self.assertEqual(self.chat_log.get_page(1, 4, role="user"), user_messages[4:8])
+        self.assertEqual(self.chat_log.get_page(10 ** 6, 7), [])
+    def test_pinned_messages(self):
+        """Tests that a pinned message outlives newer messages, and the window stays in order and in budget"""
+        self.chat_log.add_message("user", "A spec that must not be forgotten")
+        self.chat_log.pin_message()
+        self.chat_log.add_message_list(get_test_chat_log(name="random_10000.json"))
+        self.assertEqual(self.chat_log.get_pinned_positions(), [0])
+        self.assertIs(self.chat_log.trimmed_chat_log[0], self.chat_log.full_chat_log[0])
+        self.assertLessEqual(self.chat_log.trimmed_chat_log_tokens, self.chat_log.max_chat_tokens)
+        self.assertEqual(self.chat_log.get_finished_chat_log()[1]["content"], "A spec that must not be forgotten")
+        self.assertEqual(self.chat_log.trimmed_messages, len(self.chat_log.full_chat_log) - len(self.chat_log.trimmed_chat_log))
+        loaded_chat_log = ChatLog()
+        loaded_chat_log.load_save_dict(self.chat_log.make_save_dict())
+        self.assertEqual(loaded_chat_log.get_pinned_positions(), [0])
+        self.chat_log.unpin_message(0)
+        self.assertIsNot(self.chat_log.trimmed_chat_log[0], self.chat_log.full_chat_log[0])
+    def test_message_priorities(self):
+        """Tests the prioritized window against evicting one message at a time, lowest priority and oldest first"""
+        random_generator = random.Random(7)
+        test_log = get_test_chat_log(name="random_10000.json")
+        self.chat_log.add_message_list(test_log)
+        length = len(self.chat_log.full_chat_log)
+        for position in random_generator.sample(range(length), 15):
+            self.chat_log._priorities[position] = random_generator.choice([-2, -1, 1, 3, ChatLog.PINNED_PRIORITY])
+        for max_model_tokens, max_chat_messages in [(8000, 200), (4000, 200), (3000, 10), (30000, None)]:
+            with self.subTest(max_model_tokens=max_model_tokens, max_chat_messages=max_chat_messages):
+                self.chat_log.max_chat_messages = max_chat_messages
+                self.chat_log.max_model_tokens = max_model_tokens
+                self.chat_log.rebuild_trimmed_chat_log()
+                eviction_order = sorted(range(length), key=lambda position: (self.chat_log.get_message_priority(position), position))
+                kept = list(eviction_order)
+                while kept and (
+                    sum(self.chat_log.full_chat_log[position].tokens for position in kept) > self.chat_log.max_chat_tokens
+                    or (max_chat_messages is not None and len(kept) > max_chat_messages)
+                ):
+                    kept.pop(0)
+                self.assertEqual(list(self.chat_log.trimmed_chat_log), [self.chat_log.full_chat_log[position] for position in sorted(kept)])
     def test_assistant_message(self):
         self.chat_log.assistant_message = "Hello, how are you?"
         self.assertEqual(self.chat_log.assistant_message.content, "Hello, how are you?")
@@ -855,12 +2006,141 @@ class TestChatLog(unittest.TestCase):
                     self.chat_log.add_message_list(short_1000_test_log)
                     self.assertLessEqual(self.chat_log.trimmed_chat_log_tokens, case)
                     self.chat_log.reset()
+    def test_budget_grows(self):
+        """Tests that raising the token or message budget brings evicted messages back, the same as adding them under the bigger budget"""
+        test_log = get_test_chat_log(name="short_2000_messages.json")
+        self.chat_log.max_model_tokens = 3000
+        self.chat_log.add_message_list(test_log)
+        small_window = len(self.chat_log.trimmed_chat_log)
+        self.chat_log.max_model_tokens = 8000
+        self.assertGreater(len(self.chat_log.trimmed_chat_log), small_window)
+        fresh_chat_log = ChatLog(max_model_tokens=8000)
+        fresh_chat_log.sys_prompt = self.chat_log._sys_prompt
+        fresh_chat_log.add_message_list(test_log)
+        self.assertEqual(list(self.chat_log.trimmed_chat_log), list(fresh_chat_log.trimmed_chat_log))
+        self.assertEqual(self.chat_log.trimmed_chat_log_tokens, fresh_chat_log.trimmed_chat_log_tokens)
+        self.assertEqual(self.chat_log.trimmed_messages, fresh_chat_log.trimmed_messages)
+        self.chat_log.max_chat_messages = 10
+        self.assertEqual(len(self.chat_log.trimmed_chat_log), 10)
+        self.chat_log.max_chat_messages = 200
+        self.assertEqual(list(self.chat_log.trimmed_chat_log), list(fresh_chat_log.trimmed_chat_log))
+    def test_find_window_start(self):
+        """Tests that the binary search agrees with trimming one message at a time"""
+        self.chat_log.max_chat_messages = None
+        self.chat_log.add_message_list(get_test_chat_log(name="short_2000_messages.json"))
+        for budget in [0, 1, 50, 777, 5000, 10 ** 9]:
+            with self.subTest(budget=budget):
+                start = 0
+                total = sum(message.tokens for message in self.chat_log.full_chat_log)
+                while start < len(self.chat_log.full_chat_log) and total > budget:
+                    total -= self.chat_log.full_chat_log[start].tokens
+                    start += 1
+                self.assertEqual(self.chat_log.find_window_start(max_chat_tokens=budget), start)
+    def test_token_index_from_the_end(self):
+        """Tests that the token index is built back from the end only as far as the window needs, so a loaded chat log's older messages aren't counted"""
+        self.chat_log.add_message_list(get_test_chat_log(name="short_2000_messages.json"))
+        save_dict = self.chat_log.make_save_dict()
+        for msg in save_dict["full_chat_log"]:
+            msg.pop("tokens", None)
+        loaded_chat_log = ChatLog()
+        loaded_chat_log.load_save_dict(save_dict)
+        loaded_chat_log.max_model_tokens = 12000
+        self.chat_log.max_model_tokens = 12000
+        self.assertEqual(list(loaded_chat_log.trimmed_chat_log), list(self.chat_log.trimmed_chat_log))
+        self.assertEqual(loaded_chat_log.trimmed_chat_log_tokens, self.chat_log.trimmed_chat_log_tokens)
+        counted = sum(message._tokens is not None for message in loaded_chat_log.full_chat_log)
+        self.assertLessEqual(counted, 2 * len(loaded_chat_log.trimmed_chat_log) + 64)
+        self.assertGreater(loaded_chat_log._token_index_start, 0)
+        self.assertEqual(loaded_chat_log.count_window_tokens(0, 10), sum(message.tokens for message in self.chat_log.full_chat_log[:10]))
+    def test_fork(self):
+        """Tests that a fork shares the parent's messages, and that neither side's changes show up in the other"""
+        self.chat_log.add_message_list(long_1000_test_log)
+        self.chat_log.pin_message(0)
+        fork = self.chat_log.fork()
+        self.assertIs(fork.full_chat_log.base, self.chat_log.full_chat_log)
+        self.assertEqual(fork.get_finished_chat_log(), self.chat_log.get_finished_chat_log())
+        fork.add_message("user", "only in the fork")
+        fork.unpin_message(0)
+        self.chat_log.add_message("user", "only in the parent")
+        self.assertEqual(len(fork.full_chat_log), len(self.chat_log.full_chat_log))
+        self.assertEqual(fork.full_chat_log[-1].content, "only in the fork")
+        self.assertEqual(fork.get_messages_as_list(format="str")[0], "only in the fork")
+        self.assertEqual(self.chat_log.get_pinned_positions(), [0])
+        self.assertEqual(fork.get_pinned_positions(), [])
+        self.assertEqual(fork.get_finished_chat_log()[-1]["content"], "only in the fork")
+        self.assertEqual(self.chat_log.get_finished_chat_log()[-1]["content"], "only in the parent")
+        # a fork of a fork that hasn't added anything shares the same base
+        self.assertIs(fork.fork().fork().full_chat_log.base, fork.full_chat_log)
+    def test_fork_wildcards(self):
+        """Tests that a wildcard added to a fork of a loaded chat log doesn't change the parent's system prompt"""
+        self.chat_log.sys_prompt = "hi {fork_name}"
+        self.chat_log.add_message("user", "Hello")
+        loaded = ChatLog()
+        loaded.load_save_dict(self.chat_log.make_save_dict())
+        fork = loaded.fork()
+        fork.add_more_wildcards({"fork_name": {"value": "fork", "description": "Only in the fork"}})
+        self.assertEqual(fork.get_finished_chat_log()[0]["content"], "hi fork")
+        self.assertEqual(loaded.get_finished_chat_log()[0]["content"], "hi {fork_name}")
+        self.assertNotIn("fork_name", loaded.system_prompt_wildcards)
+    def test_fork_switch_encoding(self):
+        """Tests that switching a fork to another encoding copies the messages, so the parent's counts don't change"""
+        self.add_test_bytes_model()
+        for i in range(10):
+            self.chat_log.add_message("user", f"question number {i}")
+        fork = self.chat_log.fork()
+        tokens = self.chat_log.trimmed_chat_log_tokens
+        fork.model = "test-bytes-model"
+        self.assertEqual(fork.trimmed_chat_log_tokens, sum(len(message.content) for message in fork.trimmed_chat_log))
+        self.assertEqual(self.chat_log.full_chat_log[0].model, "gpt-4")
+        self.assertEqual(self.chat_log.trimmed_chat_log_tokens, tokens)
+        self.assertEqual(sum(message.tokens for message in self.chat_log.trimmed_chat_log), tokens)
     def test_max_model_tokens_setter(self):
         with self.assertRaises(TypeError):
             self.chat_log.max_model_tokens = "hello"
     def test_token_padding_setter_error(self):
         with self.assertRaises(TypeError):
             self.chat_log.token_padding = "hello"
+    def add_test_bytes_model(self):
+        """Adds a model called test-bytes-model, with a byte level encoding so the counts differ from cl100k_base without downloading another encoding"""
+        import tiktoken
+        encoding = tiktoken.Encoding(
+            name="test_bytes", pat_str=r"\S+|\s+", mergeable_ranks={bytes([i]): i for i in range(256)}, special_tokens={"<|endoftext|>": 256}
+        )
+        tiktoken.registry.ENCODINGS["test_bytes"] = encoding
+        self.addCleanup(tiktoken.registry.ENCODINGS.pop, "test_bytes", None)
+        tokenizer_registry.add_alias("test-bytes-model", "test_bytes")
+        self.addCleanup(tokenizer_registry.aliases.pop, "test-bytes-model", None)
+        self.addCleanup(tokenizer_registry._encodings.pop, "test-bytes-model", None)
+    def test_model_switch_same_encoding(self):
+        """Tests that switching to a model with the same encoding keeps every count"""
+        self.chat_log.add_message_list(long_1000_test_log)
+        window = list(self.chat_log.trimmed_chat_log)
+        tokens = self.chat_log.trimmed_chat_log_tokens
+        self.chat_log.model = "gpt-3.5-turbo"
+        self.assertEqual(list(self.chat_log.trimmed_chat_log), window)
+        self.assertEqual(self.chat_log.trimmed_chat_log_tokens, tokens)
+        self.assertIsNone(self.chat_log.full_chat_log[-1]._encoding_tokens)
+    def test_model_switch_other_encoding(self):
+        """Tests that switching encodings recounts the window once, and switching back reuses the old counts"""
+        from unittest import mock
+        self.add_test_bytes_model()
+        for i in range(30):
+            self.chat_log.add_message("user", f"question number {i}")
+            self.chat_log.add_message("assistant", f"answer number {i}")
+        tokens = self.chat_log.trimmed_chat_log_tokens
+        first = self.chat_log.full_chat_log[0]
+        self.chat_log.model = "test-bytes-model"
+        self.assertEqual(self.chat_log.trimmed_chat_log[-1].tokens, len("answer number 29"))
+        self.assertEqual(self.chat_log.trimmed_chat_log_tokens, sum(len(message.content) for message in self.chat_log.trimmed_chat_log))
+        self.assertLessEqual(self.chat_log.trimmed_chat_log_tokens, self.chat_log.max_chat_tokens)
+        # messages outside the window aren't counted until needed
+        self.assertEqual(first.model, "test-bytes-model")
+        with mock.patch.object(tokenizer_registry, "count_tokens_batch", wraps=tokenizer_registry.count_tokens_batch) as batch:
+            self.chat_log.model = "gpt-4"
+            self.chat_log.model = "test-bytes-model"
+            self.chat_log.model = "gpt-4"
+        batch.assert_not_called()
+        self.assertEqual(self.chat_log.trimmed_chat_log_tokens, tokens)
     
         
                 
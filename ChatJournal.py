@@ -0,0 +1,220 @@
+import json
+import os
+import uuid
+from typing import Callable, Optional
+
+from SaveWriter import write_save
+
+
+class BadJournalError(Exception):
+    """Raised when a journal or its snapshot can't be replayed"""
+    pass
+
+
+class ChatJournal:
+    """
+    Saves a ChatLog incrementally, as an append-only JSONL journal of its changes plus a snapshot that is rewritten every so often
+    Each added message, parameter change, system prompt change, wildcard change, priority change (pins included), trim policy change and reset is appended to the journal as one typed JSON line, so saving a turn costs the same however long the chat log is.
+    After snapshot_every records the whole chat log is written to the snapshot (with SaveToDict) and the journal starts again, so loading replays the snapshot plus a short tail
+    Files:
+        <folder>/<name>.snapshot: JSON, {"journal_id": str, "chat_log": save dict, "extra": dict or None}, replaced atomically. It doesn't end in .json so the load menus don't list it as a save
+        <folder>/<name>.journal.jsonl: A header line {"op": "header", "journal_id": str}, then one record per line
+    A journal is only replayed on top of the snapshot with the same journal_id, so a crash while a snapshot is being taken never applies a record twice. A half written last line is dropped
+    Attributes:
+        folder (str), name (str): Where the files are
+        snapshot_every (int): Number of records after which a snapshot is taken
+        fsync (bool): If True each record is fsynced, otherwise it is only flushed to the OS
+        extra_state (callable): Optional, returns a JSON-able dict stored with the chat log, such as a ChatWrapper's GPTChat settings. It is checked after each message and when record_extra is called, and recorded when it changes
+        restore_extra_state (callable): Optional, called with the extra state after the chat log is loaded
+        extra (dict): The last extra state that was loaded or recorded
+        records (int): Records in the journal since the last snapshot
+    Methods:
+        exists() -> bool: Returns True if there is a snapshot to load
+        open(chat_log): Loads the chat log from the files if they exist, otherwise takes a first snapshot, then records the chat log's changes
+        record(op: str, **fields), record_messages(messages): Called by ChatLog to append records
+        record_extra(): Appends the extra state if it changed, called by ChatWrapper when its GPTChat settings change
+        snapshot(): Writes the snapshot and starts a new journal
+        close(): Closes the journal file and stops recording
+    Example Usage:
+        journal = ChatJournal("chat_log_saves", "my_session")
+        chat_log.set_journal(journal)  # loads my_session if it exists
+        chat_log.add_message("user", "Hello")  # appends one line to my_session.journal.jsonl
+    """
+
+    # parameters that are recorded, and set again with setattr when replayed
+    params = frozenset({"max_model_tokens", "max_completion_tokens", "token_padding", "max_chat_messages", "model"})
+
+    def __init__(
+        self,
+        folder: str,
+        name: str,
+        snapshot_every: int = 1000,
+        fsync: bool = False,
+        extra_state: Callable[[], dict] = None,
+        restore_extra_state: Callable[[dict], None] = None,
+    ):
+        if snapshot_every < 1:
+            raise ValueError("snapshot_every must be at least 1")
+        self.folder = folder
+        self.name = name
+        self.snapshot_every = snapshot_every
+        self.fsync = fsync
+        self.extra_state = extra_state
+        self.restore_extra_state = restore_extra_state
+        self.extra: Optional[dict] = None
+        self.records = 0
+        self.chat_log = None
+        self._file = None
+        self._journal_id = None
+
+    @property
+    def snapshot_path(self) -> str:
+        return os.path.join(self.folder, f"{self.name}.snapshot")
+
+    @property
+    def journal_path(self) -> str:
+        return os.path.join(self.folder, f"{self.name}.journal.jsonl")
+
+    def exists(self) -> bool:
+        return os.path.exists(self.snapshot_path)
+
+    def open(self, chat_log) -> None:
+        """Loads chat_log from the snapshot and the journal if they exist, otherwise takes a first snapshot of it. Its changes are recorded from then on"""
+        self.close()
+        chat_log.journal = None
+        self.chat_log = chat_log
+        if self.exists():
+            self._replay()
+        self.snapshot()
+        chat_log.journal = self
+
+    # recording
+
+    def _write(self, record: dict) -> None:
+        self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._file.flush()
+        if self.fsync:
+            os.fsync(self._file.fileno())
+        self.records += 1
+
+    def record(self, op: str, **fields) -> None:
+        """Appends one record, and takes a snapshot if there have been snapshot_every records since the last one"""
+        if self._file is None:
+            return
+        self._write({"op": op, **fields})
+        if self.records >= self.snapshot_every:
+            self.snapshot()
+
+    def record_messages(self, messages: list) -> None:
+        """Appends a record for each message, with its token count so it isn't counted again when replayed"""
+        if self._file is None:
+            return
+        for message in messages:
+            self._write({"op": "message", "role": message.role, "content": message.content, "tokens": message._tokens})
+        self.record_extra()
+
+    def record_extra(self) -> None:
+        """Appends the extra state if it changed since it was last recorded"""
+        if self._file is None:
+            return
+        if self.extra_state is not None:
+            extra = self.extra_state()
+            if extra != self.extra:
+                self.extra = extra
+                self._write({"op": "extra", "value": extra})
+        if self.records >= self.snapshot_every:
+            self.snapshot()
+
+    def snapshot(self) -> None:
+        """Writes the whole chat log to the snapshot and starts a new, empty journal"""
+        if self.chat_log is None:
+            raise BadJournalError("The journal has not been opened with a chat log")
+        os.makedirs(self.folder, exist_ok=True)
+        if self.extra_state is not None:
+            self.extra = self.extra_state()
+        journal_id = str(uuid.uuid4())
+        snapshot = {"journal_id": journal_id, "chat_log": self.chat_log.make_save_dict(sized=False), "extra": self.extra}
+        # the snapshot is replaced first, the old journal doesn't match its journal_id so it is never replayed on top of it
+        write_save(self.snapshot_path, snapshot, atomic=True)
+        self._replace(self.journal_path, json.dumps({"op": "header", "journal_id": journal_id}) + "\n")
+        if self._file is not None:
+            self._file.close()
+        self._file = open(self.journal_path, "a", encoding="utf-8")
+        self._journal_id = journal_id
+        self.records = 0
+
+    def _replace(self, path: str, text: str) -> None:
+        temp_path = path + ".tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self.chat_log is not None and self.chat_log.journal is self:
+            self.chat_log.journal = None
+
+    # loading
+
+    def _read_journal(self, journal_id: str) -> list:
+        """Returns the records of the journal if it belongs to the snapshot with journal_id, without a half written last line"""
+        if not os.path.exists(self.journal_path):
+            return []
+        with open(self.journal_path, "r", encoding="utf-8") as f:
+            lines = f.read().split("\n")
+        records = []
+        for number, line in enumerate(lines):
+            if not line:
+                continue
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                if number >= len(lines) - 2:
+                    # the last line was cut off by a crash, its change was never finished
+                    break
+                raise BadJournalError(f"Line {number + 1} of {self.journal_path} is not valid JSON")
+        if not records or records[0].get("op") != "header" or records[0].get("journal_id") != journal_id:
+            return []
+        return records[1:]
+
+    def _replay(self) -> None:
+        with open(self.snapshot_path, "r", encoding="utf-8") as f:
+            snapshot = json.load(f)
+        chat_log = self.chat_log
+        chat_log.load_save_dict(snapshot["chat_log"])
+        self.extra = snapshot.get("extra")
+        for record in self._read_journal(snapshot["journal_id"]):
+            self._apply(chat_log, record)
+        if self.extra is not None and self.restore_extra_state is not None:
+            self.restore_extra_state(self.extra)
+
+    def _apply(self, chat_log, record: dict) -> None:
+        op = record.get("op")
+        if op == "message":
+            message = chat_log.message_class(record["role"], record["content"], chat_log.model, tokens=record.get("tokens"))
+            chat_log.add_message_obj(message)
+        elif op == "param":
+            if record["name"] not in self.params:
+                raise BadJournalError(f"Unknown parameter {record['name']} in journal")
+            setattr(chat_log, record["name"], record["value"])
+        elif op == "sys_prompt":
+            chat_log.sys_prompt = record["value"]
+        elif op == "wildcards":
+            chat_log.add_more_wildcards(record["value"])
+        elif op == "trim_policy":
+            chat_log.set_trim_policy(record["name"], record.get("options"))
+        elif op == "priority":
+            chat_log.set_message_priority(record["position"], record["priority"])
+        elif op == "reset":
+            chat_log.reset(clear_sys_prompt=record.get("clear_sys_prompt", False))
+        elif op == "extra":
+            self.extra = record["value"]
+        else:
+            raise BadJournalError(f"Unknown journal record {op}")
+
+    def __repr__(self):
+        return f"ChatJournal(folder={self.folder!r}, name={self.name!r}, snapshot_every={self.snapshot_every}, records={self.records})"
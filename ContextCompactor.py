@@ -0,0 +1,176 @@
+import hashlib
+import re
+import threading
+from collections import OrderedDict
+from typing import List, Optional
+
+from TokenCounter import tokenizer_registry
+
+
+class Summarizer:
+    """
+    Base class for summarizers used by ContextCompactor. A summarizer takes a list of messages (anything with .role and .content) and returns a summary string
+    Subclasses only need to implement summarize
+    """
+
+    def summarize(self, messages: list) -> str:
+        raise NotImplementedError
+
+    def __call__(self, messages: list) -> str:
+        return self.summarize(messages)
+
+
+class ExtractiveSummarizer(Summarizer):
+    """
+    A local, deterministic summarizer that keeps the first sentence of each message. It makes no API calls, so it is used in tests and when no GPTChat is available
+    Attributes:
+        max_chars_per_message (int): Longest a single message's sentence can be before it is cut off
+    """
+
+    sentence_end = re.compile(r"(?<=[.!?])\s")
+
+    def __init__(self, max_chars_per_message: int = 160):
+        self.max_chars_per_message = max_chars_per_message
+
+    def summarize(self, messages: list) -> str:
+        lines = []
+        for message in messages:
+            content = " ".join(message.content.split())
+            if not content:
+                continue
+            sentence = self.sentence_end.split(content, maxsplit=1)[0]
+            if len(sentence) > self.max_chars_per_message:
+                sentence = sentence[: self.max_chars_per_message - 3].rstrip() + "..."
+            lines.append(f"{message.role}: {sentence}")
+        return "\n".join(lines)
+
+
+class GPTChatSummarizer(Summarizer):
+    """
+    Summarizes messages with a GPTChat object, this is the default summarizer used by ChatWrapper.enable_compaction
+    Attributes:
+        gpt_chat (GPTChat): The GPTChat object used to make the API call, its return_type is set to string for the call and then put back
+        prompt (str): The system prompt asking for the summary
+    """
+
+    default_prompt = (
+        "Summarize the following part of a conversation between a user and an AI assistant. "
+        "Keep names, decisions, facts, code identifiers and open questions. Be brief and do not add anything that is not in the conversation."
+    )
+
+    def __init__(self, gpt_chat, prompt: str = None):
+        self.gpt_chat = gpt_chat
+        self.prompt = prompt if prompt is not None else self.default_prompt
+
+    def summarize(self, messages: list) -> str:
+        transcript = "\n\n".join(f"{message.role}: {message.content}" for message in messages)
+        return_type = self.gpt_chat.return_type
+        self.gpt_chat.return_type = "string"
+        try:
+            return self.gpt_chat.make_api_call(
+                [{"role": "system", "content": self.prompt}, {"role": "user", "content": transcript}]
+            )
+        finally:
+            self.gpt_chat.return_type = return_type
+
+
+class ContextCompactor:
+    """
+    Condenses messages that were evicted from a ChatLog's trimmed chat log into a summary message, which ChatLog.get_finished_chat_log puts after the system prompt
+    Evicted messages are summarized in fixed chunks of chunk_size messages, counted in the order they come in full_chat_log, so a chunk is only summarized once it has been evicted in full and is never summarized again.
+    The chat log reports which positions were really evicted, so messages kept by keep_first, pins or priorities are never summarized, and only the settled evicted messages (see ChatLog.count_settled_evictions) are chunked, so the chunks don't move as more are evicted
+    Summaries are cached by a hash of the chunk's roles and contents, so the same range is never sent to the summarizer twice, even from another chat log or after a reload
+    Attributes:
+        summarizer (Summarizer): Turns a list of messages into a summary string
+        chunk_size (int): Number of evicted messages summarized together
+        max_summary_tokens (int): Tokens set aside for the summary message. ChatLog takes these out of its budget, and only the newest chunk summaries that fit are used
+        cache_size (int): Number of chunk summaries kept
+        calls (int): Number of times the summarizer has been called
+    Methods:
+        range_hash(messages: list) -> str: Hashes a range of messages for the summary cache
+        summarize_chunk(messages: list, positions: tuple) -> str: Returns the cached summary for a chunk, or makes it
+        get_summary_message(chat_log) -> dict | None: Returns the summary message for the chat log's evicted messages, or None if nothing has been evicted in full chunks yet
+    Example Usage:
+        chat_log.set_compactor(ContextCompactor(ExtractiveSummarizer(), chunk_size=10))
+        chat_log.get_finished_chat_log()  # [system prompt, summary of evicted messages, *trimmed chat log]
+    """
+
+    summary_heading = "Summary of the earlier conversation, which is no longer shown in full:"
+
+    def __init__(self, summarizer: Summarizer, chunk_size: int = 20, max_summary_tokens: int = 500, cache_size: int = 256):
+        if chunk_size < 1:
+            raise ValueError("chunk_size must be at least 1")
+        self.summarizer = summarizer
+        self.chunk_size = chunk_size
+        self.max_summary_tokens = max_summary_tokens
+        self.cache_size = cache_size
+        self.calls = 0
+        self._summaries: "OrderedDict[str, str]" = OrderedDict()
+        # id of a chunk's first message -> (first message, last message, positions, hash), so a chunk's content is only hashed once
+        self._chunk_hashes: "OrderedDict[int, tuple]" = OrderedDict()
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def range_hash(messages: list) -> str:
+        """Hashes a range of messages for the summary cache"""
+        digest = hashlib.blake2b(digest_size=16)
+        for message in messages:
+            digest.update(message.role.encode("utf-8"))
+            digest.update(b"\x00")
+            digest.update(message.content.encode("utf-8"))
+            digest.update(b"\x01")
+        return digest.hexdigest()
+
+    def _chunk_hash(self, messages: list, positions: tuple = None) -> str:
+        key = id(messages[0])
+        cached = self._chunk_hashes.get(key)
+        if cached is not None and cached[0] is messages[0] and cached[1] is messages[-1] and cached[2] == positions:
+            return cached[3]
+        chunk_hash = self.range_hash(messages)
+        self._chunk_hashes[key] = (messages[0], messages[-1], positions, chunk_hash)
+        if len(self._chunk_hashes) > self.cache_size:
+            self._chunk_hashes.popitem(last=False)
+        return chunk_hash
+
+    def summarize_chunk(self, messages: list, positions: tuple = None) -> str:
+        """Returns the cached summary for a chunk of messages, calling the summarizer if it hasn't been summarized before. positions are where the messages are in full_chat_log, if the chunk can have gaps"""
+        with self._lock:
+            chunk_hash = self._chunk_hash(messages, positions)
+            summary = self._summaries.get(chunk_hash)
+            if summary is not None:
+                self._summaries.move_to_end(chunk_hash)
+                return summary
+            summary = self.summarizer(messages)
+            self.calls += 1
+            self._summaries[chunk_hash] = summary
+            if len(self._summaries) > self.cache_size:
+                self._summaries.popitem(last=False)
+            return summary
+
+    def get_summary_message(self, chat_log) -> Optional[dict]:
+        """Returns a system message summarizing the chat log's evicted messages, newest chunks first until max_summary_tokens is used, or None"""
+        evicted = chat_log.count_settled_evictions()
+        budget = self.max_summary_tokens - tokenizer_registry.count_tokens(self.summary_heading, chat_log.model)
+        summaries: List[str] = []
+        for chunk in range(evicted // self.chunk_size - 1, -1, -1):
+            start = chunk * self.chunk_size
+            positions, messages = zip(*chat_log.get_evicted_messages(start, start + self.chunk_size))
+            summary = self.summarize_chunk(list(messages), positions)
+            # one more token for the newline joining the summaries
+            tokens = tokenizer_registry.count_tokens(summary, chat_log.model) + 1
+            if tokens > budget:
+                break
+            budget -= tokens
+            summaries.append(summary)
+        if not summaries:
+            return None
+        summaries.reverse()
+        return {"role": "system", "content": "\n".join([self.summary_heading, *summaries])}
+
+    def clear(self) -> None:
+        with self._lock:
+            self._summaries.clear()
+            self._chunk_hashes.clear()
+
+    def __repr__(self):
+        return f"ContextCompactor(summarizer={self.summarizer.__class__.__name__}, chunk_size={self.chunk_size}, max_summary_tokens={self.max_summary_tokens})"
@@ -1,4 +1,4 @@
-import tiktoken
+from TokenCounter import tokenizer_registry
 from collections import namedtuple
 import random 
 import unittest
@@ -122,10 +122,8 @@ class EncodeMessage:
     
     @staticmethod
     def _default_token_counter_func( string, model = None) -> int:
-        """Counts tokens in a string"""
-      
-        encoding = tiktoken.encoding_for_model(model)
-        return len(encoding.encode(string))
+        """Counts tokens in a string, using the shared tokenizer registry"""
+        return tokenizer_registry.count_tokens(string, model)
     
     def _styler(self, message: dict | EncodedMessage) -> str:
         """Wrapper for styler function"""
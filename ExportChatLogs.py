@@ -2,6 +2,9 @@ import json
 import os
 from typing import Any, Dict, List, Optional, Set, Tuple, Union
 
+from settings import SAVE_STORAGE
+from StorageBackends import make_storage
+
 
 class NoFolderError(Exception):
     def __init__(self, message: str = None):
@@ -21,6 +24,7 @@ class ChatLogExporter:
     Attributes:
         - folder: str, folder where the chat logs are saved Defaults to "chatbot_saves", which is the default folder for ChatWrapper
         - save_folder: str, folder where the text files will be saved Defaults to "text_exports"
+        - storage: where the chat logs are read from, see StorageBackends.make_storage. Defaults to the .json files in folder, "sqlite" reads them straight from the SQLite database in folder
     Methods:
         Public:
 
@@ -70,12 +74,13 @@ class ChatLogExporter:
 
     """
 
-    def __init__(self, folder: str = "chatbot_saves", save_folder="text_exports"):
+    def __init__(self, folder: str = "chatbot_saves", save_folder="text_exports", storage=None):
         if not folder.endswith("/"):
             folder += "/"
         if not os.path.exists(folder):
             os.makedirs(folder)
         self.folder = folder
+        self.storage = make_storage(storage, folder)
         if not save_folder.endswith("/"):
             save_folder += "/"
         if not os.path.exists(save_folder):
@@ -102,16 +107,15 @@ class ChatLogExporter:
         return filepath
 
     def list_chatlog_files(self, remove_filepath: bool = True) -> list:
-        """Lists all the files in the folder. If remove_filepath is True, the folder path is removed from the file path."""
+        """Lists all the chat logs in the storage (for the .json files in the folder, other files like the token count store are skipped). If remove_filepath is True, the folder path is removed from the file path."""
+        names = self.storage.names()
         if remove_filepath:
-            return [
-                self._remove_filepath_chatlogs(file) for file in os.listdir(self.folder)
-            ]
-        return os.listdir(self.folder)
+            return names
+        return [name + ".json" for name in names]
 
     def check_if_chatlog_exists(self, filename: str) -> bool:
         """Checks if a ChatLog file exists."""
-        return os.path.exists(self._add_filepath_chatlogs(filename))
+        return self.storage.exists(self._remove_filepath_chatlogs(filename))
 
     def _check_message(self, message: dict) -> dict:
         """Checks if a message is valid, otherwise raises a type error or value error. This system is designed to work on ChatWrappers save files. Do not modify the save files, or this will not work."""
@@ -178,12 +182,9 @@ class ChatLogExporter:
         Raises:
             FileNotFoundError: If the file does not exist
         """
-        file_name = self._add_filepath_chatlogs(file_name)
-        try:
-            with open(file_name, "r") as f:
-                data = json.load(f)
-        except FileNotFoundError:
-            raise FileNotFoundError(f"File {file_name} not found")
+        data = self.storage.load(self._remove_filepath_chatlogs(file_name))
+        if data is None:
+            raise FileNotFoundError(f"File {self._add_filepath_chatlogs(file_name)} not found")
         return data
 
     def _add_filepath_saves(self, filepath: str) -> str:
@@ -284,8 +285,8 @@ def confirm(message: str = "Are you sure?", y_n_msg="(y/n)", yes="y", no="n") ->
 
 
 class ExportChatMenu:
-    def __init__(self, chatlog_folder: str = None, save_folder: str = None):
-        arg_dict = {}
+    def __init__(self, chatlog_folder: str = None, save_folder: str = None, storage=None):
+        arg_dict = {"storage": storage}
         if chatlog_folder is not None:
             arg_dict.update({"chatlog_folder": chatlog_folder})
         if save_folder is not None:
@@ -426,4 +427,4 @@ class ExportChatMenu:
                 return ans_lower, False
 
 
-export_chat_menu = ExportChatMenu()
+export_chat_menu = ExportChatMenu(storage=SAVE_STORAGE)
@@ -0,0 +1,102 @@
+from itertools import islice
+from typing import Iterator, List
+
+
+class ForkedHistory:
+    """
+    A list-like full_chat_log for a forked ChatLog. It shares the first messages with the chat log it was forked from, and keeps the messages added since the fork in its own list
+    Sharing is safe because a full_chat_log is only ever appended to. The parent can keep adding messages after the fork, the fork only sees the first length of them.
+    Replacing a full_chat_log (reset, load) swaps in a new object, so it never changes what a fork sees
+    Forking is O(1) and uses no memory per shared message. Reading a shared message goes through the parent, which for a fork of a fork is one step per level
+    Attributes:
+        base (list | SpilledHistory | ForkedHistory): The parent's full_chat_log
+        length (int): How many of the base's messages are shared
+    Methods:
+        append(message), extend(messages): Adds messages after the shared ones
+        role_positions(role, start, stop, reverse) -> iterator, count_role(role, start, stop) -> int: Find messages by role, using the base's roles for the shared messages. Only if the base stores its roles (see stores_roles)
+    Example Usage:
+        child = chat_log.fork()
+        child.full_chat_log  # ForkedHistory, used like a list
+    """
+
+    def __init__(self, base, length: int = None):
+        if length is None:
+            length = len(base)
+        # a fork of a fork that hasn't added anything shares the same messages, so it can use the same base
+        while isinstance(base, ForkedHistory) and length <= base.length:
+            base = base.base
+        self.base = base
+        self.length = length
+        self._tail: List = []
+
+    def append(self, message) -> None:
+        self._tail.append(message)
+
+    def extend(self, messages) -> None:
+        self._tail.extend(messages)
+
+    def __len__(self) -> int:
+        return self.length + len(self._tail)
+
+    def __bool__(self) -> bool:
+        return len(self) > 0
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return [self[position] for position in range(start, stop, step)]
+            return list(self._iter_range(start, stop))
+        length = len(self)
+        if index < 0:
+            index += length
+        if not 0 <= index < length:
+            raise IndexError("history index out of range")
+        if index < self.length:
+            return self.base[index]
+        return self._tail[index - self.length]
+
+    def _iter_range(self, start: int, stop: int) -> Iterator:
+        if start < self.length:
+            yield from self.base[start:min(stop, self.length)]
+        if stop > self.length:
+            yield from self._tail[max(start - self.length, 0):stop - self.length]
+
+    def __iter__(self) -> Iterator:
+        return self._iter_range(0, len(self))
+
+    def __reversed__(self) -> Iterator:
+        yield from reversed(self._tail)
+        if self.length == len(self.base):
+            yield from reversed(self.base)
+        else:
+            # skip what the parent added after the fork
+            yield from islice(reversed(self.base), len(self.base) - self.length, None)
+
+    @property
+    def stores_roles(self) -> bool:
+        """True if the base keeps its messages' roles apart from the messages (ie SpilledHistory), so they can be found by role without reading them"""
+        return getattr(self.base, "stores_roles", False)
+
+    def _tail_role_positions(self, role: str, start: int, stop: int) -> List[int]:
+        return [position for position in range(max(start, self.length), stop) if self._tail[position - self.length].role == role]
+
+    def role_positions(self, role: str, start: int = 0, stop: int = None, reverse: bool = False) -> Iterator[int]:
+        """Yields the positions in [start, stop) of the messages with role, newest first if reverse is True"""
+        stop = len(self) if stop is None else min(stop, len(self))
+        shared_stop = min(stop, self.length)
+        if reverse:
+            yield from reversed(self._tail_role_positions(role, start, stop))
+        if start < shared_stop:
+            yield from self.base.role_positions(role, start, shared_stop, reverse)
+        if not reverse:
+            yield from self._tail_role_positions(role, start, stop)
+
+    def count_role(self, role: str, start: int = 0, stop: int = None) -> int:
+        stop = len(self) if stop is None else min(stop, len(self))
+        shared_stop = min(stop, self.length)
+        shared = self.base.count_role(role, start, shared_stop) if start < shared_stop else 0
+        return shared + len(self._tail_role_positions(role, start, stop))
+
+    def __repr__(self):
+        return f"ForkedHistory(shared={self.length}, own={len(self._tail)})"
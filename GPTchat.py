@@ -1,4 +1,5 @@
 import datetime
+import functools
 import json
 import os
 import time
@@ -98,6 +99,15 @@ def process_zero_and_none(value: str) -> tuple[bool, Any]:
     else:
         return False, value
 
+
+def notifies_change(setter):
+    """Wraps a GPTChat setter so the change listeners are told once the value is set, see GPTChat.add_change_listener"""
+    @functools.wraps(setter)
+    def wrapper(self, value) -> None:
+        setter(self, value)
+        self._notify_change()
+    return wrapper
+
 class GPTChat:
     """
     A class that abstracts away using the openai api to chat with a model
@@ -120,6 +130,7 @@ class GPTChat:
         get_params(self) -> dict: Returns the model parameters
         make_api_call(self, messages: list | ChatLog) -> Union[str, dict, Message]: Makes the api call to the openai api
         make_save_dict(self) -> dict: Makes a dictionary that can be used to save the model
+        add_change_listener(self, listener), remove_change_listener(self, listener): Calls listener(0) after each change to the model or its parameters
         _verify_save_dict(self, save_dict: dict) -> None: Verifies that the save dict is valid
         load_save_dict(self, save_dict: dict) -> None: Loads object information from a save dict
 
@@ -180,6 +191,8 @@ class GPTChat:
         }
         # for use in the ChatLogAndGPTChatFactory class
         self.template = template
+        # called after each change to the model or its parameters, see add_change_listener
+        self._change_listeners = []
         self.temperature = temperature
         self.model_name = model_name
         self.max_tokens = max_tokens
@@ -219,6 +232,7 @@ class GPTChat:
         return self._temperature
 
     @temperature.setter
+    @notifies_change
     def temperature(self, value: float) -> None:
         """Sets the temperature, which is a float between 0 and 2"""
         
@@ -247,6 +261,7 @@ class GPTChat:
         return self._model_name
 
     @model_name.setter
+    @notifies_change
     def model_name(self, value: str) -> None:
         """Sets the model name, which is a string, these are changed often by openai, so check the openai api for the most up to date models. The openai api will raise an error if it's not valid.The default is gpt-4"""
 
@@ -258,6 +273,7 @@ class GPTChat:
         return self._max_tokens
 
     @max_tokens.setter
+    @notifies_change
     def max_tokens(self, value: int) -> None:
         """Sets the max tokens, which is an int between 1 and the model's max tokens"""
         if value is None:
@@ -281,6 +297,7 @@ class GPTChat:
         return self._top_p
 
     @top_p.setter
+    @notifies_change
     def top_p(self, value: float) -> None:
         """Sets the top p, which is a float between 0 and 1"""
         special, val = process_zero_and_none(value)
@@ -306,6 +323,7 @@ class GPTChat:
         return self._frequency_penalty
 
     @frequency_penalty.setter
+    @notifies_change
     def frequency_penalty(self, value: float) -> None:
         """Sets the frequency penalty, which is a float between 0 and 2"""
         special, val = process_zero_and_none(value)
@@ -333,6 +351,7 @@ class GPTChat:
         return self._presence_penalty
 
     @presence_penalty.setter
+    @notifies_change
     def presence_penalty(self, value: float) -> None:
         """Sets the presence penalty, which is a float between 0 and 2"""
         special, val = process_zero_and_none(value)
@@ -482,6 +501,25 @@ class GPTChat:
                 print("Trying again... " + str(retries) + " retries left")
                 time.sleep(3)
 
+    def add_change_listener(self, listener) -> None:
+        """Calls listener(0) after each change to the model or its parameters, the 0 being the number of messages added, as for ChatLog.add_change_listener"""
+        self._change_listeners.append(listener)
+
+    def remove_change_listener(self, listener) -> None:
+        if listener in self._change_listeners:
+            self._change_listeners.remove(listener)
+
+    def _notify_change(self) -> None:
+        for listener in list(self._change_listeners):
+            listener(0)
+
+    def __copy__(self):
+        """A copy has no change listeners, they were added for this object"""
+        gpt_chat = self.__class__.__new__(self.__class__)
+        gpt_chat.__dict__.update(self.__dict__)
+        gpt_chat._change_listeners = []
+        return gpt_chat
+
     def make_save_dict(self) -> dict:
         """Returns a dictionary that can be used to recreate the GPTChat object"""
         return {
@@ -518,7 +556,15 @@ class GPTChat:
         return save_dict
 
     def load_save_dict(self, save_dict: dict, API_KEY = None) -> None:
-        """Loads a save dict into the GPTChat object"""
+        """Loads a save dict into the GPTChat object, the change listeners are told once"""
+        listeners, self._change_listeners = self._change_listeners, []
+        try:
+            self._load_save_dict(save_dict, API_KEY)
+        finally:
+            self._change_listeners = listeners
+        self._notify_change()
+
+    def _load_save_dict(self, save_dict: dict, API_KEY = None) -> None:
         save_dict = self._verify_save_dict(save_dict)
         self.temperature = save_dict["temperature"]
         self.model_name = save_dict["model_name"]
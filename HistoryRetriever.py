@@ -0,0 +1,173 @@
+import math
+import re
+from collections import Counter
+from typing import Container, Dict, Iterable, List, Optional, Tuple
+
+from TokenCounter import tokenizer_registry
+
+
+class BM25Index:
+    """
+    A small incremental BM25 index over documents with integer ids. Documents can only be added, which is all the chat history needs
+    Attributes:
+        k1 (float), b (float): The usual BM25 parameters
+        doc_count (int): Number of documents in the index
+    Methods:
+        tokenize(text: str) -> list: Splits text into lower case terms, without stop words
+        add(doc_id: int, text: str): Adds a document
+        search(query: str, top_k: int, exclude: Container[int] = None) -> list: Returns (doc_id, score) pairs, best first, skipping ids in exclude
+    Example Usage:
+        index = BM25Index()
+        index.add(0, "the deque is in collections")
+        index.search("where is deque", top_k=3)
+    """
+
+    term_pattern = re.compile(r"\w+")
+    stop_words = frozenset(
+        "a an and are as at be but by can do for from has have i if in is it its me my no not of on or so that the this to was we what when which who will with you your".split()
+    )
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        # term -> list of (doc_id, term frequency)
+        self._postings: Dict[str, List[Tuple[int, int]]] = {}
+        self._doc_lengths: Dict[int, int] = {}
+        self._total_length = 0
+
+    @property
+    def doc_count(self) -> int:
+        return len(self._doc_lengths)
+
+    def __contains__(self, doc_id: int) -> bool:
+        return doc_id in self._doc_lengths
+
+    def tokenize(self, text: str) -> List[str]:
+        return [term for term in self.term_pattern.findall(text.lower()) if term not in self.stop_words]
+
+    def add(self, doc_id: int, text: str) -> None:
+        terms = self.tokenize(text)
+        self._doc_lengths[doc_id] = len(terms)
+        self._total_length += len(terms)
+        for term, frequency in Counter(terms).items():
+            self._postings.setdefault(term, []).append((doc_id, frequency))
+
+    def search(self, query: str, top_k: int = 3, exclude: Container[int] = None) -> List[Tuple[int, float]]:
+        """Scores only the documents that share a term with the query, so the cost follows the query terms' postings and not the index size"""
+        if not self._doc_lengths:
+            return []
+        average_length = self._total_length / len(self._doc_lengths) or 1
+        scores: Dict[int, float] = {}
+        for term in set(self.tokenize(query)):
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (len(self._doc_lengths) - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc_id, frequency in postings:
+                if exclude is not None and doc_id in exclude:
+                    continue
+                length_norm = 1 - self.b + self.b * self._doc_lengths[doc_id] / average_length
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * frequency * (self.k1 + 1) / (frequency + self.k1 * length_norm)
+        return sorted(scores.items(), key=lambda item: (-item[1], -item[0]))[:top_k]
+
+    def clear(self) -> None:
+        self._postings.clear()
+        self._doc_lengths.clear()
+        self._total_length = 0
+
+
+class HistoryRetriever:
+    """
+    Brings back evicted messages that are relevant to the latest user message, using a local BM25 index over the evicted part of a ChatLog's full_chat_log
+    The index is updated incrementally as messages are evicted. ChatLog.get_finished_chat_log puts the retrieved messages in a system message after the system prompt, using only the tokens left over after trimming
+    The chat log tells the retriever the position of each message that leaves its window (see ChatLog.evict_from_window), so messages kept by keep_first, pins or priorities are never indexed, and each update only reads the messages evicted since the last one.
+    Messages that come back into the window when the budget grows stay in the index, and are left out of the results while they are in the window
+    Attributes:
+        top_k (int): Most messages to retrieve per turn
+        min_score (float): Messages scoring lower than this are not retrieved
+        index (BM25Index): The index, document ids are positions in full_chat_log
+    Methods:
+        note_evicted(chat_log, positions): Called by the chat log with the positions of messages that left its window
+        update(chat_log): Adds newly evicted messages to the index, rebuilding it from the chat log's evicted positions if the chat log is new to it, or was reset or loaded
+        retrieve(chat_log, query: str, token_budget: int) -> list: Returns the most relevant evicted messages that fit in token_budget, oldest first
+        get_retrieval_message(chat_log) -> dict | None: Returns the system message for the chat log's next request, or None
+        fork() -> HistoryRetriever: Returns a retriever with the same settings and an empty index, for a forked chat log
+    Example Usage:
+        chat_log.set_retriever(HistoryRetriever(top_k=3))
+        chat_log.get_finished_chat_log()  # [system prompt, relevant earlier messages, *trimmed chat log]
+    """
+
+    heading = "Earlier messages that may be relevant to the conversation:"
+
+    def __init__(self, top_k: int = 3, min_score: float = 1.0, k1: float = 1.5, b: float = 0.75):
+        self.top_k = top_k
+        self.min_score = min_score
+        self.index = BM25Index(k1=k1, b=b)
+        # the id and first message of the chat log the index is for, to tell when it is another chat log or was reset or loaded
+        self._chat_log_id = None
+        self._first_message = None
+        # positions evicted from that chat log since the last update
+        self._pending: List[int] = []
+
+    def note_evicted(self, chat_log, positions: Iterable[int]) -> None:
+        if chat_log.id == self._chat_log_id:
+            self._pending.extend(positions)
+
+    def update(self, chat_log) -> None:
+        """Indexes messages evicted since the last update"""
+        full_chat_log = chat_log.full_chat_log
+        first_message = full_chat_log[0] if full_chat_log else None
+        if chat_log.id != self._chat_log_id or first_message is not self._first_message:
+            # the positions mean something else now, so the index is made again from every evicted message
+            self.index.clear()
+            self._pending.clear()
+            self._chat_log_id = chat_log.id
+            self._first_message = first_message
+            for position, message in chat_log.get_evicted_messages():
+                self.index.add(position, message.content)
+            return
+        window = chat_log.trimmed_chat_log.positions()
+        # a position can be noted more than once if it came back into the window in between
+        positions = sorted({position for position in self._pending if position not in self.index and position not in window})
+        self._pending.clear()
+        for position, message in zip(positions, chat_log.get_messages_at(positions)):
+            self.index.add(position, message.content)
+
+    def retrieve(self, chat_log, query: str, token_budget: int) -> List:
+        """Returns the evicted messages that best match query and fit in token_budget together, oldest first"""
+        self.update(chat_log)
+        if not query or token_budget <= 0:
+            return []
+        # indexed messages can come back into the window when the budget grows
+        results = self.index.search(query, top_k=self.top_k, exclude=chat_log.trimmed_chat_log.positions())
+        retrieved = []
+        for position, score in results:
+            if score < self.min_score:
+                break
+            message = chat_log.full_chat_log[position]
+            # one more token for the newline and role label
+            tokens = message.tokens + 2
+            if tokens > token_budget:
+                continue
+            token_budget -= tokens
+            retrieved.append(position)
+        return [chat_log.full_chat_log[position] for position in sorted(retrieved)]
+
+    def get_retrieval_message(self, chat_log, token_budget: int) -> Optional[dict]:
+        """Returns a system message with the evicted messages most relevant to the last user message, fitting in token_budget, or None"""
+        last_user_message = chat_log.get_last_message("user")
+        if last_user_message is None:
+            return None
+        token_budget -= tokenizer_registry.count_tokens(self.heading, chat_log.model)
+        messages = self.retrieve(chat_log, last_user_message.content, token_budget)
+        if not messages:
+            return None
+        lines = [self.heading] + [f"{message.role}: {message.content}" for message in messages]
+        return {"role": "system", "content": "\n".join(lines)}
+
+    def fork(self) -> "HistoryRetriever":
+        """Returns a retriever with the same settings and an empty index, which is built on its first update"""
+        return HistoryRetriever(top_k=self.top_k, min_score=self.min_score, k1=self.index.k1, b=self.index.b)
+
+    def __repr__(self):
+        return f"HistoryRetriever(top_k={self.top_k}, min_score={self.min_score}, indexed={self.index.doc_count})"
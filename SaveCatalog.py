@@ -0,0 +1,215 @@
+import json
+import os
+import sqlite3
+import threading
+from typing import List, Optional
+
+
+class SaveCatalog:
+    """
+    Keeps the metadata of the saves in a folder (message count, model, date, size) in a SQLite file, so the load menus can list, sort and filter saves without opening each one
+    Saves made by ChatWrapper.SaveAndLoad, ChatLog.SaveToFile and AutoSaver are recorded as they are written. Every listing first checks the folder with os.scandir, and only opens the .json files that are new or have changed since they were recorded (by modification time and size). Rows for deleted files are dropped.
+    So the catalog rebuilds itself if saves are copied in, edited or deleted by hand, and a catalog file that can't be read is deleted and rebuilt.
+    A file that isn't a save (or can't be parsed) is still listed, with no metadata, as the menus have always listed every .json file
+    Attributes:
+        folder (str): The save folder
+        path (str): The catalog file, <folder>/.save_catalog.sqlite3. It doesn't end in .json so it isn't listed as a save
+    Methods:
+        record(path: str, save_dict: dict): Records a save that was just written to path
+        sync(): Brings the catalog up to date with the folder
+        list_saves(sort_by: str = "name", reverse: bool = False, model: str = None, min_messages: int = None, name_contains: str = None) -> list[dict]: Returns the metadata of the saves
+        names(...) -> list[str]: The same, but only the names (file names without .json)
+    Example Usage:
+        catalog = SaveCatalog("chatbot_saves")
+        catalog.list_saves(sort_by="saved_at", reverse=True, model="gpt-4")
+        # [{"name": "my_chat", "model": "gpt-4", "messages": 12, "saved_at": "2023-07-01 05:00:03", "file_size": 3744, ...}]
+    """
+
+    file_name = ".save_catalog.sqlite3"
+    columns = ("name", "mtime_ns", "file_size", "kind", "uuid", "model", "messages", "saved_at")
+    sort_columns = frozenset({"name", "file_size", "model", "messages", "saved_at"})
+
+    def __init__(self, folder: str):
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+        self.path = os.path.join(folder, self.file_name)
+        # the autosave thread records saves too
+        self._lock = threading.Lock()
+        self._connection = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            try:
+                self._connection = self._open()
+            except sqlite3.DatabaseError:
+                # the catalog only holds what can be read from the saves again
+                self._remove_catalog()
+                self._connection = self._open()
+        return self._connection
+
+    def _open(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, check_same_thread=False)
+        try:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS saves (name TEXT PRIMARY KEY, mtime_ns INTEGER, file_size INTEGER, kind TEXT, uuid TEXT, model TEXT, messages INTEGER, saved_at TEXT)"
+            )
+            connection.commit()
+        except sqlite3.DatabaseError:
+            connection.close()
+            raise
+        return connection
+
+    def _remove_catalog(self) -> None:
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+        for suffix in ("", "-journal", "-wal", "-shm"):
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    @staticmethod
+    def describe(save_dict) -> dict:
+        """Returns the catalog metadata of a ChatWrapper save or a ChatLog save. Anything else gets kind None"""
+        info = {"kind": None, "uuid": None, "model": None, "messages": None, "saved_at": None}
+        if not isinstance(save_dict, dict):
+            return info
+        chat_log = save_dict
+        if isinstance(save_dict.get("chat_log"), dict):
+            info["kind"] = "chat_wrapper"
+            chat_log = save_dict["chat_log"]
+        elif "full_chat_log" in save_dict:
+            info["kind"] = "chat_log"
+        else:
+            return info
+        metadata = chat_log.get("metadata") if isinstance(chat_log.get("metadata"), dict) else {}
+        info["uuid"] = metadata.get("uuid")
+        info["model"] = chat_log.get("model")
+        info["messages"] = metadata.get("length")
+        if info["messages"] is None and isinstance(chat_log.get("full_chat_log"), list):
+            info["messages"] = len(chat_log["full_chat_log"])
+        info["saved_at"] = metadata.get("date")
+        return info
+
+    def _name(self, path: str) -> str:
+        name = os.path.basename(path)
+        return name[:-5] if name.endswith(".json") else name
+
+    def _upsert(self, name: str, stat: os.stat_result, info: dict) -> None:
+        self._connect().execute(
+            "INSERT OR REPLACE INTO saves VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (name, stat.st_mtime_ns, stat.st_size, info["kind"], info["uuid"], info["model"], info["messages"], info["saved_at"]),
+        )
+
+    def record(self, path: str, save_dict: dict) -> None:
+        """Records a save that was just written to path, from the dict it was written from, so it doesn't have to be read back"""
+        with self._lock:
+            try:
+                self._upsert(self._name(path), os.stat(path), self.describe(save_dict))
+                self._connect().commit()
+            except sqlite3.DatabaseError:
+                # the next sync rebuilds it from the files
+                self._remove_catalog()
+
+    def _read_info(self, path: str) -> dict:
+        try:
+            with open(path, "r") as f:
+                return self.describe(json.load(f))
+        except (OSError, ValueError):
+            return self.describe(None)
+
+    def sync(self) -> None:
+        """Brings the catalog up to date with the folder, only reading the saves that changed since they were recorded"""
+        with self._lock:
+            try:
+                self._sync()
+            except sqlite3.DatabaseError:
+                self._remove_catalog()
+                self._sync()
+
+    def _sync(self) -> None:
+        connection = self._connect()
+        known = {name: (mtime_ns, file_size) for name, mtime_ns, file_size in connection.execute("SELECT name, mtime_ns, file_size FROM saves")}
+        seen = set()
+        with os.scandir(self.folder) as entries:
+            for entry in entries:
+                if not entry.name.endswith(".json") or not entry.is_file():
+                    continue
+                name = entry.name[:-5]
+                seen.add(name)
+                stat = entry.stat()
+                if known.get(name) != (stat.st_mtime_ns, stat.st_size):
+                    self._upsert(name, stat, self._read_info(entry.path))
+        removed = [(name,) for name in known.keys() - seen]
+        if removed:
+            connection.executemany("DELETE FROM saves WHERE name = ?", removed)
+        connection.commit()
+
+    def list_saves(
+        self,
+        sort_by: str = "name",
+        reverse: bool = False,
+        model: str = None,
+        min_messages: int = None,
+        name_contains: str = None,
+    ) -> List[dict]:
+        """Returns the metadata of the saves in the folder as dicts, sorted by sort_by (name, file_size, model, messages or saved_at), and filtered by model, least number of messages and part of the name"""
+        self.sync()
+        query, params = list_query("saves", self.columns, self.sort_columns, sort_by, reverse, model, min_messages, name_contains)
+        with self._lock:
+            rows = self._connect().execute(query, params).fetchall()
+        return [dict(zip(self.columns, row)) for row in rows]
+
+    def names(self, **kwargs) -> List[str]:
+        """Returns the names of the saves, takes the same arguments as list_saves"""
+        return [save["name"] for save in self.list_saves(**kwargs)]
+
+    def __repr__(self):
+        return f"SaveCatalog(folder={self.folder!r})"
+
+
+def list_query(table: str, columns: tuple, sort_columns: frozenset, sort_by: str, reverse: bool, model: str, min_messages: int, name_contains: str) -> tuple:
+    """Returns the SQL and parameters listing the saves in table, shared with StorageBackends.SQLiteStorage. sort_by is checked against sort_columns, since it can't be a parameter"""
+    if sort_by not in sort_columns:
+        raise ValueError(f"sort_by must be one of {sorted(sort_columns)}")
+    query = f"SELECT {', '.join(columns)} FROM {table}"
+    conditions, params = [], []
+    if model is not None:
+        conditions.append("model = ?")
+        params.append(model)
+    if min_messages is not None:
+        conditions.append("messages >= ?")
+        params.append(min_messages)
+    if name_contains is not None:
+        conditions.append("instr(name, ?) > 0")
+        params.append(name_contains)
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    query += f" ORDER BY {sort_by} {'DESC' if reverse else 'ASC'}, name"
+    return query, params
+
+
+def format_save_info(save: dict) -> str:
+    """Returns a line for a menu describing a save from SaveCatalog.list_saves"""
+    if save["kind"] is None:
+        return save["name"]
+    return f"{save['name']} - {save['messages']} messages, {save['model']}, saved {save['saved_at']}, {save['file_size'] / 1024:.1f} KB"
+
+
+# one catalog per folder, so every menu and saver in the process shares its connection and lock
+_catalogs = {}
+_catalogs_lock = threading.Lock()
+
+
+def get_catalog(folder: str) -> SaveCatalog:
+    """Returns the shared SaveCatalog for folder"""
+    key = os.path.abspath(folder)
+    with _catalogs_lock:
+        if key not in _catalogs:
+            _catalogs[key] = SaveCatalog(folder)
+        return _catalogs[key]
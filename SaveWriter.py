@@ -0,0 +1,122 @@
+import hashlib
+import json
+import os
+import threading
+
+# the same encoder json.dump uses, so files written here match ones written with json.dump
+_encoder = json.JSONEncoder()
+
+
+class SaveWriter:
+    """
+    Writes a save dict to a text file in one pass, filling in the size and checksum of each chat log save in it as it is written
+    json.dumps just to get a save's size and then json.dump to write it serializes every message twice. SaveWriter encodes each message once, straight into the file
+    A chat log save is a dict whose "metadata" dict has "size" set to None, as made by ChatLog.SaveToDict.save(sized=False). Its other keys are written first and its metadata last, once the size and checksum are known:
+        size (int): The same number SaveToDict.save gives, the length of json.dumps of the save without the size
+        checksum (str): The sha256 of json.dumps of the save without its metadata, see checksum_matches
+    Key order aside, the file is the same JSON json.dump would write, so it loads with json.load as before
+    Attributes:
+        f: The text file being written to
+        size (int): Characters written so far
+    Methods:
+        write_value(value): Writes a JSON value. Dicts are written key by key, lists item by item
+    Example Usage:
+        with open("save.json", "w") as f:
+            SaveWriter(f).write_value(chat_log.save_to_dict.save(sized=False))
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.size = 0
+        # [length, sha256] of each chat log save being written, innermost last
+        self._sections = []
+
+    def write(self, text: str) -> None:
+        self.f.write(text)
+        self.size += len(text)
+        for section in self._sections:
+            section[0] += len(text)
+            section[1].update(text.encode("utf-8"))
+
+    def write_value(self, value) -> None:
+        if isinstance(value, dict):
+            metadata = value.get("metadata")
+            if isinstance(metadata, dict) and "size" in metadata and metadata["size"] is None:
+                self._write_sized(value)
+            else:
+                self._write_items(value.items())
+        elif isinstance(value, list):
+            self.write("[")
+            for number, item in enumerate(value):
+                if number:
+                    self.write(", ")
+                self.write(_encoder.encode(item))
+            self.write("]")
+        else:
+            self.write(_encoder.encode(value))
+
+    def _write_items(self, items) -> None:
+        self.write("{")
+        for number, (key, item) in enumerate(items):
+            if number:
+                self.write(", ")
+            self.write(_encoder.encode(str(key)) + ": ")
+            self.write_value(item)
+        self.write("}")
+
+    def _write_sized(self, save_dict: dict) -> None:
+        section = [0, hashlib.sha256()]
+        self._sections.append(section)
+        self.write("{")
+        body = [(key, item) for key, item in save_dict.items() if key != "metadata"]
+        for number, (key, item) in enumerate(body):
+            if number:
+                self.write(", ")
+            self.write(_encoder.encode(key) + ": ")
+            self.write_value(item)
+        self._sections.pop()
+        length, checksum = section
+        checksum.update(b"}")
+        metadata = {key: item for key, item in save_dict["metadata"].items() if key != "size"}
+        # json.dumps of the save with its metadata first and no size, which is what SaveToDict.save measures
+        size = length + 1 + len('"metadata": ') + len(_encoder.encode(metadata))
+        if body:
+            size += len(", ")
+            self.write(", ")
+        metadata["size"] = size
+        metadata["checksum"] = checksum.hexdigest()
+        self.write('"metadata": ')
+        self.write(_encoder.encode(metadata))
+        self.write("}")
+
+
+def checksum_matches(save_dict: dict) -> bool:
+    """Returns True if a loaded chat log save has the checksum it was written with, False if it has been changed or has no checksum"""
+    checksum = save_dict.get("metadata", {}).get("checksum")
+    if checksum is None:
+        return False
+    body = {key: item for key, item in save_dict.items() if key != "metadata"}
+    return hashlib.sha256(json.dumps(body).encode("utf-8")).hexdigest() == checksum
+
+
+def write_save(path: str, value, atomic: bool = False) -> int:
+    """Writes value to path with a SaveWriter and returns the number of characters written
+    If atomic is True it is written to a temporary file next to path, fsynced and renamed over path, so path is never left half written"""
+    if not atomic:
+        with open(path, "w") as f:
+            writer = SaveWriter(f)
+            writer.write_value(value)
+        return writer.size
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(temp_path, "w") as f:
+            writer = SaveWriter(f)
+            writer.write_value(value)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return writer.size
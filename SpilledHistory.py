@@ -0,0 +1,259 @@
+import json
+import os
+import tempfile
+import threading
+import weakref
+from array import array
+from typing import Callable, Iterator, List
+
+from TokenCounter import tokenizer_registry
+
+
+class SpilledHistory:
+    """
+    A list-like store for a ChatLog's full_chat_log that keeps only the newest messages in memory and spills the older ones to an append-only segment file
+    The segment file has one JSON record per message, with its role, content and token counts per encoding. In memory there is only an array of the records' byte offsets and one byte per message for its role, so resident memory follows the window and not the length of the session
+    Spilled messages that are still used somewhere else (ie in the trimmed chat log) are found through a weak cache, so reading one back gives the same object for as long as it is alive
+    Supports len, indexing and slicing (including negative indexes), iteration, reversed, append and extend, which is everything ChatLog, the trim policies, saving and exporting use
+    Reads can come from another thread while messages are added (ie an autosave writing a fork), so the resident messages and the offsets are only looked at and changed together under a lock
+    Attributes:
+        path (str): The segment file, a temporary file in folder that is deleted when the history is closed or garbage collected
+        model (str): The model messages read back from the segment file are made with, kept in step with the ChatLog's model
+        resident_messages (int): Number of the newest messages kept in memory. Once there are twice as many, the oldest are spilled in one batch
+        spilled (int): Number of messages in the segment file
+    Methods:
+        append(message), extend(messages): Adds messages, spilling the oldest if there are too many in memory
+        role_positions(role, start, stop, reverse) -> iterator, count_role(role, start, stop) -> int: Find messages by role from the roles kept in memory, without reading the segment file
+        loaded_messages() -> list: Returns the messages that are in memory, resident or still alive somewhere else
+        close(): Closes and deletes the segment file
+    Example Usage:
+        chat_log = ChatLog(spill_history=True, spill_resident_messages=100)
+        chat_log.full_chat_log  # SpilledHistory, used like a list
+    """
+
+    def __init__(
+        self,
+        message_class: Callable,
+        model: str = "gpt-4",
+        folder: str = None,
+        resident_messages: int = 100,
+        messages: list = None,
+    ):
+        if resident_messages < 1:
+            raise ValueError("resident_messages must be at least 1")
+        self.message_class = message_class
+        self.model = model
+        self.resident_messages = resident_messages
+        if folder is not None:
+            os.makedirs(folder, exist_ok=True)
+        fd, self.path = tempfile.mkstemp(prefix="chat_log_", suffix=".jsonl", dir=folder)
+        self._file = os.fdopen(fd, "w+b")
+        self._lock = threading.RLock()
+        # _offsets[i] is where the record for message i starts in the segment file
+        self._offsets = array("Q")
+        self._end = 0
+        self._resident: List = []
+        # _roles[i] is the code of message i's role, codes are given out in _role_codes as roles are first seen
+        self._roles = bytearray()
+        self._role_codes = {}
+        # position -> spilled message that is still alive, so reads keep giving the same object
+        self._alive = weakref.WeakValueDictionary()
+        self._encodings = {}
+        self._finalizer = weakref.finalize(self, self._close_file, self._file, self.path)
+        if messages:
+            self.extend(messages)
+
+    @staticmethod
+    def _close_file(file, path: str) -> None:
+        file.close()
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def close(self) -> None:
+        """Closes and deletes the segment file, the history can't be used after this"""
+        self._finalizer()
+
+    @property
+    def spilled(self) -> int:
+        return len(self._offsets)
+
+    def _encoding_name(self, model: str) -> str:
+        encoding_name = self._encodings.get(model)
+        if encoding_name is None:
+            encoding_name = self._encodings[model] = tokenizer_registry.encoding_name_for_model(model)
+        return encoding_name
+
+    # writing
+
+    def _role_code(self, role: str) -> int:
+        code = self._role_codes.get(role)
+        if code is None:
+            if len(self._role_codes) > 255:
+                raise ValueError("A SpilledHistory can only hold 256 different roles")
+            code = self._role_codes[role] = len(self._role_codes)
+        return code
+
+    def append(self, message) -> None:
+        with self._lock:
+            self._roles.append(self._role_code(message.role))
+            self._resident.append(message)
+            if len(self._resident) >= 2 * self.resident_messages:
+                self._spill()
+
+    def extend(self, messages) -> None:
+        messages = list(messages)
+        with self._lock:
+            self._roles.extend(self._role_code(message.role) for message in messages)
+            self._resident.extend(messages)
+            if len(self._resident) >= 2 * self.resident_messages:
+                self._spill()
+
+    def _record(self, message) -> bytes:
+        counts = dict(message._encoding_tokens) if message._encoding_tokens else {}
+        if message._tokens is not None:
+            counts[self._encoding_name(message.model)] = message._tokens
+        record = {"role": message.role, "content": message.content, "tokens": counts}
+        return json.dumps(record, ensure_ascii=False).encode("utf-8") + b"\n"
+
+    def _spill(self) -> None:
+        """Writes all but the newest resident_messages to the end of the segment file in one write"""
+        with self._lock:
+            count = len(self._resident) - self.resident_messages
+            if count <= 0:
+                return
+            position = len(self._offsets)
+            records = []
+            for message in self._resident[:count]:
+                record = self._record(message)
+                self._offsets.append(self._end)
+                self._end += len(record)
+                records.append(record)
+                self._alive[position] = message
+                position += 1
+            self._file.seek(0, os.SEEK_END)
+            self._file.write(b"".join(records))
+            self._file.flush()
+            del self._resident[:count]
+
+    # reading
+
+    def _make_message(self, line: bytes):
+        record = json.loads(line)
+        message = self.message_class(record["role"], record["content"], self.model)
+        counts = record["tokens"]
+        if counts:
+            message._tokens = counts.pop(self._encoding_name(self.model), None)
+            message._encoding_tokens = counts or None
+        return message
+
+    def _read_spilled(self, start: int, stop: int) -> Iterator:
+        """Yields the spilled messages from start to stop, reading the records in order and only making messages that aren't alive already"""
+        position = start
+        while position < stop:
+            message = self._alive.get(position)
+            if message is not None:
+                yield message
+                position += 1
+                continue
+            with self._lock:
+                self._file.seek(self._offsets[position])
+                # read every record up to the next alive message in one go
+                run_end = position + 1
+                while run_end < stop and run_end not in self._alive:
+                    run_end += 1
+                end_offset = self._offsets[run_end] if run_end < len(self._offsets) else self._end
+                lines = self._file.read(end_offset - self._offsets[position]).splitlines()
+            for line in lines:
+                message = self._make_message(line)
+                self._alive[position] = message
+                yield message
+                position += 1
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._offsets) + len(self._resident)
+
+    def __bool__(self) -> bool:
+        return len(self) > 0
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return [self[position] for position in range(start, stop, step)]
+            return list(self._iter_range(start, stop))
+        with self._lock:
+            length = len(self)
+            if index < 0:
+                index += length
+            if not 0 <= index < length:
+                raise IndexError("history index out of range")
+            spilled = len(self._offsets)
+            if index >= spilled:
+                return self._resident[index - spilled]
+        # spilled records never change, so they are read without holding the lock
+        return next(self._read_spilled(index, index + 1))
+
+    def _iter_range(self, start: int, stop: int) -> Iterator:
+        with self._lock:
+            spilled = len(self._offsets)
+            resident = self._resident[max(start - spilled, 0):stop - spilled] if stop > spilled else []
+        if start < spilled:
+            yield from self._read_spilled(start, min(stop, spilled))
+        yield from resident
+
+    def __iter__(self) -> Iterator:
+        return self._iter_range(0, len(self))
+
+    def __reversed__(self) -> Iterator:
+        with self._lock:
+            resident = list(self._resident)
+            stop = len(self._offsets)
+        yield from reversed(resident)
+        # read backwards in blocks, so each block is one sequential read
+        block = 256
+        while stop > 0:
+            start = max(stop - block, 0)
+            yield from reversed(list(self._read_spilled(start, stop)))
+            stop = start
+
+    # roles, kept for every message so finding one by role never reads the segment file
+
+    stores_roles = True
+
+    def role_positions(self, role: str, start: int = 0, stop: int = None, reverse: bool = False) -> Iterator[int]:
+        """Yields the positions in [start, stop) of the messages with role, newest first if reverse is True"""
+        with self._lock:
+            code = self._role_codes.get(role)
+            length = len(self._roles)
+        if code is None:
+            return
+        stop = length if stop is None else min(stop, length)
+        # the roles are only appended to, so the part below length can be searched without the lock
+        while start < stop:
+            position = self._roles.rfind(code, start, stop) if reverse else self._roles.find(code, start, stop)
+            if position < 0:
+                return
+            yield position
+            if reverse:
+                stop = position
+            else:
+                start = position + 1
+
+    def count_role(self, role: str, start: int = 0, stop: int = None) -> int:
+        with self._lock:
+            code = self._role_codes.get(role)
+            length = len(self._roles)
+        if code is None:
+            return 0
+        return self._roles.count(code, start, length if stop is None else min(stop, length))
+
+    def loaded_messages(self) -> list:
+        """Returns the messages in memory, the resident ones and spilled ones that are still alive"""
+        with self._lock:
+            return list(self._alive.values()) + self._resident
+
+    def __repr__(self):
+        return f"SpilledHistory(messages={len(self)}, spilled={self.spilled}, resident={len(self._resident)}, path={self.path!r})"
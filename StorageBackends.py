@@ -0,0 +1,511 @@
+import json
+import os
+import sqlite3
+import threading
+import uuid
+import weakref
+from typing import Callable, Iterator, List, Optional
+
+from ForkedHistory import ForkedHistory
+from SaveCatalog import get_catalog, list_query
+from SaveWriter import write_save
+
+
+class StorageError(Exception):
+    """Raised when a save can't be stored or read"""
+    pass
+
+
+class StorageConflictError(StorageError):
+    """Raised when a save was replaced, or had other messages added to it, since the chat log writing to it was loaded or last saved"""
+    pass
+
+
+def _chat_log_dict(save_dict: dict) -> dict:
+    """Returns the ChatLog save dict inside a ChatWrapper save, or the save dict itself if it is a ChatLog save"""
+    if isinstance(save_dict.get("chat_log"), dict):
+        return save_dict["chat_log"]
+    return save_dict
+
+
+class StorageBackend:
+    """
+    Base class for where ChatWrapper.SaveAndLoad and ChatLog.SaveToFile keep their saves. A save is a save dict (a ChatWrapper save or a ChatLog save) stored under a name
+    JSONStorage, one .json file per save, is the default. SQLiteStorage keeps every save in one database with a row per message. Pick one with make_storage, or the storage argument of ChatWrapper and ChatLog
+    Methods:
+        save(name: str, save_dict: dict): Stores a save, replacing any save with the same name
+        save_chat(name: str, chat_log, wrap: callable = None): Stores a chat log. wrap turns its save dict into the one to store, ie a ChatWrapper save around it. Backends that can append only write the messages added since the chat log was loaded or last saved
+        load(name: str) -> dict: Returns the save dict, or None if there is no save with the name
+        exists(name: str) -> bool, delete(name: str) -> bool
+        list_saves(sort_by: str = "name", reverse: bool = False, model: str = None, min_messages: int = None, name_contains: str = None) -> list[dict]: The metadata of the saves, see SaveCatalog.list_saves
+        names(...) -> list[str]: The same, but only the names
+        close(): Releases any open files or connections. A storage that is used again after it is closed opens them again
+    """
+
+    def save(self, name: str, save_dict: dict) -> None:
+        raise NotImplementedError
+
+    def save_chat(self, name: str, chat_log, wrap: Callable[[dict], dict] = None) -> None:
+        save_dict = chat_log.make_save_dict(sized=False)
+        self.save(name, wrap(save_dict) if wrap is not None else save_dict)
+
+    def load(self, name: str) -> Optional[dict]:
+        raise NotImplementedError
+
+    def exists(self, name: str) -> bool:
+        raise NotImplementedError
+
+    def delete(self, name: str) -> bool:
+        raise NotImplementedError
+
+    def list_saves(self, **kwargs) -> List[dict]:
+        raise NotImplementedError
+
+    def names(self, **kwargs) -> List[str]:
+        return [save["name"] for save in self.list_saves(**kwargs)]
+
+    def close(self) -> None:
+        pass
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}()"
+
+
+class JSONStorage(StorageBackend):
+    """
+    Keeps each save as <folder>/<name>.json, written with SaveWriter to a temporary file and renamed into place, and listed through the folder's SaveCatalog
+    This is the format the chat bot has always used, so existing saves load as before
+    Attributes:
+        folder (str): The save folder
+        catalog (SaveCatalog): The catalog of the folder, every save is recorded in it
+    """
+
+    def __init__(self, folder: str = "chatbot_saves"):
+        self.folder = folder
+        self.catalog = get_catalog(folder)
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.folder, name + ".json")
+
+    def save(self, name: str, save_dict: dict) -> None:
+        path = self.path(name)
+        write_save(path, save_dict, atomic=True)
+        self.catalog.record(path, save_dict)
+
+    def load(self, name: str) -> Optional[dict]:
+        try:
+            with open(self.path(name), "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def exists(self, name: str) -> bool:
+        return os.path.exists(self.path(name))
+
+    def delete(self, name: str) -> bool:
+        if not self.exists(name):
+            return False
+        os.remove(self.path(name))
+        return True
+
+    def list_saves(self, **kwargs) -> List[dict]:
+        return self.catalog.list_saves(**kwargs)
+
+    def __repr__(self):
+        return f"JSONStorage(folder={self.folder!r})"
+
+
+class StoredHistory:
+    """
+    A list-like full_chat_log whose first messages are rows in a SQLiteStorage, read when they are needed. Messages added after it was loaded are kept in memory
+    Loading a save from SQLiteStorage only reads its window, the rest of the history comes from here. Rows read back are made into messages with make_message, or are dicts if there is none (ie for exporting)
+    Messages that are still used somewhere else (ie in the trimmed chat log) are found through a weak cache, so reading one back gives the same object for as long as it is alive
+    Each read checks that the save hasn't been replaced since it was loaded, and raises StorageConflictError if it has
+    Reads can come from another thread while messages are added (ie an autosave writing a fork), so the stored length and the added messages are only looked at and changed together under a lock
+    Attributes:
+        storage (SQLiteStorage), name (str): Where the rows are
+        generation (str): Id of the version of the save the rows belong to, a save gets a new one each time it is replaced in full
+        length (int): Number of messages that are rows in the database
+    Methods:
+        append(message), extend(messages): Adds messages after the stored ones
+        bind(make_message) -> StoredHistory: Returns the same history, making messages with make_message
+        loaded_messages() -> list: Returns the messages in memory
+    """
+
+    # rows read per query when going through a range of the history
+    read_batch = 500
+
+    def __init__(self, storage, name: str, generation: str, length: int, make_message: Callable[[dict], object] = None, messages: list = None):
+        self.storage = storage
+        self.name = name
+        self.generation = generation
+        self.length = length
+        self.make_message = make_message
+        self._tail: List = []
+        self._lock = threading.Lock()
+        # position -> message that is still alive, dicts can't be weakly referenced so they aren't cached
+        self._alive = weakref.WeakValueDictionary()
+        if messages is not None:
+            for position, message in enumerate(messages):
+                self._alive[position] = message
+
+    def bind(self, make_message: Callable[[dict], object]) -> "StoredHistory":
+        return StoredHistory(self.storage, self.name, self.generation, self.length, make_message)
+
+    def append(self, message) -> None:
+        with self._lock:
+            self._tail.append(message)
+
+    def extend(self, messages) -> None:
+        with self._lock:
+            self._tail.extend(messages)
+
+    def loaded_messages(self) -> list:
+        with self._lock:
+            return list(self._alive.values()) + self._tail
+
+    def _read_stored(self, start: int, stop: int) -> Iterator:
+        """Yields the stored messages from start to stop, only reading rows for the ones that aren't alive already"""
+        position = start
+        while position < stop:
+            message = self._alive.get(position)
+            if message is not None:
+                yield message
+                position += 1
+                continue
+            run_end = position + 1
+            while run_end < stop and run_end - position < self.read_batch and run_end not in self._alive:
+                run_end += 1
+            for message_dict in self.storage._read_messages(self.name, self.generation, position, run_end):
+                if self.make_message is None:
+                    yield message_dict
+                else:
+                    message = self.make_message(message_dict)
+                    self._alive[position] = message
+                    yield message
+                position += 1
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self.length + len(self._tail)
+
+    def __bool__(self) -> bool:
+        return len(self) > 0
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return [self[position] for position in range(start, stop, step)]
+            return list(self._iter_range(start, stop))
+        with self._lock:
+            length = self.length + len(self._tail)
+            if index < 0:
+                index += length
+            if not 0 <= index < length:
+                raise IndexError("history index out of range")
+            if index >= self.length:
+                return self._tail[index - self.length]
+        return next(self._read_stored(index, index + 1))
+
+    def _iter_range(self, start: int, stop: int) -> Iterator:
+        with self._lock:
+            stored = self.length
+            tail = self._tail[max(start - stored, 0):stop - stored] if stop > stored else []
+        if start < stored:
+            yield from self._read_stored(start, min(stop, stored))
+        yield from tail
+
+    def __iter__(self) -> Iterator:
+        return self._iter_range(0, len(self))
+
+    def __reversed__(self) -> Iterator:
+        with self._lock:
+            tail = list(self._tail)
+            stop = self.length
+        yield from reversed(tail)
+        while stop > 0:
+            start = max(stop - self.read_batch, 0)
+            yield from reversed(list(self._read_stored(start, stop)))
+            stop = start
+
+    def __repr__(self):
+        return f"StoredHistory(name={self.name!r}, stored={self.length}, unsaved={len(self._tail)})"
+
+
+class SQLiteStorage(StorageBackend):
+    """
+    Keeps every save in one SQLite database, in WAL mode so readers don't block the writer and several processes can share it
+    Tables:
+        saves: One row per save, with the save dict minus its messages (as JSON) and the metadata SaveCatalog lists
+        messages: One row per message, with its role, content and token count. list is 0 for full_chat_log and 1 for trimmed_chat_log, which is stored apart since a trim policy can keep any messages
+    Loading a save only reads its row and its window. full_chat_log is a StoredHistory, which reads the rest of the history when it is needed
+    Saving a chat log that was loaded from the same save, or saved to it before, only appends the messages added since then and rewrites the window. Otherwise the save is replaced in full.
+    What was last written to each save is kept here, by save name, as its generation, its length and its first and last message objects. A chat log whose history starts with those same objects continues the save, which is true of the chat log itself, its forks (ie autosave snapshots) and spilled histories, and the chat log is never changed by saving it
+    If another writer replaced the save or added other messages to it in the meantime, StorageConflictError is raised instead of mixing the two
+    Attributes:
+        path (str): The database file
+    Example Usage:
+        storage = make_storage("sqlite", "chatbot_saves")
+        chat_wrapper = ChatWrapper(storage=storage)
+        chat_wrapper.save("my_chat")  # the first save writes every message, later saves only the new ones
+    """
+
+    file_name = "saves.sqlite3"
+    columns = ("name", "file_size", "kind", "uuid", "model", "messages", "saved_at")
+    sort_columns = frozenset({"name", "file_size", "model", "messages", "saved_at"})
+
+    def __init__(self, path: str):
+        self.path = path
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        # the autosave thread saves too, and reads of a StoredHistory can come from any thread
+        self._lock = threading.RLock()
+        # save name -> (generation, number of messages, first message, last message) of the last save_chat to it, see _stored_prefix
+        self._written = {}
+        self._open_connection = None
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS saves (name TEXT PRIMARY KEY, generation TEXT NOT NULL, header TEXT NOT NULL, file_size INTEGER, kind TEXT, uuid TEXT, model TEXT, messages INTEGER NOT NULL, saved_at TEXT)"
+        )
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS messages (name TEXT NOT NULL, list INTEGER NOT NULL, position INTEGER NOT NULL, role TEXT NOT NULL, content TEXT NOT NULL, tokens INTEGER, PRIMARY KEY (name, list, position)) WITHOUT ROWID"
+        )
+
+    @property
+    def _connection(self) -> sqlite3.Connection:
+        """The connection to the database, opened again if the storage was closed, since make_storage gives every wrapper using the database the same storage"""
+        with self._lock:
+            if self._open_connection is None:
+                # transactions are started with BEGIN IMMEDIATE, so a writer waits for another one instead of failing part way
+                connection = sqlite3.connect(self.path, timeout=30, isolation_level=None, check_same_thread=False)
+                connection.execute("PRAGMA journal_mode=WAL")
+                connection.execute("PRAGMA synchronous=NORMAL")
+                self._open_connection = connection
+            return self._open_connection
+
+    def close(self) -> None:
+        """Closes the connection. The storage can still be used, it opens a new one when it is next needed, so closing it from one wrapper doesn't break another that shares it"""
+        with self._lock:
+            if self._open_connection is not None:
+                self._open_connection.close()
+                self._open_connection = None
+
+    def _transaction(self):
+        return _Transaction(self._connection, self._lock)
+
+    @staticmethod
+    def _split(save_dict: dict) -> tuple:
+        """Returns the save dict without the chat log's message lists, and the chat log save dict"""
+        chat_log = _chat_log_dict(save_dict)
+        chat_header = {key: value for key, value in chat_log.items() if key not in ("full_chat_log", "trimmed_chat_log")}
+        if chat_log is save_dict:
+            return chat_header, chat_log
+        header = dict(save_dict)
+        header["chat_log"] = chat_header
+        return header, chat_log
+
+    @staticmethod
+    def _rows(name: str, list_number: int, messages, start: int = 0) -> Iterator[tuple]:
+        for position, message in enumerate(messages, start):
+            yield (name, list_number, position, message["role"], message["content"], message.get("tokens"))
+
+    @staticmethod
+    def _message_bytes(messages) -> int:
+        """Returns the number of bytes the messages' roles and contents take up, encoded as UTF-8"""
+        return sum(len(message["role"].encode("utf-8")) + len(message["content"].encode("utf-8")) for message in messages)
+
+    @staticmethod
+    def _message_dict(row: tuple) -> dict:
+        role, content, tokens = row
+        if tokens is None:
+            return {"role": role, "content": content}
+        return {"role": role, "content": content, "tokens": tokens}
+
+    def _write_header(self, name: str, generation: str, header: dict, messages: int, message_bytes: int) -> None:
+        """Writes the save's row. Its file_size is the bytes of the header and of the messages in full_chat_log, encoded as UTF-8"""
+        chat_log = _chat_log_dict(header)
+        metadata = chat_log.get("metadata", {})
+        kind = "chat_log" if chat_log is header else "chat_wrapper"
+        header_json = json.dumps(header)
+        self._connection.execute(
+            "INSERT OR REPLACE INTO saves VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (name, generation, header_json, len(header_json.encode("utf-8")) + message_bytes, kind, metadata.get("uuid"), chat_log.get("model"), messages, metadata.get("date")),
+        )
+
+    def save(self, name: str, save_dict: dict) -> str:
+        """Replaces the save with the name, returns its new generation"""
+        header, chat_log = self._split(save_dict)
+        full_chat_log = chat_log["full_chat_log"]
+        if isinstance(full_chat_log, StoredHistory):
+            # the rows may be the ones about to be replaced
+            full_chat_log = list(full_chat_log)
+        generation = str(uuid.uuid4())
+        with self._transaction():
+            self._connection.execute("DELETE FROM messages WHERE name = ?", (name,))
+            self._connection.executemany("INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?)", self._rows(name, 0, full_chat_log))
+            self._connection.executemany("INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?)", self._rows(name, 1, chat_log["trimmed_chat_log"]))
+            self._write_header(name, generation, header, len(full_chat_log), self._message_bytes(full_chat_log))
+            # the messages aren't known here, save_chat remembers them if it called this
+            self._written.pop(name, None)
+        return generation
+
+    def _stored_prefix(self, history, length: int, name: str) -> Optional[tuple]:
+        """Returns (number of messages, generation) if the first messages of history are rows of the save with the name, otherwise None.
+        They are if history starts with the message objects save_chat last wrote to the save, or if it was loaded from the save"""
+        with self._lock:
+            written = self._written.get(name)
+        if written is not None:
+            generation, stored, first_message, last_message = written
+            # a history is only appended to, so holding the same objects at both ends means holding the ones between. Holding on to them keeps spilled ones alive, so they are read back as the same objects
+            if stored <= length and history[0] is first_message and history[stored - 1] is last_message:
+                return stored, generation
+        while isinstance(history, ForkedHistory):
+            length = min(length, history.length)
+            history = history.base
+        if not isinstance(history, StoredHistory) or history.storage is not self or history.name != name:
+            return None
+        return min(length, history.length), history.generation
+
+    def save_chat(self, name: str, chat_log, wrap: Callable[[dict], dict] = None) -> None:
+        history = chat_log.full_chat_log
+        length = len(history)
+        stored = self._stored_prefix(history, length, name) if length else None
+        if stored is None:
+            save_dict = chat_log.make_save_dict(sized=False)
+            generation = self.save(name, wrap(save_dict) if wrap is not None else save_dict)
+        else:
+            start, generation = stored
+            save_dict = chat_log.save_to_dict.save(sized=False, start=start)
+            self._append(name, wrap(save_dict) if wrap is not None else save_dict, start, generation)
+        if length:
+            first_message, last_message = history[0], history[length - 1]
+            with self._lock:
+                self._written[name] = (generation, length, first_message, last_message)
+
+    def _append(self, name: str, save_dict: dict, start: int, generation: str) -> None:
+        """Appends the messages of save_dict's full_chat_log, which start at position start, and replaces the window and the rest of the save"""
+        header, chat_log = self._split(save_dict)
+        new_messages = chat_log["full_chat_log"]
+        with self._transaction():
+            row = self._connection.execute("SELECT generation, messages, file_size, header FROM saves WHERE name = ?", (name,)).fetchone()
+            if row is None or row[0] != generation:
+                raise StorageConflictError(f"The save {name} was replaced or deleted since it was loaded")
+            stored_generation, stored, file_size, stored_header = row
+            # messages another save of this chat log (ie an autosave of a fork) already appended
+            overlap = stored - start
+            if overlap < 0 or overlap > len(new_messages):
+                raise StorageConflictError(f"The save {name} has messages this chat log doesn't have")
+            if overlap > 0:
+                rows = self._connection.execute(
+                    "SELECT role, content FROM messages WHERE name = ? AND list = 0 AND position >= ? ORDER BY position", (name, start)
+                ).fetchall()
+                if rows != [(message["role"], message["content"]) for message in new_messages[:overlap]]:
+                    raise StorageConflictError(f"Other messages were added to the save {name} since it was loaded")
+            appended = new_messages[overlap:]
+            self._connection.executemany("INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?)", self._rows(name, 0, appended, stored))
+            self._connection.execute("DELETE FROM messages WHERE name = ? AND list = 1", (name,))
+            self._connection.executemany("INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?)", self._rows(name, 1, chat_log["trimmed_chat_log"]))
+            message_bytes = file_size - len(stored_header.encode("utf-8")) + self._message_bytes(appended)
+            self._write_header(name, generation, header, stored + len(appended), message_bytes)
+
+    def _read_messages(self, name: str, generation: str, start: int, stop: int) -> List[dict]:
+        with self._lock:
+            row = self._connection.execute("SELECT generation FROM saves WHERE name = ?", (name,)).fetchone()
+            if row is None or row[0] != generation:
+                raise StorageConflictError(f"The save {name} was replaced or deleted since it was loaded")
+            rows = self._connection.execute(
+                "SELECT role, content, tokens FROM messages WHERE name = ? AND list = 0 AND position >= ? AND position < ? ORDER BY position",
+                (name, start, stop),
+            ).fetchall()
+        return [self._message_dict(row) for row in rows]
+
+    def load(self, name: str) -> Optional[dict]:
+        """Returns the save dict with its window, full_chat_log is a StoredHistory of message dicts that reads the rows when they are needed"""
+        with self._lock:
+            row = self._connection.execute("SELECT header, generation, messages FROM saves WHERE name = ?", (name,)).fetchone()
+            if row is None:
+                return None
+            window = self._connection.execute(
+                "SELECT role, content, tokens FROM messages WHERE name = ? AND list = 1 ORDER BY position", (name,)
+            ).fetchall()
+        header, generation, messages = row
+        save_dict = json.loads(header)
+        chat_log = _chat_log_dict(save_dict)
+        chat_log["full_chat_log"] = StoredHistory(self, name, generation, messages)
+        chat_log["trimmed_chat_log"] = [self._message_dict(message) for message in window]
+        return save_dict
+
+    def exists(self, name: str) -> bool:
+        with self._lock:
+            return self._connection.execute("SELECT 1 FROM saves WHERE name = ?", (name,)).fetchone() is not None
+
+    def delete(self, name: str) -> bool:
+        with self._transaction():
+            self._connection.execute("DELETE FROM messages WHERE name = ?", (name,))
+            deleted = self._connection.execute("DELETE FROM saves WHERE name = ?", (name,)).rowcount
+            self._written.pop(name, None)
+        return deleted > 0
+
+    def list_saves(
+        self,
+        sort_by: str = "name",
+        reverse: bool = False,
+        model: str = None,
+        min_messages: int = None,
+        name_contains: str = None,
+    ) -> List[dict]:
+        """Returns the metadata of the saves, see SaveCatalog.list_saves. file_size is the number of bytes of the save's header and messages, encoded as UTF-8"""
+        query, params = list_query("saves", self.columns, self.sort_columns, sort_by, reverse, model, min_messages, name_contains)
+        with self._lock:
+            rows = self._connection.execute(query, params).fetchall()
+        return [dict(zip(self.columns, row)) for row in rows]
+
+    def __repr__(self):
+        return f"SQLiteStorage(path={self.path!r})"
+
+
+class _Transaction:
+    """Holds the storage lock and runs a BEGIN IMMEDIATE transaction, committed on success and rolled back on an error"""
+
+    def __init__(self, connection: sqlite3.Connection, lock):
+        self.connection = connection
+        self.lock = lock
+
+    def __enter__(self):
+        self.lock.acquire()
+        try:
+            self.connection.execute("BEGIN IMMEDIATE")
+        except BaseException:
+            self.lock.release()
+            raise
+        return self.connection
+
+    def __exit__(self, exc_type, exc, traceback):
+        try:
+            self.connection.execute("COMMIT" if exc_type is None else "ROLLBACK")
+        finally:
+            self.lock.release()
+        return False
+
+
+# one SQLiteStorage per database, so every wrapper in the process shares its connection and lock. Closing it from one wrapper only closes the connection until the next use
+_sqlite_storages = {}
+_sqlite_storages_lock = threading.Lock()
+
+storage_names = ("json", "sqlite")
+
+
+def make_storage(storage=None, folder: str = "chatbot_saves") -> StorageBackend:
+    """Returns the storage backend for storage, which can be a StorageBackend, None or "json" for JSONStorage in folder, or "sqlite" for the SQLiteStorage in <folder>/saves.sqlite3"""
+    if isinstance(storage, StorageBackend):
+        return storage
+    if storage is None or storage == "json":
+        return JSONStorage(folder)
+    if storage == "sqlite":
+        path = os.path.abspath(os.path.join(folder, SQLiteStorage.file_name))
+        with _sqlite_storages_lock:
+            if path not in _sqlite_storages:
+                _sqlite_storages[path] = SQLiteStorage(path)
+            return _sqlite_storages[path]
+    raise StorageError(f"Unknown storage {storage!r}, must be one of {storage_names} or a StorageBackend")
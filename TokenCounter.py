@@ -0,0 +1,316 @@
+import atexit
+import hashlib
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import tiktoken
+
+
+class TokenCountCache:
+    """
+    A bounded LRU cache of token counts, keyed by (encoding name, content hash), so the same content is never run through the BPE twice
+    Can optionally be backed by a SQLite file, so counts survive restarts. Writes to the store are batched and flushed every `flush_every` new counts, and when the program exits
+    Attributes:
+        max_size (int): Maximum number of counts kept in memory, least recently used counts are dropped first
+        min_length (int): Strings shorter than this are cheaper to encode than to hash, so they are not cached
+        store_path (str): Path to the SQLite store, None if the cache is memory only
+        hits (int), misses (int): Cache stats, a hit from the store counts as a hit
+    Methods:
+        hash_content(content: str) -> str: Hashes a string for use as a cache key
+        get(encoding_name: str, content: str) -> int | None: Returns the cached count, or None
+        set(encoding_name: str, content: str, tokens: int): Caches a count
+        attach_store(path: str): Backs the cache with a SQLite file, creating it if needed
+        detach_store(): Flushes and closes the SQLite store
+        flush(): Writes any pending counts to the store
+        stats() -> dict: Returns the cache stats
+        clear(): Empties the in memory cache and resets the stats (the store is left alone)
+    Example Usage:
+        cache = TokenCountCache(max_size=10_000)
+        cache.attach_store("chatbot_saves/token_counts.sqlite3")
+        cache.set("cl100k_base", content, 12)
+        cache.get("cl100k_base", content)
+    """
+
+    def __init__(self, max_size: int = 50_000, min_length: int = 32, store_path: str = None, flush_every: int = 256):
+        if max_size < 1:
+            raise ValueError("max_size must be at least 1")
+        self.max_size = max_size
+        self.min_length = min_length
+        self.flush_every = flush_every
+        self._counts: "OrderedDict[Tuple[str, str], int]" = OrderedDict()
+        self._pending: List[Tuple[str, str, int]] = []
+        self._lock = threading.RLock()
+        self._connection: Optional[sqlite3.Connection] = None
+        self.store_path = None
+        self.hits = 0
+        self.misses = 0
+        if store_path is not None:
+            self.attach_store(store_path)
+
+    @staticmethod
+    def hash_content(content: str) -> str:
+        """Hashes a string for use as a cache key"""
+        return hashlib.blake2b(content.encode("utf-8"), digest_size=16).hexdigest()
+
+    def is_cacheable(self, content: str) -> bool:
+        return len(content) >= self.min_length
+
+    def get(self, encoding_name: str, content: str) -> Optional[int]:
+        """Returns the cached token count for the content, checking the store if it isn't in memory. Returns None if the count isn't cached"""
+        key = (encoding_name, self.hash_content(content))
+        with self._lock:
+            tokens = self._counts.get(key)
+            if tokens is not None:
+                self._counts.move_to_end(key)
+                self.hits += 1
+                return tokens
+            if self._connection is not None:
+                row = self._connection.execute(
+                    "SELECT tokens FROM token_counts WHERE encoding = ? AND hash = ?", key
+                ).fetchone()
+                if row is not None:
+                    self._remember(key, row[0])
+                    self.hits += 1
+                    return row[0]
+            self.misses += 1
+            return None
+
+    def set(self, encoding_name: str, content: str, tokens: int) -> None:
+        """Caches a token count, and queues it to be written to the store if there is one"""
+        key = (encoding_name, self.hash_content(content))
+        with self._lock:
+            self._remember(key, tokens)
+            if self._connection is not None:
+                self._pending.append((key[0], key[1], tokens))
+                if len(self._pending) >= self.flush_every:
+                    self.flush()
+
+    def _remember(self, key: Tuple[str, str], tokens: int) -> None:
+        self._counts[key] = tokens
+        self._counts.move_to_end(key)
+        while len(self._counts) > self.max_size:
+            self._counts.popitem(last=False)
+
+    def attach_store(self, path: str) -> None:
+        """Backs the cache with a SQLite file, creating the file (and its folder) if needed"""
+        self.detach_store()
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        with self._lock:
+            self._connection = sqlite3.connect(path, check_same_thread=False)
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS token_counts (encoding TEXT NOT NULL, hash TEXT NOT NULL, tokens INTEGER NOT NULL, PRIMARY KEY (encoding, hash))"
+            )
+            self._connection.commit()
+            self.store_path = path
+
+    def detach_store(self) -> None:
+        """Flushes and closes the SQLite store, if there is one"""
+        with self._lock:
+            if self._connection is None:
+                return
+            self.flush()
+            self._connection.close()
+            self._connection = None
+            self.store_path = None
+
+    def flush(self) -> None:
+        """Writes any pending counts to the store"""
+        with self._lock:
+            if self._connection is None or not self._pending:
+                return
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO token_counts (encoding, hash, tokens) VALUES (?, ?, ?)", self._pending
+            )
+            self._connection.commit()
+            self._pending = []
+
+    def stats(self) -> dict:
+        """Returns the cache stats"""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._counts),
+            "max_size": self.max_size,
+            "store_path": self.store_path,
+        }
+
+    def clear(self) -> None:
+        """Empties the in memory cache and resets the stats, the store is left alone"""
+        with self._lock:
+            self._counts = OrderedDict()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self._counts)
+
+
+class TokenizerRegistry:
+    """
+    A process wide registry of tiktoken encodings, so each model is only resolved to an encoding once
+    Every token counting path (Message, EncodeMessage, count_tokens) goes through the shared `tokenizer_registry` instance at the bottom of this file
+    Counts are looked up in a TokenCountCache first, if one is given
+    Attributes:
+        aliases (dict): Model names that tiktoken does not know about, mapped to an encoding name (ie gpt-35-turbo -> cl100k_base)
+        cache (TokenCountCache): Cache of token counts shared by every model, None to always encode
+        hits (int): Number of lookups that were served from the registry
+        misses (int): Number of lookups that had to resolve the model with tiktoken
+    Methods:
+        add_alias(model: str, encoding_name: str): Adds a model alias, and forgets any encoding already resolved for that model
+        encoding_name_for_model(model: str) -> str: Returns the name of the encoding used by a model, raises KeyError if the model is unknown
+        get_encoding(model: str) -> tiktoken.Encoding: Returns the encoding for a model, resolving it on the first call
+        fingerprint(model: str) -> str: Returns a string identifying the encoding a model uses, for use in save files
+        preload(models: Iterable[str]) -> list: Resolves a group of models ahead of time, returns the models that were loaded
+        count_tokens(string: str, model: str) -> int: Counts the tokens in a string
+        count_tokens_batch(strings: list, model: str, num_threads: int = 8) -> list: Counts the tokens in many strings at once, using tiktoken's threaded batch encoder
+        stats() -> dict: Returns the hit/miss stats, as well as the models and encodings that have been loaded
+        clear(): Forgets every resolved model and resets the stats
+    Example Usage:
+        tokenizer_registry.preload(["gpt-4", "gpt-35-turbo"])
+        tokenizer_registry.count_tokens("Hello, how are you?", "gpt-4")
+        tokenizer_registry.stats()
+    """
+
+    default_aliases = {
+        "gpt-35-turbo": "cl100k_base",
+    }
+    # below this many characters, count_tokens_batch doesn't bother with threads
+    batch_min_chars = 50_000
+
+    def __init__(self, aliases: dict = None, cache: TokenCountCache = None):
+        self.cache = cache
+        self.aliases = dict(self.default_aliases)
+        if aliases is not None:
+            self.aliases.update(aliases)
+        self._encodings: Dict[str, tiktoken.Encoding] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def add_alias(self, model: str, encoding_name: str) -> None:
+        """Adds a model alias, and forgets any encoding already resolved for that model"""
+        with self._lock:
+            self.aliases[model] = encoding_name
+            self._encodings.pop(model, None)
+
+    def encoding_name_for_model(self, model: str) -> str:
+        """Returns the name of the encoding used by a model, same rules as tiktoken.encoding_for_model, but aliases are checked first"""
+        if model in self.aliases:
+            return self.aliases[model]
+        if model in tiktoken.model.MODEL_TO_ENCODING:
+            return tiktoken.model.MODEL_TO_ENCODING[model]
+        for model_prefix, encoding_name in tiktoken.model.MODEL_PREFIX_TO_ENCODING.items():
+            if model.startswith(model_prefix):
+                return encoding_name
+        raise KeyError(
+            f"Could not automatically map {model} to a tokeniser. "
+            "Add an alias to the tokenizer registry with add_alias(model, encoding_name)."
+        )
+
+    def get_encoding(self, model: str) -> tiktoken.Encoding:
+        """Returns the encoding for a model, only resolving it with tiktoken the first time the model is seen"""
+        encoding = self._encodings.get(model)
+        if encoding is not None:
+            self.hits += 1
+            return encoding
+        with self._lock:
+            encoding = self._encodings.get(model)
+            if encoding is None:
+                encoding = tiktoken.get_encoding(self.encoding_name_for_model(model))
+                self.misses += 1
+                self._encodings[model] = encoding
+            else:
+                self.hits += 1
+        return encoding
+
+    def fingerprint(self, model: str) -> str:
+        """Returns a string identifying the encoding a model uses, stored alongside saved token counts so they are only trusted by the same encoding"""
+        encoding = self.get_encoding(model)
+        return f"{encoding.name}:{encoding.n_vocab}"
+
+    def preload(self, models: Iterable[str]) -> List[str]:
+        """Resolves a group of models ahead of time (ie at startup). Models that can't be mapped to an encoding are skipped. Returns the models that were loaded"""
+        loaded = []
+        for model in models:
+            try:
+                self.get_encoding(model)
+            except KeyError:
+                continue
+            loaded.append(model)
+        return loaded
+
+    def count_tokens(self, string: str, model: str) -> int:
+        """Counts the tokens in a string, using the cache if there is one"""
+        encoding = self.get_encoding(model)
+        if self.cache is None or not self.cache.is_cacheable(string):
+            return len(encoding.encode(string))
+        tokens = self.cache.get(encoding.name, string)
+        if tokens is None:
+            tokens = len(encoding.encode(string))
+            self.cache.set(encoding.name, string, tokens)
+        return tokens
+
+    def count_tokens_batch(self, strings: List[str], model: str, num_threads: int = 8) -> List[int]:
+        """Counts the tokens in each string. Repeated strings are only encoded once, and strings that aren't cached are encoded together with tiktoken's batch encoder, across up to num_threads threads
+        Threads only pay off with more than one CPU and a decent amount of text, otherwise the strings are encoded one after another"""
+        encoding = self.get_encoding(model)
+        counts: Dict[str, int] = {}
+        to_encode = []
+        for string in strings:
+            if string in counts:
+                continue
+            tokens = None
+            if self.cache is not None and self.cache.is_cacheable(string):
+                tokens = self.cache.get(encoding.name, string)
+            if tokens is None:
+                to_encode.append(string)
+                # placeholder so duplicates are skipped, filled in below
+                counts[string] = -1
+            else:
+                counts[string] = tokens
+        if to_encode:
+            num_threads = min(num_threads, os.cpu_count() or 1)
+            if num_threads > 1 and len(to_encode) > 1 and sum(len(string) for string in to_encode) >= self.batch_min_chars:
+                encoded_counts = [len(tokens) for tokens in encoding.encode_batch(to_encode, num_threads=num_threads)]
+            else:
+                encoded_counts = [len(encoding.encode(string)) for string in to_encode]
+            for string, tokens in zip(to_encode, encoded_counts):
+                counts[string] = tokens
+                if self.cache is not None and self.cache.is_cacheable(string):
+                    self.cache.set(encoding.name, string, tokens)
+        return [counts[string] for string in strings]
+
+    def stats(self) -> dict:
+        """Returns the hit/miss stats, as well as the models and encodings that have been loaded"""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "models": sorted(self._encodings.keys()),
+            "encodings": sorted({encoding.name for encoding in self._encodings.values()}),
+        }
+
+    def clear(self) -> None:
+        """Forgets every resolved model and resets the stats"""
+        with self._lock:
+            self._encodings = {}
+            self.hits = 0
+            self.misses = 0
+
+    def __repr__(self):
+        return f"TokenizerRegistry(aliases={self.aliases})\n{self.stats()}"
+
+
+token_count_cache = TokenCountCache()
+# make sure batched counts reach the store, if one was attached
+atexit.register(token_count_cache.flush)
+tokenizer_registry = TokenizerRegistry(cache=token_count_cache)
+
+
+def count_tokens(string: str, model: str) -> int:
+    """Counts the tokens in a string using the shared tokenizer registry"""
+    return tokenizer_registry.count_tokens(string, model)
@@ -0,0 +1,169 @@
+from typing import Dict, Iterable, Iterator, Tuple, Type
+
+
+class TrimPolicyError(Exception):
+    """Raised when a trimming policy name or its options are not valid"""
+    pass
+
+
+class TrimPolicy:
+    """
+    Base class for the trimming policies a ChatLog uses to decide which messages to evict from its trimmed chat log
+    A policy sorts the messages with the default priority into lanes, and the trimmed chat log keeps a queue of positions for each lane (see TrimmedWindow.py). Messages are only ever evicted from the front of a lane, oldest first, so a policy never has to look through the window for its next message:
+        lanes: The policy's lanes in the order they are evicted from. A lane is only evicted from once the lanes before it are empty
+        lane(chat_log, position, message): Returns the lane of a message
+        evict(chat_log, lane): Evicts the next message from lane, through chat_log.evict_from_window(lane), which keeps the token count and API payload in step
+        select_window(chat_log, token_budget, message_budget): Called when the window has to be worked out from scratch, such as when the budget grows. Returns the positions in full_chat_log to keep, oldest first, the tokens they hold, and whether every message with the default priority was kept
+    Messages with a priority (see ChatLog.set_message_priority) are kept in their own lanes by the chat log, lower priorities evicted before the policy's lanes and higher priorities after, so pins work the same under every policy
+    Policies keep no state of their own, everything they need is in the chat log and its window
+    Attributes:
+        name (str): The name used to select the policy, in the ChatLog constructor or a template's chat_log settings
+        options (dict): The options the policy was made with
+        protected_lanes (tuple): Lanes the policy keeps messages in for longer than their age alone would, rather than evicting them in the order they were added
+    Example Usage:
+        chat_log = ChatLog(trim_policy="pairs")
+        chat_log = ChatLog(trim_policy="keep_first", trim_policy_options={"count": 2})
+    """
+    name = None
+    lanes = ("default",)
+    protected_lanes = ()
+
+    def __init__(self, **options):
+        self.options = options
+
+    def lane(self, chat_log, position: int, message) -> str:
+        return "default"
+
+    def evict(self, chat_log, lane: str) -> None:
+        chat_log.evict_from_window(lane)
+
+    def lane_messages(self, chat_log, lane: str) -> Iterator[tuple]:
+        """Returns an iterator over the position and message of every message with the default priority in lane, newest first, reading back from the end of full_chat_log only as far as it is iterated"""
+        return chat_log.iter_default_messages(keep=lambda position, message: self.lane(chat_log, position, message) == lane)
+
+    def select_window(self, chat_log, token_budget: int, message_budget: int) -> Tuple[Iterable[int], int, bool]:
+        """Keeps the newest messages of each lane, from the lane evicted last to the lane evicted first, and stops at the first message that doesn't fit, since everything evicted before it would be gone first"""
+        kept = []
+        tokens = 0
+        for lane in reversed(self.lanes):
+            for position, message in self.lane_messages(chat_log, lane):
+                if tokens + message.tokens > token_budget or len(kept) >= message_budget:
+                    kept.sort()
+                    return kept, tokens, False
+                kept.append(position)
+                tokens += message.tokens
+        kept.sort()
+        return kept, tokens, True
+
+    @staticmethod
+    def message_budget(chat_log) -> int:
+        """Returns max_chat_messages, or the length of the chat log if there is no limit"""
+        if chat_log.max_chat_messages is None:
+            return len(chat_log.full_chat_log)
+        return chat_log.max_chat_messages
+
+    def __repr__(self):
+        options = ", ".join(f"{key}={value!r}" for key, value in self.options.items())
+        return f"{self.__class__.__name__}({options})"
+
+
+class FifoPolicy(TrimPolicy):
+    """Evicts the oldest message first, message count first and then tokens. This is the default"""
+    name = "fifo"
+
+    def select_window(self, chat_log, token_budget: int, message_budget: int) -> Tuple[Iterable[int], int, bool]:
+        if chat_log._priorities:
+            return super().select_window(chat_log, token_budget, message_budget)
+        # with only one lane the window is the end of full_chat_log, found by binary search over the token index
+        length = len(chat_log.full_chat_log)
+        start = chat_log.find_window_start(token_budget, message_budget)
+        return range(start, length), chat_log.count_window_tokens(start, length), start == 0
+
+
+class PairsPolicy(FifoPolicy):
+    """Evicts oldest first like fifo, but never leaves a reply at the start of the window without the message it answers.
+    Options:
+        reply_roles (list): Roles that are evicted along with the message before them, defaults to ["assistant"]
+    """
+    name = "pairs"
+
+    def __init__(self, reply_roles: list = None):
+        reply_roles = list(reply_roles) if reply_roles is not None else ["assistant"]
+        super().__init__(reply_roles=reply_roles)
+        self.reply_roles = frozenset(reply_roles)
+
+    def evict(self, chat_log, lane: str) -> None:
+        chat_log.evict_from_window(lane)
+        window = chat_log.trimmed_chat_log
+        oldest = window.oldest(lane)
+        while oldest is not None and oldest[1].role in self.reply_roles:
+            chat_log.evict_from_window(lane)
+            oldest = window.oldest(lane)
+
+    def select_window(self, chat_log, token_budget: int, message_budget: int) -> Tuple[Iterable[int], int, bool]:
+        positions, tokens, complete = super().select_window(chat_log, token_budget, message_budget)
+        if complete:
+            return positions, tokens, complete
+        skipped = 0
+        while skipped < len(positions) and chat_log.full_chat_log[positions[skipped]].role in self.reply_roles:
+            tokens -= chat_log.full_chat_log[positions[skipped]].tokens
+            skipped += 1
+        return positions[skipped:], tokens, complete
+
+
+class KeepFirstPolicy(TrimPolicy):
+    """Keeps the first count messages of the chat log, such as a spec or instructions, and evicts the oldest of the rest first.
+    The first messages are only evicted, oldest first, if they don't fit in the budget on their own
+    Options:
+        count (int): How many messages at the start of the chat log to keep, defaults to 1
+    """
+    name = "keep_first"
+    lanes = ("rest", "first")
+    protected_lanes = ("first",)
+
+    def __init__(self, count: int = 1):
+        if not isinstance(count, int) or count < 0:
+            raise TrimPolicyError("keep_first count must be a positive integer")
+        super().__init__(count=count)
+        self.count = count
+
+    def lane(self, chat_log, position: int, message) -> str:
+        return "first" if position < self.count else "rest"
+
+    def lane_messages(self, chat_log, lane: str) -> Iterator[tuple]:
+        first = min(self.count, len(chat_log.full_chat_log))
+        if lane == "first":
+            return chat_log.iter_default_messages(first, 0)
+        return chat_log.iter_default_messages(stop=first)
+
+
+class RoleFirstPolicy(TrimPolicy):
+    """Evicts the oldest message with one of the given roles first, and only evicts other messages once none of those are left in the window.
+    Options:
+        roles (list): Roles to evict first, defaults to ["assistant"], so the user's messages are kept the longest
+    """
+    name = "role_first"
+    lanes = ("roles", "other")
+
+    def __init__(self, roles: list = None):
+        roles = list(roles) if roles is not None else ["assistant"]
+        super().__init__(roles=roles)
+        self.roles = frozenset(roles)
+
+    def lane(self, chat_log, position: int, message) -> str:
+        return "roles" if message.role in self.roles else "other"
+
+
+trim_policies: Dict[str, Type[TrimPolicy]] = {
+    policy.name: policy for policy in (FifoPolicy, PairsPolicy, KeepFirstPolicy, RoleFirstPolicy)
+}
+
+
+def make_trim_policy(name: str = "fifo", options: dict = None) -> TrimPolicy:
+    """Makes a trimming policy from its name and options, raises TrimPolicyError if either is not valid"""
+    if name not in trim_policies:
+        raise TrimPolicyError(f"Unknown trim policy '{name}', must be one of {sorted(trim_policies)}")
+    try:
+        return trim_policies[name](**(options or {}))
+    except TypeError as e:
+        raise TrimPolicyError(f"Bad options for trim policy '{name}': {e}")
@@ -0,0 +1,125 @@
+from collections import OrderedDict, deque
+from itertools import islice
+from typing import Iterator, List, Tuple
+
+
+class TrimmedWindow:
+    """
+    A deque-like trimmed_chat_log for a ChatLog, that knows the position in full_chat_log of every message in it
+    The messages and their API dicts are kept in order in OrderedDicts keyed by position, so a message can be taken out of any part of the window in O(1) and iterating stays in order.
+    Each message is also put in a lane, a deque of positions oldest first. Messages that are evicted in a different order go in different lanes (ie a pinned message, or keep_first's first messages), and messages only ever leave from the front of a lane, so picking and removing the next message to evict is O(1)
+    New messages must come after every message already in the window, which holds for appending to full_chat_log. Anything else (a rebuild, a load) makes a new window
+    Supports len, indexing, iteration, reversed and comparing with a list or deque of messages, which is everything the old deque was used for
+    Attributes:
+        lanes (dict): lane -> deque of the positions in that lane, oldest first. Empty lanes are removed
+    Methods:
+        add(position, message, lane): Adds a message after every message in the window
+        evict(lane) -> (position, message): Removes the oldest message in lane
+        oldest(lane) -> (position, message): Returns the oldest message in lane without removing it, or None
+        positions(): The positions of the messages, oldest first, as a view that can also be used for membership tests
+        position_list() -> list: The positions as a list, kept until the window changes, for binary searches
+        payload(): The API dicts of the messages, oldest first
+        replace_messages(replace): Replaces every message with replace(message), for a chat log that copies its messages
+        copy() -> TrimmedWindow: Returns a copy, for a fork
+    Example Usage:
+        chat_log.trimmed_chat_log[0], len(chat_log.trimmed_chat_log), list(chat_log.trimmed_chat_log)
+    """
+
+    def __init__(self):
+        self._messages: "OrderedDict[int, object]" = OrderedDict()
+        self._payload: "OrderedDict[int, dict]" = OrderedDict()
+        self.lanes = {}
+        self._position_list = None
+
+    def add(self, position: int, message, lane) -> None:
+        self._messages[position] = message
+        self._payload[position] = dict(message)
+        positions = self.lanes.get(lane)
+        if positions is None:
+            positions = self.lanes[lane] = deque()
+        positions.append(position)
+        self._position_list = None
+
+    def evict(self, lane) -> Tuple[int, object]:
+        """Removes the oldest message in lane and returns its position and the message"""
+        positions = self.lanes[lane]
+        position = positions.popleft()
+        if not positions:
+            del self.lanes[lane]
+        del self._payload[position]
+        self._position_list = None
+        return position, self._messages.pop(position)
+
+    def oldest(self, lane) -> Tuple[int, object]:
+        """Returns the position and message of the oldest message in lane, or None if the lane is empty"""
+        positions = self.lanes.get(lane)
+        if not positions:
+            return None
+        return positions[0], self._messages[positions[0]]
+
+    def lane_size(self, lane) -> int:
+        positions = self.lanes.get(lane)
+        return len(positions) if positions is not None else 0
+
+    def positions(self):
+        return self._messages.keys()
+
+    def position_list(self) -> List[int]:
+        if self._position_list is None:
+            self._position_list = list(self._messages)
+        return self._position_list
+
+    def payload(self):
+        return self._payload.values()
+
+    def replace_messages(self, replace) -> None:
+        for position, message in self._messages.items():
+            self._messages[position] = replace(message)
+
+    def copy(self) -> "TrimmedWindow":
+        window = TrimmedWindow()
+        window._messages = self._messages.copy()
+        window._payload = self._payload.copy()
+        window.lanes = {lane: deque(positions) for lane, positions in self.lanes.items()}
+        return window
+
+    def __len__(self) -> int:
+        return len(self._messages)
+
+    def __bool__(self) -> bool:
+        return bool(self._messages)
+
+    def __iter__(self) -> Iterator:
+        return iter(self._messages.values())
+
+    def __reversed__(self) -> Iterator:
+        return reversed(self._messages.values())
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(self)[index]
+        length = len(self._messages)
+        if index < 0:
+            index += length
+        if not 0 <= index < length:
+            raise IndexError("window index out of range")
+        if index == 0:
+            return next(iter(self._messages.values()))
+        if index == length - 1:
+            return next(reversed(self._messages.values()))
+        if index < length // 2:
+            return next(islice(iter(self._messages.values()), index, None))
+        return next(islice(reversed(self._messages.values()), length - 1 - index, None))
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, TrimmedWindow):
+            return list(self) == list(other)
+        if isinstance(other, (list, deque, tuple)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        lanes = ", ".join(f"{lane!r}: {len(positions)}" for lane, positions in self.lanes.items())
+        return f"TrimmedWindow(messages={len(self)}, lanes={{{lanes}}})"
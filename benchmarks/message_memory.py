@@ -0,0 +1,51 @@
+"""
+Compares the memory used by Message and CompactMessage, using the short_2000_messages.json test chat log
+Run from the root of the project with:
+    python -m benchmarks.message_memory
+"""
+import gc
+import json
+import tracemalloc
+
+from ChatHistory import CompactMessage, Message
+
+
+def load_fixture(name: str = "short_2000_messages.json") -> list[dict]:
+    with open(f"test_chat_logs/{name}", "r") as f:
+        return json.load(f)
+
+
+def measure(message_class: type, messages: list[dict], count_tokens: bool) -> int:
+    """Returns the number of bytes allocated while building one message_class per message dict"""
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    built = [message_class(message["role"], message["content"], "gpt-4") for message in messages]
+    if count_tokens:
+        for message in built:
+            message.tokens
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del built
+    return after - before
+
+
+def main():
+    messages = load_fixture()
+    # make sure the tokenizer and the token count cache are loaded, so they are not counted as part of the first class measured
+    measure(Message, messages, count_tokens=True)
+    print(f"{len(messages)} messages from short_2000_messages.json (content strings are shared, so only the per message overhead is measured)")
+    print(f"{'class':<16}{'tokens':<10}{'total bytes':>14}{'bytes/message':>16}")
+    for count_tokens in (False, True):
+        results = {}
+        for message_class in (Message, CompactMessage):
+            size = measure(message_class, messages, count_tokens)
+            results[message_class.__name__] = size
+            label = "counted" if count_tokens else "lazy"
+            print(f"{message_class.__name__:<16}{label:<10}{size:>14,}{size / len(messages):>16.1f}")
+        saving = 1 - results["CompactMessage"] / results["Message"]
+        print(f"CompactMessage saves {saving:.0%}")
+
+
+if __name__ == "__main__":
+    main()
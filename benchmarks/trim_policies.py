@@ -0,0 +1,55 @@
+"""
+Compares the trimming policies in TrimPolicies.py on the test_chat_logs fixtures
+For each policy and fixture it times adding every message one at a time (so trim runs after each one) and rebuilding the window after the budget grows
+Run from the root of the project with:
+    python -m benchmarks.trim_policies
+"""
+import json
+import os
+import time
+
+from ChatHistory import ChatLog
+from TrimPolicies import trim_policies
+
+FIXTURE_FOLDER = "test_chat_logs"
+# each fixture is added this many times, so the chat log is long enough for the per message cost to show
+REPEATS = 20
+
+
+def load_fixtures() -> dict[str, list[dict]]:
+    fixtures = {}
+    for file_name in sorted(os.listdir(FIXTURE_FOLDER)):
+        if file_name.endswith(".json"):
+            with open(os.path.join(FIXTURE_FOLDER, file_name), "r") as f:
+                fixtures[file_name[:-5]] = json.load(f)
+    return fixtures
+
+
+def run(policy_name: str, messages: list[dict]) -> tuple[float, float, int]:
+    """Returns the seconds per added message, the seconds for one rebuild, and the final window length"""
+    chat_log = ChatLog(max_model_tokens=8000, max_chat_messages=200, trim_policy=policy_name)
+    chat_log.sys_prompt = "You are a helpful AI assistant"
+    # count the tokens first, so only trimming is timed
+    chat_log.count_message_tokens([chat_log.make_message(message=message) for message in messages])
+    start = time.perf_counter()
+    for message in messages:
+        chat_log.add_message(message=message)
+    add_time = (time.perf_counter() - start) / len(messages)
+    start = time.perf_counter()
+    chat_log.max_model_tokens = 16000
+    rebuild_time = time.perf_counter() - start
+    return add_time, rebuild_time, len(chat_log.trimmed_chat_log)
+
+
+def main():
+    fixtures = load_fixtures()
+    print(f"{'fixture':<28}{'policy':<12}{'messages':>10}{'us/add':>10}{'rebuild ms':>12}{'window':>8}")
+    for fixture_name, fixture in fixtures.items():
+        messages = fixture * REPEATS
+        for policy_name in trim_policies:
+            add_time, rebuild_time, window = run(policy_name, messages)
+            print(f"{fixture_name:<28}{policy_name:<12}{len(messages):>10}{add_time * 1e6:>10.1f}{rebuild_time * 1e3:>12.2f}{window:>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -13,8 +13,10 @@ import from_file.from_file as ff
 import misc.MyStuff as ms
 import object_factory as fact
 from ExportChatLogs import export_chat_menu
+from SaveCatalog import format_save_info
 from settings import (API_KEY, BYPASS_MAIN_MENU, DEFAULT_MODEL,
                       DEFAULT_TEMPLATE_NAME)
+from StorageBackends import StorageConflictError
 
 def get_default_template_for_model(model: str) -> str:
     if model == "gpt-3":
@@ -612,7 +614,8 @@ class ChatLoop:
             f"Type {ms.yellow('quicksys')} to load or change a system prompt without saving",
             f"Type {ms.yellow('sysmanage')} to access the System Prompt Manager Menu",
             f"Type {ms.yellow('export')} to export the chat log to a text file(experimental). Save the chat log first!",
-            f"Type {ms.yellow('print')} to print the full chat log to the console. "
+            f"Type {ms.yellow('print')} to print the full chat log to the console. ",
+            f"Type {ms.yellow('pin')} to pin your last message so it is kept in the context for as long as possible (useful after from_file), or {ms.yellow('unpin')} to unpin all messages",
         ]
 
         message = "\n".join(msg_list)
@@ -633,6 +636,9 @@ class ChatLoop:
             if ans_lower in ("quit", "exit", "q"):
                 if confirm("Are you sure you want to quit?"):
                     print("Quitting...")
+                    if self.chat_wrapper.autosaver is not None:
+                        # writes the last turns before the wrapper is dropped
+                        self.chat_wrapper.disable_autosave()
                     break
             elif ms.xy(ans_lower):
                 pass
@@ -703,6 +709,15 @@ class ChatLoop:
                 print(self.chat_wrapper.__repr__())
             elif ans_lower in ("print", "pr"):
                 print(self.chat_wrapper.chat_log.get_pretty_messages())
+            elif ans_lower == "pin":
+                if self.chat_wrapper.chat_log.pin_last_message("user"):
+                    print("Your last message has been pinned.")
+                else:
+                    print("There is no message to pin yet.")
+            elif ans_lower == "unpin":
+                for position in self.chat_wrapper.chat_log.get_pinned_positions():
+                    self.chat_wrapper.chat_log.unpin_message(position)
+                print("All messages have been unpinned.")
 
             elif ans_lower in ("quicksys", "qsys"):
                 print("Entering the quick system prompt menu...")
@@ -760,9 +775,11 @@ class ChatLoop:
             "Type help to see this message again",
             "Type list to see a list of files in the current directory",
         ]
-        file_list = self.chat_wrapper.save_and_load.get_files(remove_path=True)
+        # newest first, with the metadata from the save catalog so no save has to be opened
+        saves = self.chat_wrapper.save_and_load.get_save_info(sort_by="saved_at", reverse=True)
+        file_list = [save["name"] for save in saves]
         files = "\n".join(
-            ["The following is a list of currently saved_files: "] + file_list
+            ["The following is a list of currently saved_files: "] + [format_save_info(save) for save in saves]
         )
         message = "\n".join(msg_list)
         print(message)
@@ -795,6 +812,10 @@ class ChatLoop:
                                     "Selected file was not found. If you believe this is an error, please contact the developer."
                                 )
                                 continue
+                        except StorageConflictError:
+                            print(
+                                f"The save {ans} was changed by another chat while it was loading. Please try loading it again."
+                            )
                         except Exception as e:
                             print(
                                 "An error occurred while loading the chat. Please try again."
@@ -829,24 +850,33 @@ class ChatLoop:
             elif ans.lower() in ("help", "h"):
                 print(msg)
             else:
-                if self.chat_wrapper.save(file_name=ans):
-                    print("Save successful!")
-                    print("Returning to main menu...")
-                    break
-                else:
-                    if confirm(
-                        f"File: {ans} already exists. Are you sure you want to overwrite it?"
-                    ):
-                        if self.chat_wrapper.save(file_name=ans, overwrite=True):
-                            print("Save successful!")
-                            print("Returning to main menu...")
-                            break
+                try:
+                    if self.chat_wrapper.save(file_name=ans):
+                        print("Save successful!")
+                        print("Returning to main menu...")
+                        break
+                    else:
+                        if confirm(
+                            f"File: {ans} already exists. Are you sure you want to overwrite it?"
+                        ):
+                            if self.chat_wrapper.save(file_name=ans, overwrite=True):
+                                print("Save successful!")
+                                print("Returning to main menu...")
+                                break
+                            else:
+                                print("Save failed. Please try again.")
+                                continue
                         else:
                             print("Save failed. Please try again.")
                             continue
-                    else:
-                        print("Save failed. Please try again.")
-                        continue
+                except StorageConflictError:
+                    print(
+                        f"The save {ans} was changed by another chat since this chat was loaded or last saved to it, so it was not overwritten."
+                    )
+                    print(
+                        f"Type another file name to keep both, or quit and load {ans} again to carry on from the other chat."
+                    )
+                    continue
 
     def modify_model_param_menu(self) -> None:
         """A menu for modifying model parameters"""
@@ -1177,9 +1207,11 @@ class MainMenu:
             "Type help to see this message again",
             "Type list to see a list of files in the current directory",
         ]
-        file_list = self.chat_wrapper.save_and_load.get_files(remove_path=True)
+        # newest first, with the metadata from the save catalog so no save has to be opened
+        saves = self.chat_wrapper.save_and_load.get_save_info(sort_by="saved_at", reverse=True)
+        file_list = [save["name"] for save in saves]
         files = "\n".join(
-            ["The following is a list of currently saved_files: "] + file_list
+            ["The following is a list of currently saved_files: "] + [format_save_info(save) for save in saves]
         )
         message = "\n".join(msg_list)
         print(message)
@@ -1216,6 +1248,10 @@ class MainMenu:
                                     "Selected file was not found. If you believe this is an error, please contact the developer."
                                 )
                                 continue
+                        except StorageConflictError:
+                            print(
+                                f"The save {ans} was changed by another chat while it was loading. Please try loading it again."
+                            )
                         except Exception as e:
                             print(
                                 "An error occurred while loading the chat. Please try again."
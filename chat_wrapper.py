@@ -1,3 +1,4 @@
+import copy
 import datetime
 import json
 import os
@@ -8,6 +9,11 @@ from typing import Any, Dict, List, Optional, Set, Tuple, Union
 import openai
 
 import GPTchat as g
+from AutoSaver import AutoSaver
+from ChatJournal import ChatJournal
+from ContextCompactor import ContextCompactor, GPTChatSummarizer, Summarizer
+from HistoryRetriever import HistoryRetriever
+from StorageBackends import make_storage
 from settings import API_KEY
 
 
@@ -64,7 +70,8 @@ class ChatWrapper:
         save_path: str = "chatbot_saves",
         return_type: str = "Message",
         wrapper_return_type: str = "pretty_printed",
-        default_system_prompt: str = "You are a helpful AI assistant. Your model is {model} Today's date is {date}, and your training data cuts off in September 2021 "
+        default_system_prompt: str = "You are a helpful AI assistant. Your model is {model} Today's date is {date}, and your training data cuts off in September 2021 ",
+        storage=None,
     ) -> None:
         self.constructor_args = {
             "API_KEY": "Excluded for security reasons",
@@ -73,9 +80,16 @@ class ChatWrapper:
             "save_path": save_path,
             "return_type": return_type,
             "wrapper_return_type": wrapper_return_type,
+            "storage": storage if storage is None or isinstance(storage, str) else repr(storage),
         }
         self.gpt_chat = gpt_chat
         self.chat_log = chat_log
+        self.compactor = None
+        self.retriever = None
+        self.journal = None
+        self.autosaver = None
+        # True if the compactor summarizes with this wrapper's GPTChat, so it follows it when a new one is added
+        self._compactor_uses_gpt_chat = False
        
         if not self.gpt_chat is None:
             self.gpt_chat.return_type = "Message"
@@ -83,7 +97,7 @@ class ChatWrapper:
             
         self.uuid = str(uuid.uuid4())
         self.is_loaded = False
-        self.save_and_load = self.SaveAndLoad(self, save_folder=save_path)
+        self.save_and_load = self.SaveAndLoad(self, save_folder=save_path, storage=storage)
         if self.chat_log is None or self.gpt_chat is None:
             self.is_setup = False
         else:
@@ -159,12 +173,12 @@ class ChatWrapper:
             raise e
 
        
-    def get_string_from_response(self, response: g.ch.Message | dict | str ) -> str:
+    def get_string_from_response(self, response: g.ch.BaseMessage | dict | str ) -> str:
         if isinstance(response, str):
             return response
         elif isinstance(response, dict):
             return response["content"]
-        elif isinstance(response, g.ch.Message):
+        elif isinstance(response, g.ch.BaseMessage):
             return response.content
     def add_GPTChat_object(self, gpt_chat: g.GPTChat) -> None:
         """Adds a GPTChat object to the chatbot"""
@@ -176,6 +190,14 @@ class ChatWrapper:
         self.gpt_chat: g.GPTChat = gpt_chat
         self.API_KEY = gpt_chat.api_key
         self.gpt_chat.return_type = "string"
+        if self._compactor_uses_gpt_chat:
+            self.compactor.summarizer.gpt_chat = gpt_chat
+        if self.journal is not None:
+            gpt_chat.add_change_listener(self._journal_gpt_chat_change)
+            self.journal.record_extra()
+        if self.autosaver is not None:
+            self.autosaver.watch()
+            self.autosaver.mark_dirty(0)
 
     def add_ChatLog_object(self, chat_log: g.ch.ChatLog) -> None:
         """Adds a ChatLog object to the chatbot"""
@@ -183,7 +205,92 @@ class ChatWrapper:
             raise TypeError(
                 "chat_log must be an instance of ChatLog, not " + str(type(chat_log))
             )
+        if self.journal is not None:
+            # the journal holds the old chat log, it isn't replayed into a different one
+            self.disable_journal()
         self.chat_log: g.ch.ChatLog = chat_log
+        if self.compactor is not None:
+            self.chat_log.set_compactor(self.compactor)
+        if self.retriever is not None:
+            self.chat_log.set_retriever(self.retriever)
+        if self.autosaver is not None:
+            # a chat log being loaded is saved once the load has told its listeners
+            self.autosaver.watch()
+
+    def enable_compaction(self, summarizer: Summarizer = None, chunk_size: int = 20, max_summary_tokens: int = 500) -> ContextCompactor:
+        """Turns on context compaction, evicted messages are summarized into a message after the system prompt. See ContextCompactor.py
+        The summarizer defaults to this wrapper's GPTChat, so each summary costs an API call. The compactor is kept when a chat log is loaded"""
+        self._check_setup()
+        self._compactor_uses_gpt_chat = summarizer is None
+        if summarizer is None:
+            summarizer = GPTChatSummarizer(self.gpt_chat)
+        self.compactor = ContextCompactor(summarizer, chunk_size=chunk_size, max_summary_tokens=max_summary_tokens)
+        self.chat_log.set_compactor(self.compactor)
+        return self.compactor
+
+    def enable_retrieval(self, top_k: int = 3, min_score: float = 1.0) -> HistoryRetriever:
+        """Turns on retrieval of evicted messages that are relevant to the latest user message, see HistoryRetriever.py. The retriever is kept when a chat log is loaded"""
+        self._check_setup()
+        self.retriever = HistoryRetriever(top_k=top_k, min_score=min_score)
+        self.chat_log.set_retriever(self.retriever)
+        return self.retriever
+
+    def enable_journal(self, name: str, snapshot_every: int = 1000, fsync: bool = False) -> ChatJournal:
+        """Saves the chat as it happens, as a journal named name in the save folder. Each turn appends a line to <name>.journal.jsonl instead of rewriting a whole save file, see ChatJournal.py
+        If the journal already exists the chat is loaded from it. The GPTChat settings are stored with it. Adding or loading another chat log stops the journal"""
+        self._check_setup()
+        if self.journal is not None:
+            self.disable_journal()
+        journal = ChatJournal(
+            self.save_and_load.save_folder,
+            name,
+            snapshot_every=snapshot_every,
+            fsync=fsync,
+            extra_state=lambda: {"gpt_chat": self.gpt_chat.make_save_dict()},
+            restore_extra_state=lambda extra: self.gpt_chat.load_save_dict(extra["gpt_chat"]),
+        )
+        self.chat_log.set_journal(journal)
+        self.journal = journal
+        self.gpt_chat.add_change_listener(self._journal_gpt_chat_change)
+        return journal
+
+    def _journal_gpt_chat_change(self, messages: int) -> None:
+        """Change listener of the GPTChat while a journal is on, so its settings are journaled when they change and not only with the next message"""
+        if self.journal is not None:
+            self.journal.record_extra()
+
+    def enable_autosave(self, interval: float = 30.0, max_dirty_messages: int = 10, file_name: str = None) -> AutoSaver:
+        """Saves the chat wrapper in a background thread after each change to the chat log or the GPTChat, see AutoSaver.py. Changes are coalesced: a save is written once max_dirty_messages messages are unsaved, or interval seconds after the first unsaved change
+        The save is an ordinary save file (autosave_<uuid>.json in the save folder by default), written to a temporary file and renamed so it is never half written"""
+        self._check_setup()
+        self.disable_autosave()
+        self.autosaver = AutoSaver(self, file_name=file_name, interval=interval, max_dirty_messages=max_dirty_messages)
+        self.autosaver.start()
+        return self.autosaver
+
+    def disable_autosave(self, flush: bool = True) -> None:
+        """Stops the autosave thread, writing any unsaved turns first if flush is True"""
+        if self.autosaver is not None:
+            self.autosaver.stop(flush=flush)
+        self.autosaver = None
+
+    def disable_journal(self) -> None:
+        if self.journal is not None:
+            self.journal.close()
+        if self.gpt_chat is not None:
+            self.gpt_chat.remove_change_listener(self._journal_gpt_chat_change)
+        self.journal = None
+
+    def disable_retrieval(self) -> None:
+        self.retriever = None
+        if self.chat_log is not None:
+            self.chat_log.set_retriever(None)
+
+    def disable_compaction(self) -> None:
+        self.compactor = None
+        self._compactor_uses_gpt_chat = False
+        if self.chat_log is not None:
+            self.chat_log.set_compactor(None)
 
     @property
     def assistant_message(self) -> str:
@@ -225,6 +332,29 @@ class ChatWrapper:
         """Wrapper for the save_and_load object's load_from_file method"""
         return self.save_and_load.load_from_file(file_name)
 
+    def fork(self) -> "ChatWrapper":
+        """Returns a copy of the chat wrapper, to try another follow up from the same point without saving and loading. See ChatLog.fork, the chat log is shared copy on write
+        The GPTChat settings are copied. The compactor is shared, since its summaries only depend on the messages, and the retriever gets a new index"""
+        self._check_setup()
+        fork = ChatWrapper(
+            API_KEY=self.API_KEY,
+            save_path=self.save_and_load.save_folder,
+            wrapper_return_type=self.wrapper_return_type,
+            storage=self.save_and_load.storage,
+        )
+        gpt_chat = copy.copy(self.gpt_chat)
+        fork.add_GPTChat_object(gpt_chat)
+        gpt_chat.return_type = self.gpt_chat.return_type
+        chat_log = self.chat_log.fork()
+        fork.compactor = self.compactor
+        fork.retriever = chat_log.retriever
+        fork.add_ChatLog_object(chat_log)
+        fork.save_and_load.gpt_chat = gpt_chat
+        fork.save_and_load.chat_log = chat_log
+        fork.is_loaded = self.is_loaded
+        fork.is_setup = True
+        return fork
+
     def modify_max_completion_tokens(self, max_completion_tokens: int) -> None:
         """This is necessary as the max_completion_tokens must be changed in both the ChatLog object and the GPTChat object"""
         self.chat_log.set_token_info(max_completion_tokens=max_completion_tokens)
@@ -264,6 +394,7 @@ class ChatWrapper:
         Attributes:
             chat_wrapper: The chat wrapper to save or load from
             save_folder: The folder to save to or load from
+            storage: Where the saves are kept (StorageBackends.py). A JSONStorage in the save folder by default, or "sqlite" for a SQLiteStorage in it
             gpt_chat: The GPTChat object inside the chat wrapper
             chat_log: The ChatLog object inside the chat wrapper
         Example Usage:
@@ -273,13 +404,14 @@ class ChatWrapper:
             chat_wrapper.save_and_load.get_files()
         """
 
-        def __init__(self, chat_wrapper, save_folder="chat_wrapper_saves"):
+        def __init__(self, chat_wrapper, save_folder="chat_wrapper_saves", storage=None):
             self.chat_wrapper = chat_wrapper
             if not save_folder.endswith("/"):
                 save_folder = save_folder + "/"
             self.save_folder = save_folder
             if not os.path.exists(self.save_folder):
                 os.makedirs(self.save_folder)
+            self.storage = make_storage(storage, self.save_folder)
             self.gpt_chat = chat_wrapper.gpt_chat
             self.chat_log = chat_wrapper.chat_log
         def __repr__(self):
@@ -287,10 +419,15 @@ class ChatWrapper:
 
         def make_save_dict(self) -> dict:
             """Returns a dictionary that can be used to recreate the chat wrapper"""
+            return self.build_save_dict(self.chat_log, self.gpt_chat.make_save_dict())
 
-            chat_log_dict = self.chat_log.make_save_dict()
+        def build_save_dict(self, chat_log, gpt_chat_dict: dict, sized: bool = True) -> dict:
+            """Returns the save dict for chat_log and a GPTChat save dict, so a snapshot (ie a ChatLog.fork) can be saved from another thread. See SaveToDict.save for sized"""
+            return self.wrap_save_dict(chat_log.make_save_dict(sized=sized), gpt_chat_dict)
 
-            gpt_chat_dict = self.gpt_chat.make_save_dict()
+        def wrap_save_dict(self, chat_log_dict: dict, gpt_chat_dict: dict) -> dict:
+            """Returns the chat wrapper save dict around a ChatLog save dict and a GPTChat save dict"""
+            gpt_chat_dict = dict(gpt_chat_dict)
             gpt_chat_dict['return_type'] = "Message"
 
             meta_data = {
@@ -305,11 +442,12 @@ class ChatWrapper:
             }
 
         def load_save_dict(self, save_dict: dict, API_KEY: str = None) -> None:
-            """Loads a save dict into the chat wrapper"""
+            """Loads a save dict into the chat wrapper. The new ChatLog is made with the current one's constructor arguments, so settings that aren't in the save (compact messages, spilling, storage) carry over"""
             self.chat_wrapper.uuid = save_dict["meta_data"]["chat_wrapper_uuid"]
             if API_KEY is None:
                 API_KEY = self.chat_wrapper.API_KEY
-            self.chat_log = g.ch.ChatLog()
+            old_chat_log = self.chat_wrapper.chat_log
+            self.chat_log = g.ch.ChatLog(**old_chat_log.constructor_args) if old_chat_log is not None else g.ch.ChatLog()
             self.chat_wrapper.add_ChatLog_object(self.chat_log)
             self.chat_wrapper.chat_log.save_to_dict.load(save_dict["chat_log"])
             
@@ -321,24 +459,23 @@ class ChatWrapper:
 
         def save_to_file(self, file_name: str, overwrite=False) -> bool:
             """Saves the chat wrapper to a file, returns True if successful, False if not"""
-            if not overwrite and os.path.exists(file_name):
+            name = self._remove_file_path(file_name)
+            if not overwrite and self.storage.exists(name):
                 return False
-            file_name = self._add_file_path(file_name)
-            save_dict = self.make_save_dict()
-            with open(file_name, "w") as f:
-                json.dump(save_dict, f)
+            self.save_chat(name, self.chat_log, self.gpt_chat.make_save_dict())
             return True
 
+        def save_chat(self, name: str, chat_log, gpt_chat_dict: dict) -> None:
+            """Stores chat_log and a GPTChat save dict as the save name, so a snapshot (ie a ChatLog.fork) can be saved from another thread. A storage that can append only writes the new messages"""
+            self.storage.save_chat(name, chat_log, wrap=lambda chat_log_dict: self.wrap_save_dict(chat_log_dict, gpt_chat_dict))
+
         def load_from_file(self, file_name: str) -> None:
             """Loads a save file into the chat wrapper"""
-            file_name = self._add_file_path(file_name)
-            try:
-                with open(file_name, "r") as f:
-                    save_dict = json.load(f)
-                self.load_save_dict(save_dict)
-            except FileNotFoundError:
-                print("File not found: " + file_name)
+            save_dict = self.storage.load(self._remove_file_path(file_name))
+            if save_dict is None:
+                print("File not found: " + self._add_file_path(file_name))
                 return False
+            self.load_save_dict(save_dict)
             return True
 
         def _add_file_path(self, file_name: str) -> str:
@@ -360,13 +497,14 @@ class ChatWrapper:
 
         def get_files(self, remove_path=True) -> list:
             """Returns a list of files in the save folder, if remove_path is true, the path will be removed from the file names"""
-            files = []
-            for file in os.listdir(self.save_folder):
-                if file.endswith(".json"):
-                    if remove_path:
-                        file = self._remove_file_path(file)
-                    files.append(file)
-            return files
+            names = self.storage.names()
+            if remove_path:
+                return names
+            return [name + ".json" for name in names]
+
+        def get_save_info(self, **kwargs) -> list:
+            """Returns the metadata of the saves in the storage (name, messages, model, saved_at, file_size), see SaveCatalog.list_saves for sorting and filtering"""
+            return self.storage.list_saves(**kwargs)
 
 
 class TestChatWrapper(unittest.TestCase):
@@ -433,6 +571,73 @@ class TestChatWrapper(unittest.TestCase):
         test_chat_wrapper = ChatWrapper()
         self.assertRaises(ChatWrapperNotSetupError, test_chat_wrapper._check_setup)
 
+    def test_enable_compaction(self):
+        """Tests that the compactor defaults to the wrapper's GPTChat, and is kept when a save is loaded"""
+        compactor = self.chat_wrapper.enable_compaction()
+        self.assertIs(compactor.summarizer.gpt_chat, self.gpt_chat)
+        self.assertIs(self.chat_log.compactor, compactor)
+        save_dict = self.chat_wrapper.save_and_load.make_save_dict()
+        self.chat_wrapper.save_and_load.load_save_dict(save_dict, API_KEY=API_KEY)
+        self.assertIs(self.chat_wrapper.chat_log.compactor, compactor)
+        self.assertIs(compactor.summarizer.gpt_chat, self.chat_wrapper.gpt_chat)
+        self.chat_wrapper.disable_compaction()
+        self.assertIsNone(self.chat_wrapper.chat_log.compactor)
+
+    def test_load_keeps_chat_log_settings(self):
+        """Tests that loading a save keeps the trim policy and the settings of the chat log it is loaded into"""
+        chat_log = g.ch.ChatLog(trim_policy="keep_first", trim_policy_options={"count": 2}, compact_messages=True)
+        chat_wrapper = ChatWrapper(gpt_chat=self.gpt_chat, chat_log=chat_log)
+        chat_wrapper.chat_log.add_message_list(g.ch.short_1000_test_log)
+        save_dict = chat_wrapper.save_and_load.make_save_dict()
+        chat_wrapper.save_and_load.load_save_dict(save_dict, API_KEY=API_KEY)
+        self.assertIsNot(chat_wrapper.chat_log, chat_log)
+        self.assertEqual(chat_wrapper.chat_log.trim_policy.name, "keep_first")
+        self.assertEqual(chat_wrapper.chat_log.trim_policy.count, 2)
+        self.assertIs(chat_wrapper.chat_log.message_class, g.ch.CompactMessage)
+        self.assertEqual(chat_wrapper.chat_log.get_finished_chat_log(), chat_log.get_finished_chat_log())
+        # a save carries its own policy into a chat log made with another one
+        self.chat_wrapper.save_and_load.load_save_dict(save_dict, API_KEY=API_KEY)
+        self.assertEqual(self.chat_wrapper.chat_log.trim_policy.name, "keep_first")
+
+    def test_enable_retrieval(self):
+        retriever = self.chat_wrapper.enable_retrieval(top_k=2)
+        self.assertIs(self.chat_log.retriever, retriever)
+        self.chat_wrapper.save_and_load.load_save_dict(self.chat_wrapper.save_and_load.make_save_dict(), API_KEY=API_KEY)
+        self.assertIs(self.chat_wrapper.chat_log.retriever, retriever)
+
+    def test_fork(self):
+        """Tests that a fork starts from the same point, and that each side's new messages don't show up in the other"""
+        self.chat_wrapper.chat_log.add_message_list(g.ch.short_1000_test_log[:20])
+        self.chat_wrapper.gpt_chat.temperature = 0.5
+        fork = self.chat_wrapper.fork()
+        self.assertEqual(fork.chat_log.get_finished_chat_log(), self.chat_log.get_finished_chat_log())
+        fork.gpt_chat.temperature = 1.0
+        self.assertEqual(self.chat_wrapper.gpt_chat.temperature, 0.5)
+        fork.chat_log.user_message = "Fork"
+        self.chat_log.user_message = "Parent"
+        self.assertEqual(fork.chat_log.user_message.content, "Fork")
+        self.assertEqual(self.chat_log.user_message.content, "Parent")
+        self.assertEqual(len(fork.chat_log.full_chat_log), 21)
+        self.assertEqual(fork.save_and_load.make_save_dict()["chat_log"]["full_chat_log"][-1]["content"], "Fork")
+
+    def test_enable_journal(self):
+        """Tests that a journaled chat is loaded back with its GPTChat settings, including ones changed after the last message"""
+        name = "test_enable_journal"
+        self.chat_wrapper.enable_journal(name)
+        self.chat_wrapper.chat_log.user_message = "Hello"
+        self.chat_wrapper.gpt_chat.temperature = 0.3
+        self.chat_wrapper.chat_log.assistant_message = "Hi"
+        self.chat_wrapper.gpt_chat.top_p = 0.5
+        self.chat_wrapper.disable_journal()
+        test_chat_wrapper = ChatWrapper(gpt_chat=g.GPTChat(API_KEY=API_KEY), chat_log=g.ch.ChatLog())
+        journal = test_chat_wrapper.enable_journal(name)
+        self.assertEqual(test_chat_wrapper.chat_log.get_finished_chat_log(), self.chat_log.get_finished_chat_log())
+        self.assertEqual(test_chat_wrapper.gpt_chat.temperature, 0.3)
+        self.assertEqual(test_chat_wrapper.gpt_chat.top_p, 0.5)
+        test_chat_wrapper.disable_journal()
+        os.remove(journal.snapshot_path)
+        os.remove(journal.journal_path)
+
     def test_return_type_works(self):
         """Tests that changing the return type will actually change the return type"""
         self.chat_wrapper.chat_log.user_message = "Hello, how are you?"
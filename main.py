@@ -1,20 +1,41 @@
 import pyfiglet as pf
 
 import chat_loop as cl
+from settings import TOKEN_CACHE_PATH
+from templates import template_selector
+from TokenCounter import token_count_cache, tokenizer_registry
 
-result = pf.figlet_format("Alex's P.N.G.CLI Chatbot")
-print("\u001b[35m" + result + "\u001b[0m")
-divider = "_-_" * 20
-print(divider)
-msg = pf.figlet_format("Alex's Pretty Neat GPT CLI Chatbot", font="digital")
-print("\u001b[33m" + msg + "\u001b[0m")
-# print("Alex's")
-# print("Pretty Neat ")
-# print("GPT CLI Chatbot")
-print("Version 1.0.0")
-print("Ensure that you have completed the setup process before using this program.")
-print(divider)
-print()
-print()
-
-cl.main_menu.main_menu()
+
+def startup() -> None:
+    """Gets the tokenizers and the token count cache ready before the first message"""
+    # resolve the tokenizer for every template's model once, up front, rather than on the first message
+    tokenizer_registry.preload(
+        {template["chat_log"]["model"] for template in template_selector.get_all_templates().values() if "model" in template["chat_log"]}
+    )
+    # keep token counts between runs
+    if TOKEN_CACHE_PATH is not None:
+        token_count_cache.attach_store(TOKEN_CACHE_PATH)
+
+
+def main() -> None:
+    startup()
+    result = pf.figlet_format("Alex's P.N.G.CLI Chatbot")
+    print("\u001b[35m" + result + "\u001b[0m")
+    divider = "_-_" * 20
+    print(divider)
+    msg = pf.figlet_format("Alex's Pretty Neat GPT CLI Chatbot", font="digital")
+    print("\u001b[33m" + msg + "\u001b[0m")
+    # print("Alex's")
+    # print("Pretty Neat ")
+    # print("GPT CLI Chatbot")
+    print("Version 1.0.0")
+    print("Ensure that you have completed the setup process before using this program.")
+    print(divider)
+    print()
+    print()
+
+    cl.main_menu.main_menu()
+
+
+if __name__ == "__main__":
+    main()
@@ -11,7 +11,7 @@ import openai
 import tiktoken
 
 import chat_wrapper as cw
-from settings import API_KEY
+from settings import API_KEY, SAVE_STORAGE
 from templates import GetTemplates, template_selector
 
 
@@ -170,8 +170,15 @@ class ChatWrapperFactory:
             raise NoTemplateSelectedError()
         chat_log, gpt_chat = self.make_chat_log_and_gpt_chat()
         chat_wrapper = cw.ChatWrapper(
-            API_KEY=self.api_key, chat_log=chat_log, gpt_chat=gpt_chat
+            API_KEY=self.api_key, chat_log=chat_log, gpt_chat=gpt_chat, storage=SAVE_STORAGE
         )
+        autosave = self.selected_template.get("autosave")
+        if autosave is not None and autosave.get("enabled", False):
+            chat_wrapper.enable_autosave(
+                interval=autosave.get("interval", 30.0),
+                max_dirty_messages=autosave.get("max_dirty_messages", 10),
+                file_name=autosave.get("file_name"),
+            )
 
         return chat_wrapper
 
@@ -7,6 +7,12 @@ load_dotenv()
 API_KEY = os.getenv("OPENAI_API_KEY")
 DEFAULT_MODEL = os.getenv("DEFAULT_MODEL")
 DEFAULT_TEMPLATE_NAME = os.getenv("DEFAULT_TEMPLATE_NAME")
+# "json" (the default) or "sqlite", see StorageBackends.py
+SAVE_STORAGE = os.getenv("SAVE_STORAGE") or None
+# SQLite file that keeps token counts between runs (see TokenCounter.py), kept apart from the saves. "none" keeps them in memory only
+TOKEN_CACHE_PATH = os.getenv("TOKEN_CACHE_PATH") or os.path.join(".cache", "token_counts.sqlite3")
+if TOKEN_CACHE_PATH.lower() == "none":
+    TOKEN_CACHE_PATH = None
 bypass = os.getenv("BYPASS_MAIN_MENU")
 if (
     bypass == 1
@@ -114,6 +114,7 @@ class GetTemplates:
         self.templates = templates
 
     required_top_level_keys = {"chat_log", "gpt_chat", "description", "tags"}
+    optional_top_level_keys = {"autosave"}
 
     def get_template(self, template_name: str) -> dict:
         """Get a template by name"""
@@ -167,6 +168,12 @@ class GetTemplates:
             "max_completion_tokens",
             "max_chat_messages",
             "token_padding",
+            "compact_messages",
+            "trim_policy",
+            "trim_policy_options",
+            "spill_history",
+            "spill_folder",
+            "spill_resident_messages",
         }
         allowed_gpt_chat_keys = {
             "model_name",
@@ -179,8 +186,14 @@ class GetTemplates:
 
         if not isinstance(template, dict):
             raise self.BadTemplateError(f"Template '{template_name}' must be a dict")
-        if self.required_top_level_keys != set(template.keys()):
-            msg = f"Template '{template_name}' must have the following keys: {self.required_top_level_keys}, missing {self.required_top_level_keys.symmetric_difference( set(template.keys()))} "
+        missing_keys = self.required_top_level_keys - set(template.keys())
+        unexpected_keys = set(template.keys()) - (self.required_top_level_keys | self.optional_top_level_keys)
+        if missing_keys or unexpected_keys:
+            msg = f"Template '{template_name}' must have the following keys: {self.required_top_level_keys}, and can have {self.optional_top_level_keys}"
+            if missing_keys:
+                msg += f", missing {missing_keys}"
+            if unexpected_keys:
+                msg += f", unexpected {unexpected_keys}"
             raise self.BadTemplateError(msg)
         if not isinstance(template["chat_log"], dict):
             raise self.BadTemplateError(
@@ -215,12 +228,24 @@ class GetTemplates:
                 f"'tags' in template '{template_name}' must be a list"
             )
 
+        if "autosave" in template:
+            allowed_autosave_keys = {"enabled", "interval", "max_dirty_messages", "file_name"}
+            if not isinstance(template["autosave"], dict):
+                raise self.BadTemplateError(
+                    f"'autosave' in template '{template_name}' must be a dict"
+                )
+            autosave_dif = set(template["autosave"].keys()) - allowed_autosave_keys
+            if len(autosave_dif) > 0:
+                raise self.BadTemplateError(
+                    f"'autosave' keys in template '{template_name}' must be one of {allowed_autosave_keys}. Got {autosave_dif}"
+                )
+
         return template
 
     def get_template_part(self, template_name: str, part: str) -> dict | str | list:
         """Get a part of a template by name"""
 
-        allowed_parts = ["chat_log", "gpt_chat", "description", "tags"]
+        allowed_parts = ["chat_log", "gpt_chat", "description", "tags", "autosave"]
         if part not in allowed_parts:
             raise ValueError(f"part must be one of {allowed_parts}")
         if template_name not in self.templates.keys():
@@ -0,0 +1,146 @@
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+import GPTchat as g
+from AutoSaver import AutoSaver
+from ChatHistory import get_test_chat_log
+from chat_wrapper import ChatWrapper
+from SaveWriter import write_save
+from settings import API_KEY
+
+
+class TestAutoSaver(unittest.TestCase):
+    def setUp(self) -> None:
+        self.folder = tempfile.TemporaryDirectory()
+        self.test_log = get_test_chat_log()
+        chat_log = g.ch.ChatLog()
+        chat_log.sys_prompt = "You are a helpful AI assistant"
+        self.chat_wrapper = ChatWrapper(gpt_chat=g.GPTChat(API_KEY=API_KEY), chat_log=chat_log, save_path=self.folder.name)
+
+    def tearDown(self) -> None:
+        self.chat_wrapper.disable_autosave(flush=False)
+        self.folder.cleanup()
+
+    def add_turn(self, autosaver: AutoSaver, position: int) -> None:
+        self.chat_wrapper.chat_log.add_message_list(self.test_log[position:position + 2])
+
+    def wait_for_saves(self, autosaver: AutoSaver, saves: int, timeout: float = 5.0) -> None:
+        deadline = time.monotonic() + timeout
+        while autosaver.saves < saves and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def load(self, autosaver: AutoSaver) -> ChatWrapper:
+        loaded = ChatWrapper(gpt_chat=g.GPTChat(API_KEY=API_KEY), chat_log=g.ch.ChatLog(), save_path=self.folder.name)
+        self.assertTrue(loaded.load(autosaver.name))
+        return loaded
+
+    def test_max_dirty_messages(self):
+        """Tests that a save is written as soon as max_dirty_messages messages are unsaved, without waiting for the interval"""
+        autosaver = self.chat_wrapper.enable_autosave(interval=60, max_dirty_messages=4)
+        self.add_turn(autosaver, 0)
+        time.sleep(0.1)
+        self.assertEqual(autosaver.saves, 0)
+        self.add_turn(autosaver, 2)
+        self.wait_for_saves(autosaver, 1)
+        self.assertEqual(autosaver.saves, 1)
+        self.assertEqual(self.load(autosaver).chat_log.get_finished_chat_log(), self.chat_wrapper.chat_log.get_finished_chat_log())
+
+    def test_interval_coalesces(self):
+        """Tests that several turns within the interval are written as one save of the latest state"""
+        autosaver = self.chat_wrapper.enable_autosave(interval=0.3, max_dirty_messages=1000)
+        for position in range(0, 20, 2):
+            self.add_turn(autosaver, position)
+        self.wait_for_saves(autosaver, 1)
+        time.sleep(0.4)
+        self.assertEqual(autosaver.saves, 1)
+        self.assertEqual(self.load(autosaver).chat_log.get_finished_chat_log(), self.chat_wrapper.chat_log.get_finished_chat_log())
+        self.assertEqual([name for name in os.listdir(self.folder.name) if name.endswith(".tmp")], [])
+
+    def test_stop_flushes(self):
+        autosaver = self.chat_wrapper.enable_autosave(interval=60, max_dirty_messages=1000)
+        self.add_turn(autosaver, 0)
+        self.chat_wrapper.gpt_chat.temperature = 0.3
+        self.add_turn(autosaver, 2)
+        self.chat_wrapper.disable_autosave()
+        self.assertIsNone(self.chat_wrapper.autosaver)
+        self.assertEqual(autosaver.saves, 1)
+        loaded = self.load(autosaver)
+        self.assertEqual(loaded.chat_log.get_finished_chat_log(), self.chat_wrapper.chat_log.get_finished_chat_log())
+        self.assertEqual(loaded.gpt_chat.temperature, 0.3)
+
+    def test_settings_saved(self):
+        """Tests that changes that don't add messages are saved too, and that a load is saved as one change"""
+        autosaver = self.chat_wrapper.enable_autosave(interval=60, max_dirty_messages=1000)
+        chat_log = self.chat_wrapper.chat_log
+        chat_log.add_message_list(self.test_log[:4])
+        autosaver.flush()
+        chat_log.sys_prompt = "You are {persona}"
+        chat_log.add_more_wildcards({"persona": {"value": "a pirate", "description": "Who the assistant is"}})
+        chat_log.pin_message(1)
+        chat_log.model = "gpt-3.5-turbo-16k"
+        self.chat_wrapper.gpt_chat.top_p = 0.5
+        autosaver.flush()
+        self.assertEqual(autosaver.saves, 2)
+        loaded = self.load(autosaver)
+        self.assertEqual(loaded.chat_log.get_finished_chat_log(), chat_log.get_finished_chat_log())
+        self.assertEqual(loaded.chat_log.get_pinned_positions(), [1])
+        self.assertEqual(loaded.chat_log.model, "gpt-3.5-turbo-16k")
+        self.assertEqual(loaded.gpt_chat.top_p, 0.5)
+        del chat_log.system_prompt_wildcards["persona"]
+        self.assertTrue(self.chat_wrapper.load(autosaver.name))
+        autosaver.flush()
+        self.assertEqual(autosaver.saves, 3)
+        self.chat_wrapper.chat_log.add_message("user", "Still watching the loaded chat log?")
+        autosaver.flush()
+        self.assertEqual(autosaver.saves, 4)
+
+    def test_snapshot_released(self):
+        """Tests that the chat log stops sharing its messages with a snapshot once it is written, so a change of encoding can move them in place again"""
+        autosaver = self.chat_wrapper.enable_autosave(interval=60, max_dirty_messages=1000)
+        chat_log = self.chat_wrapper.chat_log
+        self.add_turn(autosaver, 0)
+        self.add_turn(autosaver, 2)
+        self.assertTrue(chat_log._shares_messages)
+        autosaver.flush()
+        self.assertFalse(chat_log._shares_messages)
+        fork = chat_log.fork()
+        self.assertTrue(chat_log._shares_messages)
+        fork.release()
+        self.assertFalse(chat_log._shares_messages)
+
+    def test_snapshot_read_holds_history_lock(self):
+        """Tests that a snapshot shares the chat log's history lock, so the chat log waits to add messages while the worker reads the shared history for a save"""
+        autosaver = self.chat_wrapper.enable_autosave(interval=60, max_dirty_messages=1000)
+        chat_log = self.chat_wrapper.chat_log
+        self.add_turn(autosaver, 0)
+        snapshot_chat_log = autosaver._snapshot[1][0]
+        added = threading.Event()
+        def add():
+            self.add_turn(autosaver, 2)
+            added.set()
+        with snapshot_chat_log._history_lock:
+            thread = threading.Thread(target=add)
+            thread.start()
+            self.assertFalse(added.wait(0.2))
+            self.assertEqual(len(chat_log.full_chat_log), 2)
+        thread.join(5)
+        self.assertTrue(added.is_set())
+        autosaver.flush()
+        self.assertEqual(self.load(autosaver).chat_log.get_finished_chat_log(), chat_log.get_finished_chat_log())
+
+    def test_atomic_write_failure(self):
+        """Tests that a failed write leaves the old file and no temporary file behind"""
+        path = os.path.join(self.folder.name, "atomic.json")
+        write_save(path, {"a": 1}, atomic=True)
+        self.assertRaises(TypeError, write_save, path, {"a": object()}, atomic=True)
+        with open(path, "r") as f:
+            self.assertEqual(json.load(f), {"a": 1})
+        self.assertEqual(os.listdir(self.folder.name), ["atomic.json"])
+
+
+if __name__ == '__main__':
+    unittest.main(argv=[''], verbosity=2, exit=False)
@@ -0,0 +1,119 @@
+import os
+import tempfile
+import unittest
+
+from ChatHistory import ChatLog, get_test_chat_log
+from ChatJournal import ChatJournal
+
+
+def make_chat_log() -> ChatLog:
+    chat_log = ChatLog(max_model_tokens=3000)
+    chat_log.sys_prompt = "You are a helpful AI assistant"
+    return chat_log
+
+
+class TestChatJournal(unittest.TestCase):
+    def setUp(self) -> None:
+        self.folder = tempfile.TemporaryDirectory()
+        self.test_log = get_test_chat_log()
+
+    def tearDown(self) -> None:
+        self.folder.cleanup()
+
+    def make_journal(self, **kwargs) -> ChatJournal:
+        return ChatJournal(self.folder.name, "session", **kwargs)
+
+    def reload(self) -> ChatLog:
+        chat_log = make_chat_log()
+        journal = self.make_journal()
+        chat_log.set_journal(journal)
+        journal.close()
+        return chat_log
+
+    def assert_same(self, chat_log: ChatLog, loaded: ChatLog) -> None:
+        self.assertEqual(loaded.get_finished_chat_log(), chat_log.get_finished_chat_log())
+        self.assertEqual(loaded.get_messages_as_list(format="dict"), chat_log.get_messages_as_list(format="dict"))
+        self.assertEqual(loaded.get_pinned_positions(), chat_log.get_pinned_positions())
+        self.assertEqual(loaded.trimmed_chat_log_tokens, chat_log.trimmed_chat_log_tokens)
+
+    def test_replay(self):
+        """Tests that messages, parameters, the system prompt and pins are all replayed from the journal"""
+        chat_log = make_chat_log()
+        journal = self.make_journal()
+        chat_log.set_journal(journal)
+        chat_log.add_message_list(self.test_log[:20])
+        chat_log.pin_message(0)
+        chat_log.max_model_tokens = 2500
+        chat_log.sys_prompt = "You are a pirate"
+        for message in self.test_log[20:]:
+            chat_log.add_message(message=message)
+        chat_log.max_chat_messages = 10
+        self.assertGreater(journal.records, len(self.test_log))
+        loaded = self.reload()
+        self.assert_same(chat_log, loaded)
+        self.assertEqual(loaded.max_model_tokens, 2500)
+        self.assertEqual(loaded.max_chat_messages, 10)
+        journal.close()
+
+    def test_replay_wildcards_and_trim_policy(self):
+        """Tests that wildcards and the trim policy are replayed, even when no message comes after them"""
+        chat_log = make_chat_log()
+        journal = self.make_journal()
+        chat_log.set_journal(journal)
+        chat_log.add_message_list(self.test_log)
+        chat_log.sys_prompt = "You are {journal_persona}"
+        chat_log.add_more_wildcards({"journal_persona": {"value": "a pirate", "description": "Who the assistant is"}})
+        self.addCleanup(ChatLog.system_prompt_wildcards.pop, "journal_persona", None)
+        chat_log.set_trim_policy("keep_first", {"count": 2})
+        loaded = self.reload()
+        self.assert_same(chat_log, loaded)
+        # the snapshot was taken before the wildcard was added, so it came back from the journal
+        self.assertIn("journal_persona", vars(loaded)["system_prompt_wildcards"])
+        self.assertEqual(loaded.get_finished_chat_log()[0]["content"], "You are a pirate")
+        self.assertEqual((loaded.trim_policy.name, loaded.trim_policy.options), ("keep_first", {"count": 2}))
+        journal.close()
+
+    def test_one_line_per_message(self):
+        """Tests that adding a message appends one line, and doesn't touch the snapshot"""
+        chat_log = make_chat_log()
+        journal = self.make_journal()
+        chat_log.set_journal(journal)
+        chat_log.add_message_list(self.test_log)
+        snapshot_size = os.path.getsize(journal.snapshot_path)
+        journal_size = os.path.getsize(journal.journal_path)
+        chat_log.add_message("user", "one more")
+        self.assertEqual(os.path.getsize(journal.snapshot_path), snapshot_size)
+        with open(journal.journal_path, "r") as f:
+            self.assertEqual(len(f.read()) - journal_size, len(f'{{"op": "message", "role": "user", "content": "one more", "tokens": {chat_log.full_chat_log[-1].tokens}}}\n'))
+        journal.close()
+
+    def test_snapshot_every(self):
+        chat_log = make_chat_log()
+        journal = self.make_journal(snapshot_every=7)
+        chat_log.set_journal(journal)
+        for message in self.test_log:
+            chat_log.add_message(message=message)
+        self.assertLess(journal.records, 7)
+        self.assert_same(chat_log, self.reload())
+        journal.close()
+
+    def test_torn_and_stale_journals(self):
+        """Tests that a half written last line is dropped, and that a journal from before the snapshot is not replayed"""
+        chat_log = make_chat_log()
+        journal = self.make_journal()
+        chat_log.set_journal(journal)
+        chat_log.add_message_list(self.test_log[:10])
+        journal.close()
+        with open(journal.journal_path, "r") as f:
+            old_journal = f.read()
+        with open(journal.journal_path, "a") as f:
+            f.write('{"op": "message", "role": "us')
+        self.assert_same(chat_log, self.reload())
+        # reloading took a new snapshot with the records in it, so the old journal must not be replayed on top of it again
+        with open(journal.journal_path, "w") as f:
+            f.write(old_journal)
+        self.assert_same(chat_log, self.reload())
+
+
+if __name__ == '__main__':
+    unittest.main(argv=[''], verbosity=2, exit=False)
@@ -0,0 +1,105 @@
+import unittest
+
+from ChatHistory import ChatLog, get_test_chat_log
+from ContextCompactor import ContextCompactor, ExtractiveSummarizer
+from TokenCounter import count_tokens
+
+
+class CountingSummarizer(ExtractiveSummarizer):
+    """An ExtractiveSummarizer that remembers which chunks it was asked to summarize"""
+
+    def __init__(self):
+        super().__init__()
+        self.chunks = []
+
+    def summarize(self, messages: list) -> str:
+        self.chunks.append([message.content for message in messages])
+        return super().summarize(messages)
+
+
+class TestContextCompactor(unittest.TestCase):
+    def setUp(self) -> None:
+        self.summarizer = CountingSummarizer()
+        self.compactor = ContextCompactor(self.summarizer, chunk_size=4, max_summary_tokens=300)
+        self.chat_log = ChatLog(max_model_tokens=4000)
+        self.chat_log.sys_prompt = "You are a helpful AI assistant"
+        self.chat_log.set_compactor(self.compactor)
+
+    def test_extractive_summarizer(self):
+        chat_log = ChatLog()
+        messages = [
+            chat_log.make_message("user", "What is a deque?  It is in the collections module."),
+            chat_log.make_message("assistant", "A double ended queue. " + "x" * 500),
+        ]
+        summary = ExtractiveSummarizer(max_chars_per_message=40).summarize(messages)
+        self.assertEqual(summary, "user: What is a deque?\nassistant: A double ended queue.")
+        self.assertEqual(summary, ExtractiveSummarizer(max_chars_per_message=40).summarize(messages))
+
+    def test_budget_reserved(self):
+        without_compactor = ChatLog(max_model_tokens=4000)
+        without_compactor.sys_prompt = "You are a helpful AI assistant"
+        self.assertEqual(self.chat_log.max_chat_tokens, without_compactor.max_chat_tokens - 300)
+
+    def test_summary_in_finished_chat_log(self):
+        self.chat_log.add_message_list(get_test_chat_log())
+        finished_chat_log = self.chat_log.get_finished_chat_log()
+        summary_message = finished_chat_log[1]
+        self.assertEqual(summary_message["role"], "system")
+        self.assertTrue(summary_message["content"].startswith(ContextCompactor.summary_heading))
+        self.assertLessEqual(count_tokens(summary_message["content"], self.chat_log.model), 300)
+        self.assertEqual(finished_chat_log[2:], [dict(message) for message in self.chat_log.trimmed_chat_log])
+
+    def test_chunks_summarized_once(self):
+        """Tests that each evicted chunk goes to the summarizer once, and only once it is evicted in full"""
+        self.chat_log.add_message_list(get_test_chat_log())
+        evicted = self.chat_log.count_settled_evictions()
+        for _ in range(3):
+            self.chat_log.get_finished_chat_log()
+        chunk_contents = [tuple(chunk) for chunk in self.summarizer.chunks]
+        self.assertEqual(len(chunk_contents), len(set(chunk_contents)))
+        self.assertLessEqual(len(chunk_contents), evicted // 4)
+        for chunk in self.summarizer.chunks:
+            self.assertEqual(len(chunk), 4)
+
+    def test_kept_messages_not_summarized(self):
+        """Tests that messages kept by keep_first or a pin are left out of the chunks, which are made from the messages that were really evicted"""
+        compactor = ContextCompactor(self.summarizer, chunk_size=4, max_summary_tokens=1500)
+        chat_log = ChatLog(max_model_tokens=8000, trim_policy="keep_first", trim_policy_options={"count": 2})
+        chat_log.sys_prompt = "You are a helpful AI assistant"
+        chat_log.set_compactor(compactor)
+        test_log = get_test_chat_log()
+        chat_log.add_message_list(test_log[:20])
+        chat_log.pin_message(9)
+        chat_log.add_message_list(test_log[20:])
+        window_positions = set(chat_log.trimmed_chat_log.positions())
+        self.assertTrue({0, 1, 9} <= window_positions)
+        settled = chat_log.count_settled_evictions()
+        evicted = chat_log.get_evicted_positions(0, settled)
+        self.assertEqual(evicted, [position for position in range(len(chat_log.full_chat_log)) if position not in window_positions][:settled])
+        chat_log.get_finished_chat_log()
+        chunks = [[chat_log.full_chat_log[position].content for position in evicted[start:start + 4]] for start in range(0, settled - settled % 4, 4)]
+        self.assertTrue(self.summarizer.chunks)
+        for chunk in self.summarizer.chunks:
+            self.assertIn(chunk, chunks)
+        self.assertEqual(self.summarizer.chunks[-1], chunks[0])
+
+    def test_cache_shared_by_hash(self):
+        """Tests that the same range from another chat log is not summarized again"""
+        self.chat_log.add_message_list(get_test_chat_log())
+        self.chat_log.get_finished_chat_log()
+        calls = self.compactor.calls
+        other_chat_log = ChatLog(max_model_tokens=4000)
+        other_chat_log.sys_prompt = "You are a helpful AI assistant"
+        other_chat_log.set_compactor(self.compactor)
+        other_chat_log.add_message_list(get_test_chat_log())
+        self.assertEqual(other_chat_log.get_finished_chat_log()[1], self.chat_log.get_finished_chat_log()[1])
+        self.assertEqual(self.compactor.calls, calls)
+
+    def test_nothing_evicted(self):
+        self.chat_log.add_message("user", "Hello")
+        self.assertEqual(len(self.chat_log.get_finished_chat_log()), 2)
+        self.assertEqual(self.compactor.calls, 0)
+
+
+if __name__ == '__main__':
+    unittest.main(argv=[''], verbosity=2, exit=False)
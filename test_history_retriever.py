@@ -0,0 +1,83 @@
+import unittest
+
+from ChatHistory import ChatLog
+from HistoryRetriever import BM25Index, HistoryRetriever
+
+
+class TestBM25Index(unittest.TestCase):
+    def setUp(self) -> None:
+        self.index = BM25Index()
+        self.index.add(0, "The deployment uses a blue green strategy on Kubernetes")
+        self.index.add(1, "My favourite pasta recipe needs garlic and basil")
+        self.index.add(2, "Kubernetes pods restart when the liveness probe fails")
+
+    def test_search(self):
+        results = self.index.search("why do my kubernetes pods restart?", top_k=3)
+        self.assertEqual([doc_id for doc_id, _ in results], [2, 0])
+        self.assertEqual(self.index.search("nothing matches this", top_k=3), [])
+
+    def test_exclude(self):
+        results = self.index.search("kubernetes", top_k=3, exclude={2})
+        self.assertEqual([doc_id for doc_id, _ in results], [0])
+
+
+class TestHistoryRetriever(unittest.TestCase):
+    def setUp(self) -> None:
+        self.chat_log = ChatLog(max_model_tokens=2000, max_completion_tokens=500, token_padding=100, max_chat_messages=4)
+        self.chat_log.sys_prompt = "You are a helpful AI assistant"
+        self.retriever = HistoryRetriever(top_k=2)
+        self.chat_log.set_retriever(self.retriever)
+        self.chat_log.add_message("user", "The project codename is Bluebird and the database is Postgres 15")
+        self.chat_log.add_message("assistant", "Noted, Bluebird runs on Postgres 15.")
+        for i in range(6):
+            self.chat_log.add_message("user", f"Tell me fact number {i} about the ocean")
+            self.chat_log.add_message("assistant", f"Ocean fact {i}: the ocean is large")
+
+    def test_retrieves_evicted_message(self):
+        self.chat_log.add_message("user", "Which database does Bluebird use again?")
+        finished_chat_log = self.chat_log.get_finished_chat_log()
+        retrieval_message = finished_chat_log[1]
+        self.assertEqual(retrieval_message["role"], "system")
+        self.assertIn("Postgres 15", retrieval_message["content"])
+        self.assertEqual(finished_chat_log[2:], [dict(message) for message in self.chat_log.trimmed_chat_log])
+
+    def test_index_is_incremental(self):
+        self.chat_log.get_finished_chat_log()
+        indexed = self.retriever.index.doc_count
+        self.assertEqual(indexed, self.chat_log.count_evicted())
+        self.chat_log.add_message("user", "One more question")
+        self.chat_log.get_finished_chat_log()
+        self.assertEqual(self.retriever.index.doc_count, indexed + 1)
+
+    def test_fits_leftover_budget(self):
+        self.chat_log.add_message("user", "Which database does Bluebird use again?")
+        leftover = self.chat_log.max_chat_tokens - self.chat_log.trimmed_chat_log_tokens
+        self.assertIsNone(self.retriever.get_retrieval_message(self.chat_log, 5))
+        self.assertIsNotNone(self.retriever.get_retrieval_message(self.chat_log, leftover))
+
+    def test_kept_messages_not_indexed(self):
+        """Tests that a pinned message is never indexed, that messages evicted from around it are, and that a message brought back into the window isn't retrieved"""
+        self.chat_log.pin_message(0)
+        for i in range(6, 10):
+            self.chat_log.add_message("user", f"Tell me fact number {i} about the ocean")
+        self.chat_log.get_finished_chat_log()
+        self.assertNotIn(0, self.retriever.index)
+        self.assertEqual(sorted(self.retriever.index._doc_lengths), self.chat_log.get_evicted_positions())
+        self.chat_log.unpin_message(0)
+        self.chat_log.add_message("user", "Which database does Bluebird use again?")
+        self.assertIn("Postgres 15", self.chat_log.get_finished_chat_log()[1]["content"])
+        self.assertEqual(sorted(self.retriever.index._doc_lengths), self.chat_log.get_evicted_positions())
+        self.chat_log.max_chat_messages = 30
+        self.assertIn(0, self.chat_log.trimmed_chat_log.positions())
+        self.assertEqual(self.retriever.retrieve(self.chat_log, "Bluebird Postgres", 1000), [])
+
+    def test_reset(self):
+        self.chat_log.get_finished_chat_log()
+        self.chat_log.reset()
+        self.chat_log.add_message("user", "Which database does Bluebird use again?")
+        self.assertEqual(len(self.chat_log.get_finished_chat_log()), 2)
+        self.assertEqual(self.retriever.index.doc_count, 0)
+
+
+if __name__ == '__main__':
+    unittest.main(argv=[''], verbosity=2, exit=False)
@@ -0,0 +1,85 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from ChatHistory import ChatLog
+from SaveCatalog import SaveCatalog, format_save_info
+
+
+def make_chat_log(model: str = "gpt-4", messages: int = 4) -> ChatLog:
+    chat_log = ChatLog(model=model)
+    chat_log.sys_prompt = "You are a helpful AI assistant"
+    for number in range(messages):
+        chat_log.add_message("user" if number % 2 == 0 else "assistant", f"message {number}")
+    return chat_log
+
+
+class TestSaveCatalog(unittest.TestCase):
+    def setUp(self) -> None:
+        self.folder = tempfile.TemporaryDirectory()
+        self.catalog = SaveCatalog(self.folder.name)
+        self.save_to_file = ChatLog.SaveToFile(make_chat_log(), self.folder.name)
+
+    def tearDown(self) -> None:
+        self.catalog.close()
+        self.folder.cleanup()
+
+    def write(self, name: str, data) -> None:
+        with open(os.path.join(self.folder.name, name), "w") as f:
+            json.dump(data, f)
+
+    def test_record_and_list(self):
+        """Tests that a recorded save is listed with its metadata without being read back"""
+        chat_log = make_chat_log(model="gpt-3.5-turbo", messages=6)
+        path = os.path.join(self.folder.name, "chat.json")
+        save_dict = {"meta_data": {}, "chat_log": chat_log.make_save_dict(), "gpt_chat": {}}
+        self.write("chat.json", save_dict)
+        self.catalog.record(path, save_dict)
+        with mock.patch("SaveCatalog.json.load", side_effect=AssertionError("save was opened")):
+            saves = self.catalog.list_saves()
+        self.assertEqual(len(saves), 1)
+        self.assertEqual(saves[0]["name"], "chat")
+        self.assertEqual(saves[0]["kind"], "chat_wrapper")
+        self.assertEqual(saves[0]["model"], "gpt-3.5-turbo")
+        self.assertEqual(saves[0]["messages"], 6)
+        self.assertEqual(saves[0]["file_size"], os.path.getsize(path))
+        self.assertIn("6 messages", format_save_info(saves[0]))
+
+    def test_sort_and_filter(self):
+        for number in range(30):
+            chat_log = make_chat_log(model="gpt-4" if number % 3 else "gpt-3.5-turbo", messages=number)
+            self.write(f"save_{number:02}.json", chat_log.make_save_dict())
+        self.write("notes.json", ["not", "a", "save"])
+        self.assertEqual(len(self.catalog.names()), 31)
+        self.assertIsNone(self.catalog.list_saves(name_contains="notes")[0]["kind"])
+        self.assertEqual(self.catalog.names(sort_by="messages", reverse=True, model="gpt-4")[:2], ["save_29", "save_28"])
+        self.assertEqual(self.catalog.names(model="gpt-3.5-turbo", min_messages=20), ["save_21", "save_24", "save_27"])
+        self.assertRaises(ValueError, self.catalog.list_saves, sort_by="uuid; DROP TABLE saves")
+
+    def test_heals_when_out_of_sync(self):
+        """Tests that saves added, changed or deleted behind the catalog's back are picked up, and only those are read"""
+        self.write("a.json", make_chat_log(messages=2).make_save_dict())
+        self.write("b.json", make_chat_log(messages=2).make_save_dict())
+        self.assertEqual(self.catalog.names(), ["a", "b"])
+        os.remove(os.path.join(self.folder.name, "b.json"))
+        self.write("a.json", make_chat_log(messages=12).make_save_dict())
+        self.write("c.json", make_chat_log(messages=3).make_save_dict())
+        with mock.patch("SaveCatalog.json.load", wraps=json.load) as load:
+            saves = self.catalog.list_saves()
+        self.assertEqual(load.call_count, 2)
+        self.assertEqual([(save["name"], save["messages"]) for save in saves], [("a", 12), ("c", 3)])
+
+    def test_rebuilds_broken_catalog(self):
+        self.assertTrue(self.save_to_file.save("chat"))
+        self.catalog.close()
+        with open(self.catalog.path, "wb") as f:
+            f.write(b"this is not a sqlite database" * 100)
+        catalog = SaveCatalog(self.folder.name)
+        self.assertEqual(catalog.list_saves()[0]["messages"], 4)
+        catalog.close()
+
+
+if __name__ == '__main__':
+    unittest.main(argv=[''], verbosity=2, exit=False)
@@ -0,0 +1,61 @@
+import io
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from ChatHistory import ChatLog, get_test_chat_log
+from SaveWriter import SaveWriter, checksum_matches, write_save
+
+
+class TestSaveWriter(unittest.TestCase):
+    def setUp(self) -> None:
+        self.folder = tempfile.TemporaryDirectory()
+        self.chat_log = ChatLog(max_model_tokens=3000)
+        self.chat_log.sys_prompt = "You are a helpful AI assistant é"
+        self.chat_log.add_message_list(get_test_chat_log())
+        self.chat_log.pin_message(0)
+
+    def tearDown(self) -> None:
+        self.folder.cleanup()
+
+    def test_same_as_json_dump(self):
+        """Tests that the written save loads back to the same dict as before, with the same size SaveToDict.save gives"""
+        save_dict = self.chat_log.make_save_dict()
+        f = io.StringIO()
+        writer = SaveWriter(f)
+        writer.write_value(self.chat_log.make_save_dict(sized=False))
+        self.assertEqual(writer.size, len(f.getvalue()))
+        written = json.loads(f.getvalue())
+        self.assertTrue(checksum_matches(written))
+        del written["metadata"]["checksum"]
+        self.assertEqual(written, save_dict)
+        written["full_chat_log"][3]["content"] += "!"
+        written["metadata"]["checksum"] = "0"
+        self.assertFalse(checksum_matches(written))
+
+    def test_nested_save(self):
+        """Tests that a chat log save inside another dict, as ChatWrapper saves it, is sized too"""
+        nested = {"meta_data": {"version": "1"}, "chat_log": self.chat_log.make_save_dict(sized=False), "tags": ["a", 1, None]}
+        path = os.path.join(self.folder.name, "nested.json")
+        write_save(path, nested)
+        with open(path, "r") as f:
+            written = json.load(f)
+        self.assertEqual(written["chat_log"]["metadata"]["size"], self.chat_log.make_save_dict()["metadata"]["size"])
+        self.assertEqual(written["tags"], ["a", 1, None])
+        self.assertTrue(checksum_matches(written["chat_log"]))
+
+    def test_save_to_file_serializes_once(self):
+        """Tests that saving to a file doesn't serialize the save with json.dumps first, and that the file loads"""
+        save_to_file = ChatLog.SaveToFile(self.chat_log, self.folder.name)
+        with mock.patch("ChatHistory.json.dumps", side_effect=AssertionError("serialized twice")):
+            self.assertTrue(save_to_file.save("test"))
+        loaded = ChatLog(max_model_tokens=3000)
+        self.assertTrue(ChatLog.SaveToFile(loaded, self.folder.name).load("test"))
+        self.assertEqual(loaded.get_finished_chat_log(), self.chat_log.get_finished_chat_log())
+        self.assertEqual(loaded.get_pinned_positions(), self.chat_log.get_pinned_positions())
+
+
+if __name__ == '__main__':
+    unittest.main(argv=[''], verbosity=2, exit=False)
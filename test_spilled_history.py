@@ -0,0 +1,125 @@
+import os
+import tempfile
+import threading
+import unittest
+
+from ChatHistory import ChatLog, CompactMessage, Message, get_test_chat_log
+from SpilledHistory import SpilledHistory
+
+
+def make_chat_log(**kwargs) -> ChatLog:
+    chat_log = ChatLog(max_model_tokens=3000, **kwargs)
+    chat_log.sys_prompt = "You are a helpful AI assistant"
+    return chat_log
+
+
+class TestSpilledHistory(unittest.TestCase):
+    def setUp(self) -> None:
+        self.folder = tempfile.TemporaryDirectory()
+        self.test_log = get_test_chat_log()
+
+    def tearDown(self) -> None:
+        self.folder.cleanup()
+
+    def test_list_behaviour(self):
+        """Tests that a SpilledHistory reads back the same messages as a list, including unicode and newlines"""
+        messages = [Message("user", f"message {i}\nwith a second line é") for i in range(25)]
+        history = SpilledHistory(Message, folder=self.folder.name, resident_messages=4)
+        for message in messages:
+            history.append(message)
+        self.assertGreater(history.spilled, 0)
+        expected = [dict(message) for message in messages]
+        del messages
+        self.assertEqual(len(history), 25)
+        self.assertEqual([dict(message) for message in history], expected)
+        self.assertEqual([dict(message) for message in reversed(history)], expected[::-1])
+        self.assertEqual([dict(message) for message in history[3:17]], expected[3:17])
+        self.assertEqual([dict(message) for message in history[::-5]], expected[::-5])
+        self.assertEqual(dict(history[-25]), expected[0])
+        self.assertRaises(IndexError, history.__getitem__, 25)
+        history.close()
+        self.assertFalse(os.path.exists(history.path))
+
+    def test_alive_messages_keep_identity(self):
+        history = SpilledHistory(CompactMessage, folder=self.folder.name, resident_messages=2)
+        kept = CompactMessage("user", "kept", tokens=5)
+        history.append(kept)
+        history.extend(CompactMessage("assistant", f"reply {i}") for i in range(10))
+        self.assertGreater(history.spilled, 0)
+        self.assertIs(history[0], kept)
+        self.assertEqual(history[0].tokens, 5)
+
+    def test_read_while_appending(self):
+        """Tests that a range read from another thread sees the right messages while spills move them to the segment file"""
+        history = SpilledHistory(Message, folder=self.folder.name, resident_messages=3)
+        history.extend(Message("user", f"message {i}") for i in range(10))
+        errors = []
+        def read():
+            for _ in range(200):
+                length = len(history)
+                contents = [message.content for message in history[length - 10:length]]
+                if contents != [f"message {i}" for i in range(length - 10, length)]:
+                    errors.append(contents)
+        reader = threading.Thread(target=read)
+        reader.start()
+        for i in range(10, 2000):
+            history.append(Message("user", f"message {i}"))
+        reader.join()
+        self.assertEqual(errors, [])
+        history.close()
+
+    def test_chat_log_matches_unspilled(self):
+        """Tests that a spilled chat log trims, saves and queries the same as one that keeps everything in memory"""
+        plain = make_chat_log(trim_policy="keep_first")
+        spilled = make_chat_log(trim_policy="keep_first", spill_history=True, spill_folder=self.folder.name, spill_resident_messages=10)
+        for message in self.test_log:
+            plain.add_message(message=message)
+            spilled.add_message(message=message)
+        self.assertIsInstance(spilled.full_chat_log, SpilledHistory)
+        self.assertLess(len(spilled.full_chat_log._resident), 20)
+        self.assertEqual(spilled.get_finished_chat_log(), plain.get_finished_chat_log())
+        self.assertEqual(spilled.get_messages_as_list(format="dict"), plain.get_messages_as_list(format="dict"))
+        spilled.max_model_tokens = 6000
+        plain.max_model_tokens = 6000
+        self.assertEqual(spilled.get_finished_chat_log(), plain.get_finished_chat_log())
+        save_dict = spilled.make_save_dict()
+        self.assertEqual(save_dict["full_chat_log"], plain.make_save_dict()["full_chat_log"])
+        path = spilled.full_chat_log.path
+        spilled.load_save_dict(save_dict)
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(spilled.get_finished_chat_log(), plain.get_finished_chat_log())
+
+    def assert_same_role_queries(self, chat_log: ChatLog, plain: ChatLog) -> None:
+        for role in ("user", "assistant", "system"):
+            self.assertEqual(chat_log.count_messages(role), plain.count_messages(role))
+            self.assertEqual(chat_log.get_messages_as_list(role, format="dict"), plain.get_messages_as_list(role, format="dict"))
+            self.assertEqual(chat_log.get_messages_as_list(role, limit=3, reverse=False, format="dict"), plain.get_messages_as_list(role, limit=3, reverse=False, format="dict"))
+            self.assertEqual([dict(m) for m in chat_log.get_message_range(20, 40, role)], [dict(m) for m in plain.get_message_range(20, 40, role)])
+            self.assertEqual([dict(m) for m in chat_log.get_last_turns(3, role)], [dict(m) for m in plain.get_last_turns(3, role)])
+            for page in range(3):
+                for reverse in (False, True):
+                    self.assertEqual([dict(m) for m in chat_log.get_page(page, 7, role, reverse)], [dict(m) for m in plain.get_page(page, 7, role, reverse)])
+
+    def test_role_queries_read_no_spilled_messages(self):
+        """Tests that finding messages by role uses the roles kept in memory, so a spilled chat log and its forks answer like one in memory without reading the segment file for every message"""
+        plain = make_chat_log()
+        spilled = make_chat_log(spill_history=True, spill_folder=self.folder.name, spill_resident_messages=10)
+        plain.add_message_list(self.test_log)
+        spilled.add_message_list(self.test_log)
+        reads = []
+        make_message = spilled.full_chat_log._make_message
+        spilled.full_chat_log._make_message = lambda line: reads.append(line) or make_message(line)
+        fork = spilled.fork()
+        fork.add_message("user", "only in the fork")
+        for chat_log in (spilled, fork):
+            reads.clear()
+            self.assertEqual(chat_log.count_messages("user"), sum(message["role"] == "user" for message in self.test_log) + (chat_log is fork))
+            self.assertEqual(dict(chat_log.get_last_message("assistant")), dict(plain.get_last_message("assistant")))
+            self.assertLessEqual(len(reads), 1)
+            self.assertEqual(chat_log._role_index, {})
+        self.assert_same_role_queries(spilled, plain)
+        plain.add_message("user", "only in the fork")
+        self.assert_same_role_queries(fork, plain)
+
+if __name__ == '__main__':
+    unittest.main(argv=[''], verbosity=2, exit=False)
@@ -0,0 +1,179 @@
+import os
+import tempfile
+import unittest
+
+import GPTchat as g
+from ChatHistory import ChatLog, get_test_chat_log
+from chat_wrapper import ChatWrapper
+from ExportChatLogs import ChatLogExporter
+from settings import API_KEY
+from StorageBackends import JSONStorage, SQLiteStorage, StorageConflictError, StoredHistory, make_storage
+
+
+class TestSQLiteStorage(unittest.TestCase):
+    def setUp(self) -> None:
+        self.folder = tempfile.TemporaryDirectory()
+        self.storage = SQLiteStorage(os.path.join(self.folder.name, SQLiteStorage.file_name))
+        self.test_log = get_test_chat_log()
+        self.chat_log = self.make_chat_log()
+        self.chat_log.add_message_list(self.test_log[:40])
+        self.chat_log.pin_message(0)
+
+    def tearDown(self) -> None:
+        self.storage.close()
+        self.folder.cleanup()
+
+    def make_chat_log(self) -> ChatLog:
+        chat_log = ChatLog(max_model_tokens=3000, storage=self.storage, save_folder=self.folder.name)
+        chat_log.sys_prompt = "You are a helpful AI assistant"
+        return chat_log
+
+    def load(self, name: str = "chat") -> ChatLog:
+        loaded = self.make_chat_log()
+        self.assertTrue(loaded.save_to_file.load(name))
+        return loaded
+
+    def test_round_trip(self):
+        self.assertEqual(self.storage._connection.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+        self.assertTrue(self.chat_log.save_to_file.save("chat"))
+        self.assertFalse(self.chat_log.save_to_file.save("chat"))
+        loaded = self.load()
+        self.assertEqual(loaded.get_finished_chat_log(), self.chat_log.get_finished_chat_log())
+        self.assertEqual(loaded.get_pinned_positions(), self.chat_log.get_pinned_positions())
+        self.assertEqual([message.content for message in loaded.full_chat_log], [message["content"] for message in self.test_log[:40]])
+        self.assertEqual(self.storage.names(), ["chat"])
+        self.assertEqual(self.storage.list_saves()[0]["messages"], 40)
+        self.assertFalse(self.make_chat_log().save_to_file.load("missing"))
+
+    def test_loads_only_the_window(self):
+        """Tests that loading reads the window, and the rest of the history only when it is needed"""
+        self.chat_log.save_to_file.save("chat")
+        loaded = self.load()
+        self.assertIsInstance(loaded.full_chat_log, StoredHistory)
+        self.assertEqual(len(loaded.full_chat_log.loaded_messages()), 0)
+        self.assertLess(len(loaded.trimmed_chat_log), 40)
+        self.assertEqual(loaded.full_chat_log[3].content, self.test_log[3]["content"])
+
+    def test_appends_new_messages(self):
+        """Tests that saving again after adding a message only writes that message and the window"""
+        self.chat_log.save_to_file.save("chat")
+        self.assertIsInstance(self.chat_log.full_chat_log, list)
+        loaded = self.load()
+        loaded.add_message("user", "one more message")
+        before = self.storage._connection.total_changes
+        self.assertTrue(loaded.save_to_file.save("chat", overwrite=True))
+        written = self.storage._connection.total_changes - before
+        self.assertLess(written, len(loaded.trimmed_chat_log) * 2 + 5)
+        reloaded = self.load()
+        self.assertEqual(len(reloaded.full_chat_log), 41)
+        self.assertEqual(reloaded.full_chat_log[-1].content, "one more message")
+        self.assertEqual(reloaded.get_finished_chat_log(), loaded.get_finished_chat_log())
+
+    def test_file_size_in_bytes(self):
+        """Tests that a save's file_size is the bytes of its header and messages encoded as UTF-8, after a full save and after an append"""
+        def expected_size(chat_log: ChatLog) -> int:
+            header = self.storage._connection.execute("SELECT header FROM saves WHERE name = 'chat'").fetchone()[0]
+            messages = sum(len(message.role.encode("utf-8")) + len(message.content.encode("utf-8")) for message in chat_log.full_chat_log)
+            return len(header.encode("utf-8")) + messages
+        self.chat_log.add_message("user", "Ünïcödé takes more bytes than characters ✓")
+        self.chat_log.save_to_file.save("chat")
+        self.assertEqual(self.storage.list_saves()[0]["file_size"], expected_size(self.chat_log))
+        loaded = self.load()
+        loaded.add_message("assistant", "Ça marche ✓")
+        loaded.save_to_file.save("chat", overwrite=True)
+        self.assertEqual(self.storage.list_saves()[0]["file_size"], expected_size(loaded))
+
+    def count_written(self, save) -> int:
+        """Returns the number of rows save() changes in the database"""
+        before = self.storage._connection.total_changes
+        save()
+        return self.storage._connection.total_changes - before
+
+    def test_forks_and_spilled_histories_append(self):
+        """Tests that saving a fork (ie an autosave snapshot) or a spilled history again only appends, without changing the chat log that is saved"""
+        spilled = ChatLog(max_model_tokens=3000, storage=self.storage, save_folder=self.folder.name, spill_history=True, spill_folder=self.folder.name, spill_resident_messages=5)
+        spilled.sys_prompt = "You are a helpful AI assistant"
+        spilled.add_message_list(self.test_log[:40])
+        for chat_log in (self.chat_log, spilled):
+            with self.subTest(history=type(chat_log.full_chat_log).__name__):
+                history = chat_log.full_chat_log
+                self.storage.save_chat("forked", chat_log.fork())
+                self.assertIs(chat_log.full_chat_log, history)
+                for position in range(40, 60, 2):
+                    chat_log.add_message_list(self.test_log[position:position + 2])
+                    snapshot = chat_log.fork()
+                    # fewer rows than the messages already saved, which a full rewrite would write again
+                    self.assertLess(self.count_written(lambda: self.storage.save_chat("forked", snapshot)), position)
+                self.assertLess(self.count_written(lambda: self.storage.save_chat("forked", chat_log)), 40)
+                self.assertIs(chat_log.full_chat_log, history)
+                loaded = self.load("forked")
+                self.assertEqual([message.content for message in loaded.full_chat_log], [message["content"] for message in self.test_log[:60]])
+                self.assertEqual(loaded.get_finished_chat_log(), chat_log.get_finished_chat_log())
+        spilled.full_chat_log.close()
+
+    def test_conflicts(self):
+        """Tests that two chat logs appending different messages to the same save, or reading a replaced save, raise StorageConflictError"""
+        self.chat_log.save_to_file.save("chat")
+        first, second = self.load(), self.load()
+        first.add_message("user", "first")
+        second.add_message("user", "second")
+        first.save_to_file.save("chat", overwrite=True)
+        self.assertRaises(StorageConflictError, second.save_to_file.save, "chat", True)
+        stale = self.load()
+        self.make_chat_log().save_to_file.save("chat", overwrite=True)
+        self.assertRaises(StorageConflictError, lambda: stale.full_chat_log[0])
+
+
+class TestStorageInWrapper(unittest.TestCase):
+    def setUp(self) -> None:
+        self.folder = tempfile.TemporaryDirectory()
+        self.chat_wrapper = self.make_wrapper("sqlite")
+        self.chat_wrapper.chat_log.add_message_list(get_test_chat_log()[:20])
+
+    def tearDown(self) -> None:
+        self.chat_wrapper.save_and_load.storage.close()
+        self.folder.cleanup()
+
+    def make_wrapper(self, storage=None) -> ChatWrapper:
+        chat_log = g.ch.ChatLog()
+        chat_log.sys_prompt = "You are a helpful AI assistant"
+        return ChatWrapper(gpt_chat=g.GPTChat(API_KEY=API_KEY), chat_log=chat_log, save_path=self.folder.name, storage=storage)
+
+    def test_save_and_load(self):
+        self.assertIs(make_storage("sqlite", self.folder.name), self.chat_wrapper.save_and_load.storage)
+        self.assertTrue(self.chat_wrapper.save("chat"))
+        self.assertEqual(self.chat_wrapper.save_and_load.get_files(), ["chat"])
+        self.assertFalse(os.path.exists(os.path.join(self.folder.name, "chat.json")))
+        loaded = self.make_wrapper("sqlite")
+        self.assertTrue(loaded.load("chat"))
+        self.assertEqual(loaded.chat_log.get_finished_chat_log(), self.chat_wrapper.chat_log.get_finished_chat_log())
+        self.assertFalse(loaded.load("missing"))
+
+    def test_shared_storage_survives_close(self):
+        """Tests that closing the storage from one wrapper doesn't break another one using the same database"""
+        other = self.make_wrapper("sqlite")
+        self.assertIs(other.save_and_load.storage, self.chat_wrapper.save_and_load.storage)
+        other.save_and_load.storage.close()
+        self.assertTrue(self.chat_wrapper.save("chat"))
+        loaded = self.make_wrapper("sqlite")
+        self.assertTrue(loaded.load("chat"))
+        self.assertEqual(loaded.chat_log.get_finished_chat_log(), self.chat_wrapper.chat_log.get_finished_chat_log())
+
+    def test_export_from_database(self):
+        self.chat_wrapper.save("chat")
+        exporter = ChatLogExporter(self.folder.name, os.path.join(self.folder.name, "exports"), storage="sqlite")
+        self.assertEqual(exporter.list_chatlog_files(), ["chat"])
+        self.assertTrue(exporter.check_if_chatlog_exists("chat"))
+        text = exporter._format_data("chat", exporter.read_chatlog_save("chat"))
+        self.assertIn(get_test_chat_log()[19]["content"], text)
+
+    def test_json_is_default(self):
+        chat_wrapper = self.make_wrapper()
+        self.assertIsInstance(chat_wrapper.save_and_load.storage, JSONStorage)
+        chat_wrapper.chat_log.add_message("user", "Hello")
+        self.assertTrue(chat_wrapper.save("chat"))
+        self.assertTrue(os.path.exists(os.path.join(self.folder.name, "chat.json")))
+
+
+if __name__ == '__main__':
+    unittest.main(argv=[''], verbosity=2, exit=False)
@@ -0,0 +1,109 @@
+import os
+import tempfile
+import tiktoken
+import unittest
+from TokenCounter import TokenCountCache, TokenizerRegistry, tokenizer_registry, count_tokens
+
+
+class TestTokenizerRegistry(unittest.TestCase):
+    def setUp(self) -> None:
+        self.registry = TokenizerRegistry()
+
+    def test_count_tokens(self):
+        """Tests that the registry counts the same as tiktoken"""
+        string = "Hello, how are you?"
+        encoding = tiktoken.encoding_for_model("gpt-4")
+        self.assertEqual(self.registry.count_tokens(string, "gpt-4"), len(encoding.encode(string)))
+
+    def test_alias(self):
+        """Tests that gpt-35-turbo resolves through the default alias, without patching tiktoken"""
+        self.assertEqual(self.registry.encoding_name_for_model("gpt-35-turbo"), "cl100k_base")
+        self.assertNotIn("gpt-35-turbo", tiktoken.model.MODEL_TO_ENCODING)
+        self.registry.add_alias("my-model", "cl100k_base")
+        self.assertEqual(self.registry.get_encoding("my-model").name, "cl100k_base")
+
+    def test_unknown_model(self):
+        self.assertRaises(KeyError, self.registry.get_encoding, "not-a-model")
+
+    def test_stats(self):
+        """Tests that a model is only resolved once"""
+        for _ in range(5):
+            self.registry.count_tokens("Hello", "gpt-4")
+        stats = self.registry.stats()
+        self.assertEqual(stats["misses"], 1)
+        self.assertEqual(stats["hits"], 4)
+        self.assertEqual(stats["models"], ["gpt-4"])
+        self.assertEqual(stats["encodings"], ["cl100k_base"])
+
+    def test_preload(self):
+        """Tests that preloading skips unknown models and counts as the only miss"""
+        loaded = self.registry.preload(["gpt-4", "gpt-35-turbo", "not-a-model"])
+        self.assertEqual(loaded, ["gpt-4", "gpt-35-turbo"])
+        self.registry.count_tokens("Hello", "gpt-35-turbo")
+        self.assertEqual(self.registry.stats()["misses"], 2)
+        self.assertEqual(self.registry.stats()["hits"], 1)
+
+    def test_shared_registry(self):
+        self.assertEqual(count_tokens("Hello", "gpt-4"), tokenizer_registry.count_tokens("Hello", "gpt-4"))
+
+    def tearDown(self) -> None:
+        del self.registry
+
+
+class TestTokenCountCache(unittest.TestCase):
+    def setUp(self) -> None:
+        self.cache = TokenCountCache(max_size=3, min_length=0)
+        self.registry = TokenizerRegistry(cache=self.cache)
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.store_path = os.path.join(self.temp_dir.name, "saves", "token_counts.sqlite3")
+
+    def test_registry_uses_cache(self):
+        """Tests that counting the same content twice only encodes it once"""
+        content = "Hello, how are you?"
+        first = self.registry.count_tokens(content, "gpt-4")
+        second = self.registry.count_tokens(content, "gpt-35-turbo")
+        self.assertEqual(first, second)
+        self.assertEqual(self.cache.stats()["misses"], 1)
+        self.assertEqual(self.cache.stats()["hits"], 1)
+
+    def test_lru_eviction(self):
+        for i in range(4):
+            self.cache.set("cl100k_base", f"message {i}", i)
+        self.assertEqual(len(self.cache), 3)
+        self.assertIsNone(self.cache.get("cl100k_base", "message 0"))
+        self.assertEqual(self.cache.get("cl100k_base", "message 3"), 3)
+
+    def test_keyed_by_encoding(self):
+        self.cache.set("cl100k_base", "Hello", 1)
+        self.assertIsNone(self.cache.get("p50k_base", "Hello"))
+
+    def test_count_tokens_batch(self):
+        """Tests that batch counting matches counting one at a time, and fills the cache"""
+        strings = ["Hello, how are you?", "I am well, how are you?", "Hello, how are you?", ""]
+        expected = [TokenizerRegistry().count_tokens(string, "gpt-4") for string in strings]
+        self.assertEqual(self.registry.count_tokens_batch(strings, "gpt-4"), expected)
+        self.assertEqual(self.cache.get("cl100k_base", "I am well, how are you?"), expected[1])
+
+    def test_min_length(self):
+        cache = TokenCountCache(min_length=10)
+        registry = TokenizerRegistry(cache=cache)
+        registry.count_tokens("short", "gpt-4")
+        self.assertEqual(len(cache), 0)
+
+    def test_store(self):
+        """Tests that counts written to the store are there for a new cache"""
+        self.cache.attach_store(self.store_path)
+        self.cache.set("cl100k_base", "Hello, how are you?", 6)
+        self.cache.detach_store()
+        new_cache = TokenCountCache(store_path=self.store_path, min_length=0)
+        self.assertEqual(new_cache.get("cl100k_base", "Hello, how are you?"), 6)
+        self.assertEqual(len(new_cache), 1)
+        new_cache.detach_store()
+
+    def tearDown(self) -> None:
+        self.cache.detach_store()
+        self.temp_dir.cleanup()
+
+
+if __name__ == '__main__':
+    unittest.main(argv=[''], verbosity=2, exit=False)
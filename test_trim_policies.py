@@ -0,0 +1,137 @@
+import unittest
+
+from ChatHistory import ChatLog, get_test_chat_log
+from TrimPolicies import TrimPolicyError, make_trim_policy, trim_policies
+
+
+def make_chat_log(trim_policy: str, options: dict = None, **kwargs) -> ChatLog:
+    chat_log = ChatLog(trim_policy=trim_policy, trim_policy_options=options, **kwargs)
+    chat_log.sys_prompt = "You are a helpful AI assistant"
+    return chat_log
+
+
+class TestTrimPolicies(unittest.TestCase):
+    def setUp(self) -> None:
+        self.test_log = get_test_chat_log()
+
+    def add_one_at_a_time(self, chat_log: ChatLog) -> None:
+        for message in self.test_log:
+            chat_log.add_message(message=message)
+
+    def assert_in_budget(self, chat_log: ChatLog) -> None:
+        self.assertLessEqual(chat_log.trimmed_chat_log_tokens, chat_log.max_chat_tokens)
+        self.assertEqual(chat_log.trimmed_chat_log_tokens, sum(message.tokens for message in chat_log.trimmed_chat_log))
+        if chat_log.max_chat_messages is not None:
+            self.assertLessEqual(len(chat_log.trimmed_chat_log), chat_log.max_chat_messages)
+        self.assertEqual(chat_log.get_finished_chat_log()[1:], [dict(message) for message in chat_log.trimmed_chat_log])
+        self.assertEqual(chat_log.trimmed_messages, len(chat_log.full_chat_log) - len(chat_log.trimmed_chat_log))
+
+    def test_all_policies_in_budget(self):
+        for name in trim_policies:
+            for max_model_tokens, max_chat_messages in [(8000, 200), (3000, 15)]:
+                with self.subTest(policy=name, max_model_tokens=max_model_tokens, max_chat_messages=max_chat_messages):
+                    chat_log = make_chat_log(name, max_model_tokens=max_model_tokens, max_chat_messages=max_chat_messages)
+                    self.add_one_at_a_time(chat_log)
+                    self.assert_in_budget(chat_log)
+                    chat_log.max_model_tokens = max_model_tokens * 2
+                    self.assert_in_budget(chat_log)
+
+    def test_fifo_and_pairs_rebuild_matches_trim(self):
+        """Tests that working the window out from scratch gives the same window as trimming after every message"""
+        for name in ("fifo", "pairs"):
+            with self.subTest(policy=name):
+                chat_log = make_chat_log(name, max_model_tokens=3000)
+                self.add_one_at_a_time(chat_log)
+                trimmed = list(chat_log.trimmed_chat_log)
+                chat_log.rebuild_trimmed_chat_log()
+                self.assertEqual(list(chat_log.trimmed_chat_log), trimmed)
+
+    def test_pairs(self):
+        chat_log = make_chat_log("pairs", max_model_tokens=3000)
+        self.add_one_at_a_time(chat_log)
+        self.assertNotEqual(chat_log.trimmed_chat_log[0].role, "assistant")
+
+    def test_keep_first(self):
+        chat_log = make_chat_log("keep_first", {"count": 2}, max_model_tokens=3000)
+        self.add_one_at_a_time(chat_log)
+        self.assertIs(chat_log.trimmed_chat_log[0], chat_log.full_chat_log[0])
+        self.assertIs(chat_log.trimmed_chat_log[1], chat_log.full_chat_log[1])
+        self.assertIs(chat_log.trimmed_chat_log[-1], chat_log.full_chat_log[-1])
+        chat_log.max_model_tokens = 4000
+        self.assertIs(chat_log.trimmed_chat_log[0], chat_log.full_chat_log[0])
+
+    def test_role_first(self):
+        """Tests that assistant messages are evicted before any user message, and the newest assistant messages are the ones kept"""
+        chat_log = make_chat_log("role_first", max_chat_messages=6)
+        for i in range(5):
+            chat_log.add_message("user", f"question {i}")
+            chat_log.add_message("assistant", f"answer {i}")
+        self.assertEqual(
+            [message.content for message in chat_log.trimmed_chat_log],
+            ["question 0", "question 1", "question 2", "question 3", "question 4", "answer 4"],
+        )
+        chat_log.max_chat_messages = 4
+        self.assertEqual([message.role for message in chat_log.trimmed_chat_log], ["user"] * 4)
+        self.assertEqual(chat_log.trimmed_chat_log[0].content, "question 1")
+        chat_log.max_chat_messages = 6
+        self.assertEqual(chat_log.trimmed_chat_log[-1].content, "answer 4")
+        self.assertEqual(len(chat_log.trimmed_chat_log), 6)
+
+    def test_policy_is_saved(self):
+        """Tests that a save keeps the trim policy, so a chat log it is loaded into goes on trimming the same way"""
+        chat_log = make_chat_log("keep_first", {"count": 2}, max_model_tokens=3000)
+        self.add_one_at_a_time(chat_log)
+        loaded = make_chat_log("fifo", max_model_tokens=3000)
+        loaded.load_save_dict(chat_log.make_save_dict())
+        self.assertEqual((loaded.trim_policy.name, loaded.trim_policy.options), ("keep_first", {"count": 2}))
+        self.assertEqual(loaded.constructor_args["trim_policy"], "keep_first")
+        self.assertEqual(loaded.get_finished_chat_log(), chat_log.get_finished_chat_log())
+        more_messages = get_test_chat_log("short_2000_messages.json")[:20]
+        chat_log.add_message_list(more_messages)
+        loaded.add_message_list(more_messages)
+        self.assertEqual(loaded.get_finished_chat_log(), chat_log.get_finished_chat_log())
+        self.assertEqual(loaded.trimmed_chat_log[0].content, self.test_log[0]["content"])
+
+    def test_pins_under_every_policy(self):
+        """Tests that a pinned message is kept under every policy, and that trimming after every message gives the same window as working it out from scratch"""
+        for name in trim_policies:
+            with self.subTest(policy=name):
+                chat_log = make_chat_log(name, max_model_tokens=3000, max_chat_messages=30)
+                chat_log.add_message_list(self.test_log[:10])
+                chat_log.pin_message(5)
+                chat_log.set_message_priority(7, -1)
+                for message in self.test_log[10:]:
+                    chat_log.add_message(message=message)
+                self.assert_in_budget(chat_log)
+                self.assertIn(5, chat_log.trimmed_chat_log.positions())
+                self.assertNotIn(7, chat_log.trimmed_chat_log.positions())
+                trimmed = list(chat_log.trimmed_chat_log)
+                chat_log.rebuild_trimmed_chat_log()
+                self.assertEqual(list(chat_log.trimmed_chat_log), trimmed)
+
+    def test_rebuild_reads_from_the_end(self):
+        """Tests that working the window out again only counts the messages near the end of a long chat log, not the whole history"""
+        test_log = get_test_chat_log("short_2000_messages.json")
+        for name, options in [("role_first", None), ("keep_first", {"count": 2}), ("pairs", None)]:
+            with self.subTest(policy=name):
+                chat_log = make_chat_log(name, options, max_model_tokens=3000)
+                chat_log.add_message_list(test_log)
+                save_dict = chat_log.make_save_dict()
+                for message in save_dict["full_chat_log"]:
+                    message.pop("tokens", None)
+                loaded = make_chat_log("fifo", max_model_tokens=3000)
+                loaded.load_save_dict(save_dict)
+                loaded.max_model_tokens = 4000
+                chat_log.max_model_tokens = 4000
+                self.assertEqual(list(loaded.trimmed_chat_log), list(chat_log.trimmed_chat_log))
+                counted = sum(message._tokens is not None for message in loaded.full_chat_log)
+                self.assertLessEqual(counted, 4 * len(loaded.trimmed_chat_log) + 64)
+
+    def test_bad_policy(self):
+        self.assertRaises(TrimPolicyError, make_trim_policy, "not-a-policy")
+        self.assertRaises(TrimPolicyError, make_trim_policy, "keep_first", {"count": -1})
+        self.assertRaises(TrimPolicyError, make_trim_policy, "pairs", {"not_an_option": 1})
+
+
+if __name__ == '__main__':
+    unittest.main(argv=[''], verbosity=2, exit=False)